@@ -9,12 +9,189 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 VOYAGE_API_KEY = os.getenv("VOYAGE_API_KEY")
 
 # Search Configuration
-TOP_K_RESULTS = 1
+TOP_K_RESULTS = 8
 EMBEDDING_MODEL = "voyage-3-large"
 CLAUDE_MODEL = "claude-sonnet-4-5-20250929"
 
+# Prompt Context
+# Retrieved chunks are packed into the prompt (best first) until this many estimated tokens;
+# neighbouring chunks of a file are merged, and a chunk with at least this fraction of its words
+# already in the context is dropped (None keeps every chunk)
+CONTEXT_TOKEN_BUDGET = 4000
+CONTEXT_REDUNDANCY_THRESHOLD = 0.9
+# Chunks around every retrieved chunk, and opening chunks of its document, that are added to the
+# context (after all the retrieved chunks, while CONTEXT_TOKEN_BUDGET lasts)
+CONTEXT_PREVIOUS_CHUNKS = 1
+CONTEXT_NEXT_CHUNKS = 1
+CONTEXT_HEAD_CHUNKS = 1
+# Anthropic prompt caching: the instructions and the packed context are the prompt prefix, marked as
+# cacheable when it is at least PROMPT_CACHE_MIN_TOKENS long (the API never caches a shorter prefix:
+# 1024 tokens for Sonnet and Opus, 2048 for Haiku). A query that retrieves the same chunks as a recent
+# one (a paraphrase the answer cache missed, a retry) then reads the context from the cache.
+# The instructions alone are a few dozen tokens, far below that minimum, so a breakpoint on them would
+# never be cached: the context is the only prefix worth caching. A cache write costs 1.25x the input
+# price and a read 0.1x, so caching pays off once about one context in four is read back; compare the
+# cache_read_input_tokens and cache_creation_input_tokens telemetry counters to check it does.
+PROMPT_CACHING = True
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Timings (retrieval, time to first token, total) are kept for this many recent queries
+QUERY_TIMINGS_KEPT = 1000
+
+# Semantic Answer Cache
+# A query whose embedding has at least this cosine similarity with a cached query, and that
+# retrieves the same chunks, gets the cached answer (None disables the cache)
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+# New answers are written to disk at most this often (and when the server or CLI shuts down)
+ANSWER_CACHE_SAVE_INTERVAL = 30.0
+
+# Query Embedding Cache
+# Exact (text, model, input_type) matches skip the embed call: this many live in memory, and
+# every embedding is also kept in a SQLite file (None keeps the cache in memory only)
+QUERY_EMBEDDING_CACHE_SIZE = 10_000
+QUERY_EMBEDDING_CACHE_FILE = "data/embeddings/query_embeddings.sqlite"
+QUERY_EMBEDDING_CACHE_DISK_ENTRIES = 100_000
+
+# Retrieval Configuration
+# "dense" only uses embeddings, "hybrid" fuses embeddings with BM25 keyword search
+RETRIEVAL_MODE = "hybrid"
+# How hybrid results are merged: "rrf" (reciprocal-rank fusion) or "weighted" (min-max normalized scores)
+FUSION_METHOD = "rrf"
+RRF_K = 60
+DENSE_WEIGHT = 0.5
+# How many candidates each retriever contributes before fusion
+HYBRID_CANDIDATES = 20
+
+# Approximate Nearest Neighbour Search
+# "exact" scans every chunk, "ivf" only scans the clusters closest to the query
+DENSE_INDEX = "ivf"
+# Below this many chunks the IVF index falls back to an exact scan
+ANN_EXACT_THRESHOLD = 10_000
+# Number of k-means clusters (None picks 4 * sqrt(number of chunks))
+ANN_NLIST = None
+# Number of clusters scanned per query: higher means better recall but slower queries
+ANN_NPROBE = 16
+
+# Two-Stage (Matryoshka) Search
+# voyage-3-large embeddings keep most of their meaning in a prefix of the vector. When set, a coarse
+# pass scores the first COARSE_DIMENSIONS dimensions (re-normalized) and the best COARSE_CANDIDATES
+# are re-ranked with the full vectors. None scores the full vectors directly.
+COARSE_DIMENSIONS = None
+COARSE_CANDIDATES = 200
+
+# Embedding Quantization
+# None keeps float32 vectors in RAM, "int8" stores 1 byte per dimension (4x smaller),
+# "pq" stores PQ_SUBVECTORS bytes per vector (64 bytes = 64x smaller for 1024 dimensions).
+# When set, this replaces DENSE_INDEX for dense search.
+QUANTIZATION = None
+PQ_SUBVECTORS = 64
+# The best candidates by compressed score are re-scored at full precision from the embedding store
+RERANK_CANDIDATES = 100
+
+# Chunking
+# chunk_by="token" packs whole sentences into chunks of about TOKEN_CHUNK_SIZE (estimated) tokens,
+# repeating up to TOKEN_CHUNK_OVERLAP tokens of trailing sentences at the start of the next chunk
+TOKEN_CHUNK_SIZE = 400
+TOKEN_CHUNK_OVERLAP = 40
+# How the ingestion CLI (python -m src.ingest) chunks each document: the first glob that
+# matches the file name wins. chunk_size/chunk_overlap can be left out to use the defaults.
+CHUNKING_POLICY = {
+    "*.pdf": {"chunk_by": "token"},
+    "*.docx": {"chunk_by": "token"},
+    "*.txt": {"chunk_by": "sentence"},
+    "*": {"chunk_by": "character"},
+}
+# Seconds between scans of DOCUMENTS_DIR in watch mode
+INGEST_WATCH_INTERVAL = 2.0
+
+# Metadata Filters (src/metadata_filter.py)
+# Tags of the documents that queries can be filtered on: every glob that matches a file name adds its tags,
+# e.g. {"*syllabus*": ["course"], "lecture_*.pdf": ["course", "lecture"]}
+DOCUMENT_TAGS = {}
+# A filter that leaves fewer than this fraction of the rows only scores those rows (gathered from the
+# matrix), otherwise every row is scored and the filtered out ones are masked before the top-k
+FILTER_GATHER_FRACTION = 0.25
+
+# Near-duplicate Chunks
+# Chunks whose estimated Jaccard similarity (of SHINGLE_SIZE-word shingles) with an earlier chunk
+# is at least DEDUP_THRESHOLD share its vector instead of being embedded and indexed (None disables)
+DEDUP_THRESHOLD = 0.9
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 32
+SHINGLE_SIZE = 5
+
+# Embedding Requests
+# Per-request limits of the embedding model
+EMBEDDING_MAX_BATCH_ITEMS = 1000
+EMBEDDING_MAX_BATCH_TOKENS = 120_000
+# Account rate limits (the defaults are Voyage's limits without a payment method, raise them for paid tiers)
+EMBEDDING_TOKENS_PER_MINUTE = 10_000
+EMBEDDING_REQUESTS_PER_MINUTE = 3
+EMBEDDING_MAX_CONCURRENCY = 4
+EMBEDDING_MAX_RETRIES = 5
+
+# Embedding Storage
+# "float32" keeps full precision, "float16" halves the size of the matrix on disk and in RAM
+EMBEDDING_STORE_DTYPE = "float32"
+# Chunks are embedded and appended to the store this many at a time, so embedding a corpus only
+# holds one batch of chunks and vectors in memory
+EMBED_BATCH_CHUNKS = 4000
+
+# Document Extraction
+# Processes used to extract text (None uses every CPU)
+EXTRACTION_WORKERS = None
+# PDFs with more pages than this are split into page ranges that are extracted in parallel
+PDF_PAGES_PER_TASK = 20
+# Ingest extracts (then chunks and embeds) this many files at a time, so only their text is held in memory
+INGEST_FILES_PER_BATCH = 16
+
+# Query Server (python -m src.server)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+# Queries that arrive within QUERY_BATCH_WAIT_MS of each other are embedded and retrieved together
+QUERY_BATCH_WAIT_MS = 5
+QUERY_BATCH_MAX_SIZE = 32
+# Answers generated at the same time, and requests accepted before new ones get a 503
+SERVER_MAX_LLM_CONCURRENCY = 8
+SERVER_MAX_PENDING_REQUESTS = 256
+
+# Retrieval Evaluation (python -m src.evaluation)
+# Labelled queries: [{"query": ..., "relevant": [{"file_name": ..., "text": <passage that answers it>}]}]
+EVALUATION_QUERIES_FILE = "tests/test_queries.json"
+EVALUATION_CUTOFFS = (1, 3, 5, 10)
+# Every chunking is evaluated with every retrieval mode
+EVALUATION_CHUNKINGS = [
+    {"chunk_by": "character", "chunk_size": 500, "chunk_overlap": 50},
+    {"chunk_by": "character", "chunk_size": 1000, "chunk_overlap": 100},
+    {"chunk_by": "sentence", "chunk_size": 5, "chunk_overlap": 1},
+    {"chunk_by": "token", "chunk_size": 200, "chunk_overlap": 20},
+    {"chunk_by": "token", "chunk_size": 400, "chunk_overlap": 40},
+]
+EVALUATION_RETRIEVAL_MODES = ["dense", "hybrid"]
+# Embeddings of chunks that are only used by evaluations (the embedding store is reused first)
+EVALUATION_EMBEDDINGS_FILE = "data/embeddings/evaluation_embeddings.sqlite"
+
+# Tracing, Metrics and Profiling (config/logging_config.py)
+# Every timed stage (load, chunk, embed, index, retrieve, generate, ...) and every profile is appended
+# to this file as one JSON line (None keeps them in memory only)
+TELEMETRY_FILE = None
+# Durations of this many recent spans of every stage are kept for the percentiles
+TELEMETRY_SPANS_KEPT = 1000
+# Fraction of queries and embedding/search calls run under cProfile (0 disables profiling)
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_TOP_FUNCTIONS = 20
+
+# Warm Start (src/snapshot.py)
+# Save the fully built retrieval state (chunks, search matrix, ANN/quantized and BM25 indexes) after
+# load_index builds it, and restore it directly on the next start while the embedding store is unchanged
+WARM_START_SNAPSHOT = True
+
 # File Paths
 DOCUMENTS_DIR = "documents"
 CHUNKS_DIR = "data/chunks"
 EMBEDDINGS_DIR = "data/embeddings"
 INDEXES_DIR = "data/indexes"
+SNAPSHOT_DIR = "data/snapshot"
+EXTRACTED_TEXT_DIR = "data/extracted"
@@ -1 +1,159 @@
-# Logging setup for debugging
\ No newline at end of file
+# Logging setup for debugging, and the pipeline's tracing, metrics and profiling hooks
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+
+from config.config import TELEMETRY_FILE, TELEMETRY_SPANS_KEPT, PROFILE_SAMPLE_RATE, PROFILE_TOP_FUNCTIONS
+
+# The span that is running in the current thread / task, so nested spans know their parent
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def configure_logging(level: int = logging.INFO) -> logging.Logger:
+    """Send the pipeline's log records ("rag" logger) to stderr"""
+    logger = logging.getLogger("rag")
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
+
+
+class Telemetry:
+    """
+    Timing spans and counters for the pipeline (load -> chunk -> embed -> index -> retrieve ->
+    generate). Spans nest into traces, every finished span and every profile is appended to
+    export_path as one JSON line (None keeps them in memory only), and the durations of the
+    most recent spans_kept spans of every name are kept for summary().
+    """
+
+    def __init__(self,
+                 export_path: Optional[str] = TELEMETRY_FILE,
+                 spans_kept: int = TELEMETRY_SPANS_KEPT,
+                 profile_sample_rate: float = PROFILE_SAMPLE_RATE,
+                 profile_top_functions: int = PROFILE_TOP_FUNCTIONS):
+        self.export_path = export_path
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_top_functions = profile_top_functions
+        self._durations = defaultdict(lambda: deque(maxlen=spans_kept))
+        self._counters = defaultdict(float)
+        self._lock = threading.Lock()
+        # cProfile can only run one profiler at a time per process
+        self._profiling = False
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Dict]:
+        """Time a stage. The yielded dict can be given more attributes before the span ends"""
+        parent = _current_span.get()
+        record = {"type": "span", "name": name,
+                  "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex[:16],
+                  "span_id": uuid.uuid4().hex[:16],
+                  "parent_id": parent["span_id"] if parent else None,
+                  "timestamp": time.time(), **attributes}
+        token = _current_span.set(record)
+        start_time = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["duration_ms"] = (time.perf_counter() - start_time) * 1000
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # A generator that was not run to the end is finished in another context
+                pass
+            with self._lock:
+                self._durations[name].append(record["duration_ms"])
+            self._export(record)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """Add to a counter (API calls, tokens, retries, cache hits, chunks scanned, ...)"""
+        with self._lock:
+            self._counters[name] += value
+
+    def counters(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters)
+
+    def summary(self) -> Dict[str, Dict]:
+        """count, mean and p50/p95/p99 (ms) of the recent spans of every name"""
+        with self._lock:
+            durations = {name: list(values) for name, values in self._durations.items()}
+        summary = {}
+        for name, values in durations.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[name] = {"count": len(values), "mean_ms": float(np.mean(values)),
+                             "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+        return summary
+
+    def export_counters(self) -> None:
+        """Append the current counters to export_path as one JSON line"""
+        self._export({"type": "counters", "timestamp": time.time(), "counters": self.counters()})
+
+    def reset(self) -> None:
+        with self._lock:
+            self._durations.clear()
+            self._counters.clear()
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[None]:
+        """Run a block under cProfile for a profile_sample_rate fraction of calls (0 disables)"""
+        with self._lock:
+            sampled = (not self._profiling and self.profile_sample_rate > 0
+                       and random.random() < self.profile_sample_rate)
+            if sampled:
+                self._profiling = True
+        if not sampled:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            self._export({"type": "profile", "name": name, "timestamp": time.time(),
+                          "trace_id": (_current_span.get() or {}).get("trace_id"),
+                          "top_functions": self._top_functions(profiler)})
+        finally:
+            with self._lock:
+                self._profiling = False
+
+    def _top_functions(self, profiler: cProfile.Profile) -> list:
+        stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats("cumulative")
+        functions = []
+        for (file_name, line, function), (_, num_calls, total, cumulative, _) in stats.stats.items():
+            functions.append({"function": f"{Path(file_name).name}:{line}({function})", "calls": num_calls,
+                              "total_ms": total * 1000, "cumulative_ms": cumulative * 1000})
+        functions.sort(key=lambda function: function["cumulative_ms"], reverse=True)
+        return functions[:self.profile_top_functions]
+
+    def _export(self, record: Dict) -> None:
+        if self.export_path is None:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            Path(self.export_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+# The process-wide instance the pipeline records to
+telemetry = Telemetry()
@@ -3,27 +3,42 @@
 import warnings
 warnings.filterwarnings("ignore", category=Warning)
 
+from config.logging_config import configure_logging, telemetry
 from src.rag_pipeline import RAGSystem
+from src.ingest import Ingestor
 
 def main():
     print("Welcome to Manish's Mini Notebook LM!\n")
+    logger = configure_logging()
     
-    # Start up the RAG pipline
+    # Start up the RAG pipline from the documents ingested with "python -m src.ingest"
     rag_system = RAGSystem()
-    rag_system.embed_documents()
+    if not rag_system.load_index():
+        # Nothing ingested yet, ingest the documents directory once with the configured chunking policy
+        Ingestor(rag_system.embedding_system, rag_system.multi_index.bm25).ingest()
+        rag_system.load_index()
+    print(f"Loaded {len(rag_system.embedded_chunks)} chunks")
     
     while True:
         user_query = input("Query: ")
         if user_query.lower() in ["quit", "q", "exit"]:
+            telemetry.export_counters()
+            rag_system.close()
             break
         
         try:
-            answer = rag_system.query(user_query)
-            print("\n" + "Claude: " + answer)
+            # Print the answer as it is generated
+            print("\n" + "Claude: ", end="", flush=True)
+            for text in rag_system.query_stream(user_query):
+                print(text, end="", flush=True)
+            timings = rag_system.query_timings[-1]
+            print(f"\n(first token after {timings['time_to_first_token'] or 0:.2f}s, "
+                  f"answered in {timings['total_seconds']:.2f}s)")
             print("-" * 50)
-        except Exception as e:
-            pass
-            # print(f"Exception: {e}")
+        except Exception:
+            # Report the failure and keep the session going
+            print()
+            logger.exception("Query failed: %r", user_query)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,256 @@
+# Approximate nearest-neighbour (IVF) index over the normalized embedding matrix
+import hashlib
+import math
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config.config import INDEXES_DIR, ANN_EXACT_THRESHOLD, ANN_NLIST, ANN_NPROBE
+from config.logging_config import telemetry
+from utils import file_utils
+from utils.vector_utils import exact_search, recall_at_k, top_k_indices
+
+IVF_INDEX_FILE = "ivf_index.npz"
+
+
+def chunk_fingerprint(chunks: Iterable[Dict]) -> str:
+    """Identify a list of chunks (and their order), so a saved index is only reused for the same rows"""
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(str(chunk.get("content_hash") or (chunk["file_name"], chunk["chunk_id"])).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IVFIndex:
+    """
+    Inverted file index: k-means splits the rows of the matrix into nlist clusters and a
+    query only scores the rows of its nprobe closest clusters. Below exact_threshold rows
+    every search is an exact scan instead.
+    """
+
+    def __init__(self,
+                 nlist: Optional[int] = ANN_NLIST,
+                 nprobe: int = ANN_NPROBE,
+                 exact_threshold: int = ANN_EXACT_THRESHOLD,
+                 kmeans_iterations: int = 15,
+                 seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.exact_threshold = exact_threshold
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.num_rows = 0
+        self.fingerprint = None
+        # Rows of cluster c are _list_rows[_list_offsets[c]:_list_offsets[c+1]]
+        self._centroids = None
+        self._list_offsets = np.zeros(1, dtype=np.int64)
+        self._list_rows = np.empty(0, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def build(self, normalized_matrix: np.ndarray, fingerprint: Optional[str] = None) -> None:
+        """Cluster the rows of the matrix and build the inverted lists
+
+        Args:
+            normalized_matrix (np.ndarray): L2-normalized vectors, one per row
+            fingerprint (str, optional): identifies the rows (see chunk_fingerprint)
+        """
+        self.num_rows = normalized_matrix.shape[0]
+        self.fingerprint = fingerprint
+        self._centroids = None
+        self._list_offsets = np.zeros(1, dtype=np.int64)
+        self._list_rows = np.empty(0, dtype=np.int64)
+        if self.num_rows < self.exact_threshold:
+            return
+
+        nlist = self.nlist or max(1, int(4 * math.sqrt(self.num_rows)))
+        self._centroids = self._train_kmeans(normalized_matrix, min(nlist, self.num_rows))
+        self._add_to_lists(normalized_matrix, np.arange(self.num_rows))
+
+    def add(self, normalized_matrix: np.ndarray, fingerprint: Optional[str] = None) -> None:
+        """Insert the rows of the matrix that are not indexed yet (rows num_rows onwards)
+
+        The clusters are not retrained, new rows go into the closest existing cluster.
+        An untrained index is (re)built once it grows past exact_threshold.
+
+        Args:
+            normalized_matrix (np.ndarray): the full matrix, the first num_rows rows already indexed
+            fingerprint (str, optional): identifies the rows of the full matrix
+        """
+        total_rows = normalized_matrix.shape[0]
+        if not self.is_trained:
+            self.build(normalized_matrix, fingerprint)
+            return
+        new_rows = np.arange(self.num_rows, total_rows)
+        self._add_to_lists(normalized_matrix[new_rows], new_rows)
+        self.num_rows = total_rows
+        self.fingerprint = fingerprint
+
+    def search(self,
+               normalized_matrix: np.ndarray,
+               normalized_queries: np.ndarray,
+               top_k: int,
+               nprobe: Optional[int] = None,
+               row_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the top_k rows for each query
+
+        Args:
+            row_mask (np.ndarray, optional): bool per row, only the True rows can be returned
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (num_queries, top_k) row indices and their cosine similarities.
+            If the probed clusters hold fewer than top_k rows, the missing results have row index -1.
+        """
+        queries = np.atleast_2d(normalized_queries)
+        num_rows = normalized_matrix.shape[0] if row_mask is None else int(row_mask.sum())
+        # A filter that leaves few rows is answered exactly (the probed clusters could miss all of them)
+        if not self.is_trained or num_rows <= self.exact_threshold:
+            telemetry.increment("chunks_scanned", len(queries) * num_rows)
+            return exact_search(normalized_matrix, queries, top_k, row_mask)
+
+        nprobe = min(nprobe or self.nprobe, len(self._centroids))
+        probed_lists = top_k_indices(queries @ self._centroids.T, nprobe)
+        num_results = min(top_k, normalized_matrix.shape[0])
+        idxs = np.full((len(queries), num_results), -1, dtype=np.int64)
+        scores = np.full((len(queries), num_results), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probed_lists)):
+            # Only score the rows in the probed clusters
+            rows = np.concatenate([self._list_rows[self._list_offsets[c]:self._list_offsets[c + 1]] for c in lists])
+            if row_mask is not None:
+                rows = rows[row_mask[rows]]
+            telemetry.increment("chunks_scanned", len(rows))
+            row_scores = normalized_matrix[rows] @ query
+            best = top_k_indices(row_scores, num_results)
+            idxs[i, :len(best)] = rows[best]
+            scores[i, :len(best)] = row_scores[best]
+        return idxs, scores
+
+    def save(self, index_dir: str = INDEXES_DIR) -> None:
+        """Save the index to one binary .npz file in index_dir"""
+        file_utils.ensure_directory_exists(index_dir)
+        path = Path(index_dir) / IVF_INDEX_FILE
+        tmp_path = path.with_name(IVF_INDEX_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     params=np.array([self.nlist or 0, self.nprobe, self.exact_threshold, self.num_rows]),
+                     fingerprint=np.frombuffer((self.fingerprint or "").encode("utf-8"), dtype=np.uint8),
+                     centroids=self._centroids if self.is_trained else np.empty((0, 0), dtype=np.float32),
+                     list_offsets=self._list_offsets,
+                     list_rows=self._list_rows)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, index_dir: str = INDEXES_DIR) -> Optional["IVFIndex"]:
+        """Load an index saved with save(), or None if there is no saved index"""
+        path = Path(index_dir) / IVF_INDEX_FILE
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            nlist, nprobe, exact_threshold, num_rows = (int(value) for value in data["params"])
+            index = cls(nlist=nlist or None, nprobe=nprobe, exact_threshold=exact_threshold)
+            index.num_rows = num_rows
+            index.fingerprint = data["fingerprint"].tobytes().decode("utf-8") or None
+            index._centroids = data["centroids"] if data["centroids"].size else None
+            index._list_offsets = data["list_offsets"]
+            index._list_rows = data["list_rows"]
+        return index
+
+    def _train_kmeans(self, normalized_matrix: np.ndarray, nlist: int) -> np.ndarray:
+        # Spherical k-means (cosine) on a sample of at most 256 rows per cluster
+        rng = np.random.default_rng(self.seed)
+        num_samples = min(normalized_matrix.shape[0], 256 * nlist)
+        sample = np.asarray(normalized_matrix[np.sort(rng.choice(normalized_matrix.shape[0], num_samples, replace=False))],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(num_samples, nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            assignments = self._assign(sample, centroids)
+            # Sum the rows of every cluster (sorted by cluster, one reduceat instead of a Python loop)
+            counts = np.bincount(assignments, minlength=nlist)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            sums[counts > 0] = np.add.reduceat(sample[np.argsort(assignments, kind="stable")],
+                                               starts[counts > 0], axis=0)
+            # Re-seed empty clusters with random sample rows
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(num_samples, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+        return centroids
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+        # Closest centroid of every vector, in batches to bound the size of the score matrix
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+            assignments[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        return assignments
+
+    def _add_to_lists(self, vectors: np.ndarray, rows: np.ndarray) -> None:
+        lists = np.concatenate([np.repeat(np.arange(len(self._list_offsets) - 1), np.diff(self._list_offsets)),
+                                self._assign(vectors, self._centroids)])
+        all_rows = np.concatenate([self._list_rows, rows])
+        order = np.argsort(lists, kind="stable")
+        counts = np.bincount(lists, minlength=len(self._centroids))
+        self._list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._list_rows = all_rows[order]
+
+
+def recall_report(normalized_matrix: np.ndarray,
+                  normalized_queries: np.ndarray,
+                  index: IVFIndex,
+                  top_k: int = 10,
+                  nprobes: Iterable[int] = (1, 2, 4, 8, 16, 32, 64)) -> List[Dict]:
+    """Measure recall@top_k and latency of the IVF index against exact search for several nprobe values
+
+    Args:
+        normalized_matrix (np.ndarray): the indexed matrix
+        normalized_queries (np.ndarray): queries to evaluate with (e.g. a sample of rows or real queries)
+        index (IVFIndex): a built index
+        top_k (int, optional): number of neighbours compared. Defaults to 10.
+        nprobes (Iterable[int], optional): nprobe values to try.
+
+    Returns:
+        List[Dict]: one row per nprobe with "nprobe", "recall", "latency_ms" and "exact_latency_ms"
+    """
+    start = time.perf_counter()
+    exact_idxs, _ = exact_search(normalized_matrix, normalized_queries, top_k)
+    exact_latency_ms = (time.perf_counter() - start) * 1000 / len(normalized_queries)
+
+    report = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        idxs, _ = index.search(normalized_matrix, normalized_queries, top_k, nprobe=nprobe)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(normalized_queries)
+        report.append({"nprobe": nprobe,
+                       "recall": recall_at_k(idxs, exact_idxs),
+                       "latency_ms": latency_ms,
+                       "exact_latency_ms": exact_latency_ms})
+    return report
+
+
+def main():
+    # Print the recall/latency trade-off of the IVF index on the stored embeddings
+    from src.embeddings_io import EmbeddingsIO
+    from utils.vector_utils import normalize_rows
+
+    matrix, _ = EmbeddingsIO.load_store()
+    if matrix is None:
+        print("No embeddings stored yet")
+        return
+    matrix = normalize_rows(matrix)
+    index = IVFIndex(exact_threshold=0)
+    index.build(matrix)
+    queries = matrix[np.random.default_rng(0).choice(len(matrix), min(100, len(matrix)), replace=False)]
+    for row in recall_report(matrix, queries, index):
+        print(f"nprobe={row['nprobe']:>3}  recall@10={row['recall']:.3f}  "
+              f"latency={row['latency_ms']:.2f}ms  (exact {row['exact_latency_ms']:.2f}ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Semantic answer cache: reuse Claude's answer for paraphrases of a query we already answered
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config.config import (INDEXES_DIR, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES,
+                           ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SAVE_INTERVAL)
+from utils import file_utils
+from utils.vector_utils import normalize_rows
+
+ANSWER_CACHE_FILE = "answer_cache.npz"
+
+
+def chunk_keys(chunks: List[Dict]) -> List[str]:
+    """Identify a set of retrieved chunks (by content, so re-chunked files never match old answers)"""
+    return sorted(str(chunk.get("content_hash") or (chunk["file_name"], chunk["chunk_id"], chunk["chunk_content"]))
+                  for chunk in chunks)
+
+
+class SemanticAnswerCache:
+    """
+    Answers keyed by query embedding. A lookup hits when a cached query is within threshold
+    cosine similarity of the new one and was answered from the same retrieved chunks. Entries
+    expire after ttl_seconds, the least recently used entry is evicted past max_entries, and
+    every entry is dropped when the corpus the answers came from changes. New answers are saved
+    at most every save_interval seconds, call flush() at shutdown to save the rest.
+    """
+
+    def __init__(self,
+                 threshold: float = ANSWER_CACHE_THRESHOLD,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds: Optional[float] = ANSWER_CACHE_TTL_SECONDS,
+                 index_dir: Optional[str] = INDEXES_DIR,
+                 save_interval: float = ANSWER_CACHE_SAVE_INTERVAL,
+                 clock=time.time):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.index_dir = index_dir
+        self.save_interval = save_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Saves run outside _lock (so lookups never wait on the disk) but never two at once
+        self._save_lock = threading.Lock()
+        # Row i of _embeddings is the normalized query embedding of _entries[i]. The matrix is
+        # preallocated (it doubles when full, up to max_entries + 1 rows), rows past len(_entries) are unused.
+        self._embeddings = None
+        self._entries = []
+        self.corpus_fingerprint = None
+        self._dirty = False
+        self._last_save = clock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        if index_dir is not None:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set_corpus(self, fingerprint: str) -> None:
+        """Tell the cache which corpus is searched, dropping every answer if it changed (re-ingest)"""
+        with self._lock:
+            if fingerprint == self.corpus_fingerprint:
+                return
+            if self._entries:
+                self.stats["invalidations"] += 1
+            self.corpus_fingerprint = fingerprint
+            self._embeddings = None
+            self._entries = []
+            self._dirty = True
+        self.flush()
+
+    def lookup(self, query_embedding: List[float], retrieved_chunks: List[Dict]) -> Optional[str]:
+        """Get the cached answer of a similar query that was answered from the same chunks, if any"""
+        keys = chunk_keys(retrieved_chunks)
+        with self._lock:
+            self._expire()
+            if self._entries:
+                scores = self._embeddings[:len(self._entries)] @ normalize_rows([query_embedding])[0]
+                for i in np.argsort(-scores):
+                    if scores[i] < self.threshold:
+                        break
+                    if self._entries[i]["chunk_keys"] == keys:
+                        self._entries[i]["last_used"] = self._clock()
+                        self.stats["hits"] += 1
+                        return self._entries[i]["answer"]
+            self.stats["misses"] += 1
+            return None
+
+    def add(self, query: str, query_embedding: List[float], retrieved_chunks: List[Dict], answer: str) -> None:
+        """Cache the answer to a query (saved once save_interval seconds passed since the last save)"""
+        now = self._clock()
+        with self._lock:
+            embedding = normalize_rows([query_embedding])[0]
+            num_entries = len(self._entries)
+            if self._embeddings is None or num_entries == len(self._embeddings):
+                self._grow(num_entries + 1, len(embedding))
+            self._embeddings[num_entries] = embedding
+            self._entries.append({"query": query, "answer": answer, "chunk_keys": chunk_keys(retrieved_chunks),
+                                  "created": now, "last_used": now})
+            # Evict the least recently used entries
+            if len(self._entries) > self.max_entries:
+                num_evicted = len(self._entries) - self.max_entries
+                keep = np.sort(np.argsort([-entry["last_used"] for entry in self._entries], kind="stable")[:self.max_entries])
+                self._keep(keep)
+                self.stats["evictions"] += num_evicted
+            self._dirty = True
+        if now - self._last_save >= self.save_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Save the cache if it changed since it was last saved"""
+        if self.index_dir is None:
+            return
+        with self._save_lock:
+            # Copy what is saved under the lock, then write it without holding the lock
+            with self._lock:
+                if not self._dirty:
+                    return
+                embeddings = (self._embeddings[:len(self._entries)].copy() if self._entries
+                              else np.empty((0, 0), dtype=np.float32))
+                metadata = json.dumps({"corpus_fingerprint": self.corpus_fingerprint, "entries": self._entries})
+                self._dirty = False
+                self._last_save = self._clock()
+            self._save(embeddings, metadata)
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def metrics(self) -> Dict:
+        """Hits, misses, hit rate, evictions, invalidations and size of the cache"""
+        return {**self.stats, "hit_rate": self.hit_rate(), "entries": len(self._entries)}
+
+    def _expire(self) -> None:
+        if self.ttl_seconds is None or not self._entries:
+            return
+        oldest_allowed = self._clock() - self.ttl_seconds
+        keep = [i for i, entry in enumerate(self._entries) if entry["created"] >= oldest_allowed]
+        if len(keep) < len(self._entries):
+            self.stats["evictions"] += len(self._entries) - len(keep)
+            self._keep(keep)
+
+    def _keep(self, rows) -> None:
+        # Move the kept rows to the front of the preallocated matrix
+        self._entries = [self._entries[i] for i in rows]
+        if self._entries:
+            self._embeddings[:len(self._entries)] = self._embeddings[np.asarray(rows, dtype=np.int64)]
+
+    def _grow(self, num_rows: int, dim: int) -> None:
+        capacity = min(max(2 * num_rows, 16), self.max_entries + 1)
+        embeddings = np.empty((max(capacity, num_rows), dim), dtype=np.float32)
+        if self._embeddings is not None and self._entries:
+            embeddings[:len(self._entries)] = self._embeddings[:len(self._entries)]
+        self._embeddings = embeddings
+
+    def _save(self, embeddings: np.ndarray, metadata: str) -> None:
+        file_utils.ensure_directory_exists(self.index_dir)
+        path = Path(self.index_dir) / ANSWER_CACHE_FILE
+        tmp_path = path.with_name(ANSWER_CACHE_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, embeddings=embeddings, metadata=np.frombuffer(metadata.encode("utf-8"), dtype=np.uint8))
+        tmp_path.replace(path)
+
+    def _load(self) -> None:
+        path = Path(self.index_dir) / ANSWER_CACHE_FILE
+        if not path.exists():
+            return
+        with np.load(path) as data:
+            metadata = json.loads(data["metadata"].tobytes().decode("utf-8"))
+            self.corpus_fingerprint = metadata["corpus_fingerprint"]
+            self._entries = metadata["entries"]
+            if self._entries:
+                self._grow(len(self._entries), data["embeddings"].shape[1])
+                self._embeddings[:len(self._entries)] = data["embeddings"]
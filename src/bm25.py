@@ -1,23 +1,252 @@
 # BM25 keyword search implementation
-import math
-from collections import Counter, defaultdict
-from typing import List, Dict
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from config.config import INDEXES_DIR
+from utils import file_utils
+from utils.text_processing import tokenize
+from utils.vector_utils import top_k_indices
+
+BM25_INDEX_FILE = "bm25_index.npz"
+
 
 class BM25Search:
+    """
+    Inverted index over chunks. Postings are stored as flat arrays sorted by term
+    (doc ids and term frequencies), with per-term offsets into them, so a query only
+    touches the postings of its own terms.
+    """
+
     def __init__(self, k1=1.5, b=0.75):
         self.k1 = k1  # Term frequency saturation parameter
         self.b = b    # Field length normalization parameter
-        
+
+        # Vocabulary: term -> term id
+        self._vocabulary = {}
+        self._terms = []
+        # Documents (chunks): which file and chunk each doc id is, and its length in tokens
+        self._file_names = []
+        self._doc_file = np.empty(0, dtype=np.int32)
+        self._doc_chunk = np.empty(0, dtype=np.int32)
+        self._doc_lengths = np.empty(0, dtype=np.int32)
+        # Postings of term t are _postings_docs[_offsets[t]:_offsets[t+1]] (and the same slice of _postings_tfs)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._postings_docs = np.empty(0, dtype=np.int32)
+        self._postings_tfs = np.empty(0, dtype=np.int32)
+        # Precomputed statistics
+        self._idf = np.empty(0)
+        self._length_norm = np.empty(0)
+        self._avgdl = 0.0
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def indexed_files(self) -> set:
+        """Get the names of all the files that have chunks in the index"""
+        return {self._file_names[i] for i in np.unique(self._doc_file)}
+
     def build_index(self, chunks: List[Dict]):
         """Build BM25 index from document chunks"""
-        # Calculate term frequencies, document frequencies, etc.
-        pass
-    
-    def search(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Search using BM25 scoring"""
-        # Calculate BM25 scores for query against all documents
-        pass
-    
+        self.__init__(self.k1, self.b)
+        self.add_chunks(chunks)
+
+    def add_chunks(self, chunks: List[Dict]):
+        """Add chunks to the index, replacing any indexed chunks of the same files
+
+        Args:
+            chunks (List[Dict]): chunks with "file_name", "chunk_id" and "chunk_content"
+        """
+        self.remove_files({chunk["file_name"] for chunk in chunks})
+        if not chunks:
+            return
+
+        # Calculate term frequencies and document lengths of the new chunks
+        file_ids = {file_name: i for i, file_name in enumerate(self._file_names)}
+        first_doc_id = len(self._doc_lengths)
+        new_terms, new_docs, new_tfs = [], [], []
+        doc_file, doc_chunk, doc_lengths = [], [], []
+        for offset, chunk in enumerate(chunks):
+            tokens = tokenize(chunk["chunk_content"])
+            for term, tf in Counter(tokens).items():
+                if term not in self._vocabulary:
+                    self._vocabulary[term] = len(self._terms)
+                    self._terms.append(term)
+                new_terms.append(self._vocabulary[term])
+                new_docs.append(first_doc_id + offset)
+                new_tfs.append(tf)
+            if chunk["file_name"] not in file_ids:
+                file_ids[chunk["file_name"]] = len(self._file_names)
+                self._file_names.append(chunk["file_name"])
+            doc_file.append(file_ids[chunk["file_name"]])
+            doc_chunk.append(chunk["chunk_id"])
+            doc_lengths.append(len(tokens))
+
+        self._doc_file = np.concatenate([self._doc_file, np.asarray(doc_file, dtype=np.int32)])
+        self._doc_chunk = np.concatenate([self._doc_chunk, np.asarray(doc_chunk, dtype=np.int32)])
+        self._doc_lengths = np.concatenate([self._doc_lengths, np.asarray(doc_lengths, dtype=np.int32)])
+
+        # Merge the new postings into the term-sorted arrays
+        terms = np.concatenate([self._posting_terms(), np.asarray(new_terms, dtype=np.int32)])
+        docs = np.concatenate([self._postings_docs, np.asarray(new_docs, dtype=np.int32)])
+        tfs = np.concatenate([self._postings_tfs, np.asarray(new_tfs, dtype=np.int32)])
+        order = np.argsort(terms, kind="stable")
+        self._set_postings(terms[order], docs[order], tfs[order])
+
+    def remove_files(self, file_names: Iterable[str]):
+        """Remove every chunk of some files from the index without rebuilding it
+
+        Args:
+            file_names (Iterable[str]): names of the files to remove
+        """
+        file_names = set(file_names)
+        remove_file_ids = [i for i, file_name in enumerate(self._file_names) if file_name in file_names]
+        if not remove_file_ids:
+            return
+        doc_alive = ~np.isin(self._doc_file, remove_file_ids)
+
+        # Renumber the remaining docs, files and terms so the arrays stay dense
+        new_doc_id = np.cumsum(doc_alive, dtype=np.int64) - 1
+        keep_postings = doc_alive[self._postings_docs]
+        terms = self._posting_terms()[keep_postings]
+        docs = new_doc_id[self._postings_docs[keep_postings]].astype(np.int32)
+        tfs = self._postings_tfs[keep_postings]
+
+        term_alive = np.bincount(terms, minlength=len(self._terms)) > 0
+        new_term_id = np.cumsum(term_alive, dtype=np.int64) - 1
+        self._terms = [term for term, alive in zip(self._terms, term_alive) if alive]
+        self._vocabulary = {term: i for i, term in enumerate(self._terms)}
+
+        file_alive = np.ones(len(self._file_names), dtype=bool)
+        file_alive[remove_file_ids] = False
+        new_file_id = np.cumsum(file_alive, dtype=np.int64) - 1
+        self._file_names = [name for name, alive in zip(self._file_names, file_alive) if alive]
+
+        self._doc_file = new_file_id[self._doc_file[doc_alive]].astype(np.int32)
+        self._doc_chunk = self._doc_chunk[doc_alive]
+        self._doc_lengths = self._doc_lengths[doc_alive]
+        self._set_postings(new_term_id[terms].astype(np.int32), docs, tfs)
+
+    def doc_keys(self) -> List[Tuple[str, int]]:
+        """Get the (file_name, chunk_id) of every indexed chunk, in doc id order"""
+        return [(self._file_names[file_id], int(chunk_id)) for file_id, chunk_id in zip(self._doc_file, self._doc_chunk)]
+
+    def search(self, query: str, top_k: int = 5, doc_mask: Optional[np.ndarray] = None) -> List[Dict]:
+        """Search using BM25 scoring
+
+        Args:
+            query (str): the user query
+            top_k (int, optional): number of results to return. Defaults to 5.
+            doc_mask (np.ndarray, optional): bool per doc id, only the True docs can be returned
+
+        Returns:
+            List[Dict]: "file_name", "chunk_id" and "score" of the top_k chunks, best first
+        """
+        # Calculate BM25 scores only for documents that contain at least one query term
+        term_ids = [self._vocabulary[term] for term in set(tokenize(query)) if term in self._vocabulary]
+        if not term_ids:
+            return []
+        candidate_docs = []
+        contributions = []
+        for term_id in term_ids:
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            docs = self._postings_docs[start:end]
+            tfs = self._postings_tfs[start:end]
+            candidate_docs.append(docs)
+            contributions.append(self._idf[term_id] * tfs * (self.k1 + 1) / (tfs + self._length_norm[docs]))
+        docs, inverse = np.unique(np.concatenate(candidate_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        if doc_mask is not None:
+            allowed = doc_mask[docs]
+            docs, scores = docs[allowed], scores[allowed]
+
+        return [{"file_name": self._file_names[self._doc_file[docs[i]]],
+                 "chunk_id": int(self._doc_chunk[docs[i]]),
+                 "score": float(scores[i])}
+                for i in top_k_indices(scores, top_k)]
+
     def _calculate_bm25_score(self, query_terms: List[str], doc_terms: List[str]) -> float:
         """Calculate BM25 score for a single document"""
-        pass
+        # Reference (unvectorized) version of the scoring in search()
+        term_frequencies = Counter(doc_terms)
+        length_norm = self.k1 * (1 - self.b + self.b * len(doc_terms) / self._avgdl)
+        score = 0.0
+        for term in set(query_terms):
+            if term not in self._vocabulary or term not in term_frequencies:
+                continue
+            tf = term_frequencies[term]
+            score += self._idf[self._vocabulary[term]] * tf * (self.k1 + 1) / (tf + length_norm)
+        return score
+
+    def save(self, index_dir: str = INDEXES_DIR) -> None:
+        """Save the index to one binary .npz file in index_dir"""
+        file_utils.ensure_directory_exists(index_dir)
+        path = Path(index_dir) / BM25_INDEX_FILE
+        tmp_path = path.with_name(BM25_INDEX_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     params=np.array([self.k1, self.b]),
+                     terms=_encode_strings(self._terms),
+                     file_names=_encode_strings(self._file_names),
+                     doc_file=self._doc_file,
+                     doc_chunk=self._doc_chunk,
+                     doc_lengths=self._doc_lengths,
+                     offsets=self._offsets,
+                     postings_docs=self._postings_docs,
+                     postings_tfs=self._postings_tfs)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, index_dir: str = INDEXES_DIR) -> Optional["BM25Search"]:
+        """Load an index saved with save(), or None if there is no saved index"""
+        path = Path(index_dir) / BM25_INDEX_FILE
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            k1, b = data["params"]
+            index = cls(k1=float(k1), b=float(b))
+            index._terms = _decode_strings(data["terms"])
+            index._vocabulary = {term: i for i, term in enumerate(index._terms)}
+            index._file_names = _decode_strings(data["file_names"])
+            index._doc_file = data["doc_file"]
+            index._doc_chunk = data["doc_chunk"]
+            index._doc_lengths = data["doc_lengths"]
+            index._offsets = data["offsets"]
+            index._postings_docs = data["postings_docs"]
+            index._postings_tfs = data["postings_tfs"]
+        index._update_statistics()
+        return index
+
+    def _posting_terms(self) -> np.ndarray:
+        # The term id of every posting, expanded from the offsets
+        return np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int32), np.diff(self._offsets))
+
+    def _set_postings(self, terms: np.ndarray, docs: np.ndarray, tfs: np.ndarray) -> None:
+        counts = np.bincount(terms, minlength=len(self._terms))
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._postings_docs = docs
+        self._postings_tfs = tfs
+        self._update_statistics()
+
+    def _update_statistics(self) -> None:
+        # IDF of every term and the length normalization of every document
+        num_docs = len(self._doc_lengths)
+        document_frequencies = np.diff(self._offsets)
+        self._idf = np.log(1 + (num_docs - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        self._avgdl = float(self._doc_lengths.mean()) if num_docs else 0.0
+        if num_docs:
+            self._length_norm = self.k1 * (1 - self.b + self.b * self._doc_lengths / max(self._avgdl, 1e-9))
+        else:
+            self._length_norm = np.empty(0)
+
+
+def _encode_strings(strings: List[str]) -> np.ndarray:
+    # Pack a list of strings into one byte array (file names and words never contain "\0")
+    return np.frombuffer("\0".join(strings).encode("utf-8"), dtype=np.uint8)
+
+
+def _decode_strings(data: np.ndarray) -> List[str]:
+    text = data.tobytes().decode("utf-8")
+    return text.split("\0") if text else []
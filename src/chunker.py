@@ -1,12 +1,179 @@
-# Split documents into fixed-size character and sentence based chunking
+# Split documents into fixed-size character, sentence and token based chunking
 import re
-from typing import Dict, List, Optional
+from array import array
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config.config import TOKEN_CHUNK_SIZE, TOKEN_CHUNK_OVERLAP
+from config.logging_config import telemetry
+from utils.text_processing import CHARS_PER_TOKEN, estimate_tokens
+
+# Sentences end at ".", "!" or "?" followed by whitespace
+SENTENCE_BOUNDARY = re.compile(r"(?<=[!?.])\s+")
+# (chunk_size, chunk_overlap) used when they are not given, per chunk_by
+DEFAULT_CHUNK_SIZES = {"character": (500, 50),
+                       "sentence": (5, 1),
+                       "token": (TOKEN_CHUNK_SIZE, TOKEN_CHUNK_OVERLAP)}
+
+
+class ChunkRecords:
+    """
+    The chunks of one document stored compactly: the (start, end) offset of every chunk
+    into the document's text in two int64 arrays, and the metadata once. The text of a
+    chunk is only sliced out of the document when it is read.
+    """
+    __slots__ = ("file_name", "text", "chunk_by", "chunk_size", "chunk_overlap", "_starts", "_ends")
+
+    def __init__(self,
+                 file_name: str,
+                 text: str,
+                 chunk_by: str,
+                 chunk_size: Optional[int] = None,
+                 chunk_overlap: Optional[int] = None,
+                 spans: Optional[Iterator[Tuple[int, int]]] = None):
+        self.file_name = file_name
+        self.text = text
+        self.chunk_by = chunk_by
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._starts = array("q")
+        self._ends = array("q")
+        for start, end in spans or ():
+            self._starts.append(start)
+            self._ends.append(end)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, chunk_id: int) -> Dict:
+        if chunk_id < 0:
+            chunk_id += len(self)
+        return {"chunk_id": chunk_id,
+                "chunk_content": self.chunk_text(chunk_id),
+                "file_name": self.file_name,
+                "start_char": self._starts[chunk_id],
+                "end_char": self._ends[chunk_id],
+                "chunk_by": self.chunk_by,
+                "chunk_size": self.chunk_size,
+                "chunk_overlap": self.chunk_overlap}
+
+    def __iter__(self) -> Iterator[Dict]:
+        for chunk_id in range(len(self)):
+            yield self[chunk_id]
+
+    def span(self, chunk_id: int) -> Tuple[int, int]:
+        """Get the (start, end) offsets of a chunk in the document's text"""
+        return self._starts[chunk_id], self._ends[chunk_id]
+
+    def chunk_text(self, chunk_id: int) -> str:
+        """Get the text of one chunk"""
+        return self.text[self._starts[chunk_id]:self._ends[chunk_id]]
+
+    def texts(self) -> Iterator[str]:
+        """Get the text of every chunk, one at a time (e.g. to feed embedding batches)"""
+        for chunk_id in range(len(self)):
+            yield self.chunk_text(chunk_id)
+
+    def total_tokens(self) -> int:
+        """Estimate how many tokens embedding every chunk will send (overlap included)"""
+        return sum(estimate_tokens(text) for text in self.texts())
+
 
 class TextChunker:
     """
     Creates a chunker for one file with specified chunking method, chunk size, and chunk overlap
     """
     
+    def _sentence_spans(self,
+                        text: str,
+                        chunk_size: int = 5,
+                        chunk_overlap: int = 1) -> Iterator[Tuple[int, int]]:
+        """Lazily seperates a large peice of text into chunks of chunk_size sentences
+
+        Returns:
+            Iterator[Tuple[int, int]]: the (start, end) offsets of every chunk in the text
+        """
+        step = chunk_size - chunk_overlap
+        # The sentences of the next chunk, and how many sentences to skip before it starts
+        window = deque()
+        num_to_skip = 0
+        for sentence in self._sentence_offsets(text):
+            if num_to_skip:
+                num_to_skip -= 1
+                continue
+            window.append(sentence)
+            if len(window) == chunk_size:
+                yield window[0][0], window[-1][1]
+                for _ in range(min(step, len(window))):
+                    window.popleft()
+                num_to_skip = max(step - chunk_size, 0)
+        # The last chunks can hold fewer than chunk_size sentences
+        while window:
+            yield window[0][0], window[-1][1]
+            for _ in range(min(step, len(window))):
+                window.popleft()
+    
+    @staticmethod
+    def _sentence_offsets(text: str) -> Iterator[Tuple[int, int]]:
+        # The same sentences as re.split(SENTENCE_BOUNDARY, text), as offsets
+        start = 0
+        for match in SENTENCE_BOUNDARY.finditer(text):
+            yield start, match.start()
+            start = match.end()
+        yield start, len(text)
+        
+    def _character_spans(self,
+                         text: str,
+                         chunk_size: int = 500,
+                         chunk_overlap: int = 50) -> Iterator[Tuple[int, int]]:
+        """Lazily seperates a large peice of text into chunks of chunk_size characters
+
+        Returns:
+            Iterator[Tuple[int, int]]: the (start, end) offsets of every chunk in the text
+        """
+        start_idx = 0
+        # Seperate large text into chunks with overlap
+        while start_idx < len(text):
+            yield start_idx, min(start_idx + chunk_size, len(text))
+            start_idx += chunk_size - chunk_overlap
+    
+    def _token_spans(self,
+                     text: str,
+                     chunk_size: int = TOKEN_CHUNK_SIZE,
+                     chunk_overlap: int = TOKEN_CHUNK_OVERLAP) -> Iterator[Tuple[int, int]]:
+        """Lazily packs whole sentences into chunks of at most chunk_size estimated tokens
+
+        The next chunk starts with the trailing sentences of the previous one that fit in
+        chunk_overlap tokens. A sentence longer than chunk_size is split by characters.
+
+        Returns:
+            Iterator[Tuple[int, int]]: the (start, end) offsets of every chunk in the text
+        """
+        # (start, end, tokens) of the sentences in the current chunk
+        window = deque()
+        window_tokens = 0
+        for start, end in self._sentence_offsets(text):
+            # Sentences that are too long on their own are cut into pieces that fit
+            piece_length = chunk_size * CHARS_PER_TOKEN
+            for piece_start in range(start, end, piece_length):
+                piece_end = min(piece_start + piece_length, end)
+                tokens = estimate_tokens(text[piece_start:piece_end])
+                if window and window_tokens + tokens > chunk_size:
+                    yield window[0][0], window[-1][1]
+                    # Keep the trailing sentences that fit in the overlap, as long as the new one fits too
+                    overlap = deque()
+                    overlap_tokens = 0
+                    while window and overlap_tokens + window[-1][2] <= chunk_overlap:
+                        overlap.appendleft(window.pop())
+                        overlap_tokens += overlap[0][2]
+                    while overlap and overlap_tokens + tokens > chunk_size:
+                        overlap_tokens -= overlap.popleft()[2]
+                    window, window_tokens = overlap, overlap_tokens
+                window.append((piece_start, piece_end, tokens))
+                window_tokens += tokens
+        if window:
+            yield window[0][0], window[-1][1]
+    
     def _sentence_based_fixed_size_chunking(self, 
                                             text: str,
                                             chunk_size: int = 5,
@@ -16,31 +183,8 @@ class TextChunker:
         Returns:
             List[Dict[str, str | int]]: A list of all the chunks and and id corresponding to that chunk
         """
-        # Split large text into a list of each sentence
-        sentences = re.split(r"(?<=[!?.])\s+", text)
-        
-        chunks = []
-        start_idx = 0
-        # Seperate large text into chunks with overlap
-        while start_idx < len(sentences):
-            end_idx = min(start_idx + chunk_size, len(sentences))
-            
-            current_chunk = sentences[start_idx: end_idx]
-            chunks.append(" ".join(current_chunk))
-            start_idx += chunk_size - chunk_overlap
-        
-        # Create a list of chunks and ids about each chunk
-        chunk_data = []
-        for id, chunk_content in enumerate(chunks):
-            chunk_data.append(
-                {
-                    "chunk_id": id,
-                    "chunk_content": chunk_content
-                }
-            )
-            
-        # Return chunk_data
-        return chunk_data
+        return [{"chunk_id": id, "chunk_content": text[start:end]}
+                for id, (start, end) in enumerate(self._sentence_spans(text, chunk_size, chunk_overlap))]
         
     def _character_based_fixed_size_chunking(self, 
                                              text: str, 
@@ -51,28 +195,63 @@ class TextChunker:
         Returns:
             List[Dict[str, str | int]]: A list of all the chunks and and id corresponding to that chunk
         """
-        chunks = []
-        start_idx = 0
-        # Seperate large text into chunks with overlap
-        while start_idx < len(text):
-            end_idx = min(start_idx + chunk_size, len(text))
-            
-            current_chunk = text[start_idx: end_idx]
-            chunks.append(current_chunk)
-            start_idx += chunk_size - chunk_overlap
+        return [{"chunk_id": id, "chunk_content": text[start:end]}
+                for id, (start, end) in enumerate(self._character_spans(text, chunk_size, chunk_overlap))]
+    
+    
+    def chunk_spans(self,
+                    text: str,
+                    chunk_by: str,
+                    chunk_size: Optional[int] = None,
+                    chunk_overlap: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+        """Lazily chunk a text, yielding the (start, end) offsets of every chunk instead of copies of it
+
+        Args:
+            text (str): the text to chunk
+            chunk_by (str): "character", "sentence" or "token"
+            chunk_size (int, optional): characters, sentences or tokens per chunk. Defaults to the method's default.
+            chunk_overlap (int, optional): characters, sentences or tokens shared by neighbouring chunks.
+
+        Returns:
+            Iterator[Tuple[int, int]]: offsets of the chunks, in order
+        """
+        # Check if the chunk_by is valid
+        valid_chunk_by = ["character", "sentence", "token"]
+        # Raise a ValueError if chunk_by not "character", "sentence" or "token"
+        if chunk_by not in valid_chunk_by:
+            raise ValueError(f"Chunk_by must be one of {valid_chunk_by}, got {chunk_by}")
         
-        # Create a list of chunks and ids about each chunk
-        chunk_data = []
-        for id, chunk_content in enumerate(chunks):
-            chunk_data.append(
-                {
-                    "chunk_id": id,
-                    "chunk_content": chunk_content
-                }
-            )
-            
-        # Return chunk_data
-        return chunk_data
+        # Fall back to the default size and overlap of the chunking method
+        default_size, default_overlap = DEFAULT_CHUNK_SIZES[chunk_by]
+        chunk_size = chunk_size or default_size
+        chunk_overlap = default_overlap if chunk_overlap is None else chunk_overlap
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        
+        if chunk_by == "sentence":
+            return self._sentence_spans(text, chunk_size, chunk_overlap)
+        if chunk_by == "token":
+            return self._token_spans(text, chunk_size, chunk_overlap)
+        return self._character_spans(text, chunk_size, chunk_overlap)
+    
+    
+    def chunk_records(self,
+                      file_name: str,
+                      text: str,
+                      chunk_by: str,
+                      chunk_size: Optional[int] = None,
+                      chunk_overlap: Optional[int] = None) -> ChunkRecords:
+        """Chunk a document into compact, offset-based records
+
+        Returns:
+            ChunkRecords: the chunks of the document, read as the same dicts chunk_document returns
+        """
+        with telemetry.span("chunk", file_name=file_name, chunk_by=chunk_by) as span:
+            records = ChunkRecords(file_name, text, chunk_by, chunk_size, chunk_overlap,
+                                   spans=self.chunk_spans(text, chunk_by, chunk_size, chunk_overlap))
+            span["chunks"] = len(records)
+        telemetry.increment("chunks_created", len(records))
+        return records
         
          
     def chunk_document(self, 
@@ -82,33 +261,8 @@ class TextChunker:
                        chunk_size: Optional[int] = None, 
                        chunk_overlap: Optional[int] = None) -> List[Dict]:
         
-        # Check if the chunk_by is valid
-        valid_chunk_by = ["character", "sentence"]
-        # Raise a ValueError if chunk_by not "character" or "sentence"
-        if chunk_by not in valid_chunk_by:
-            raise ValueError(f"Chunk_by must be one of {valid_chunk_by}, got {chunk_by}")
-        
-        # Return the text chunked by the specified method
-        kwargs = {
-            "text": text
-        }
-        if chunk_size:
-            kwargs["chunk_size"] = chunk_size
-        if chunk_overlap:
-            kwargs["chunk_overlap"] = chunk_overlap
-            
-        if chunk_by == "sentence":
-            chunks = self._sentence_based_fixed_size_chunking(**kwargs)
-        elif chunk_by == "character":
-            chunks = self._character_based_fixed_size_chunking(**kwargs)
-        # Add meta data to each chunk
-        for chunk in chunks:
-            chunk["file_name"] = file_name
-            chunk["chunk_by"] = chunk_by
-            chunk["chunk_size"] = chunk_size
-            chunk["chunk_overlap"] = chunk_overlap
-            
-        return chunks
+        # Every chunk is sliced out of the text once, with its metadata
+        return list(self.chunk_records(file_name, text, chunk_by, chunk_size, chunk_overlap))
         
         
 def main():
@@ -0,0 +1,229 @@
+# Packs ranked chunks into the context of the prompt, within a token budget
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config.config import (CONTEXT_TOKEN_BUDGET, CONTEXT_REDUNDANCY_THRESHOLD, CONTEXT_HEAD_CHUNKS,
+                           CONTEXT_PREVIOUS_CHUNKS, CONTEXT_NEXT_CHUNKS)
+from utils.text_processing import estimate_tokens, tokenize
+
+# Shorter common suffix/prefixes of neighbouring chunks are taken as coincidence, not window overlap
+MIN_OVERLAP_CHARS = 8
+# Between the <source> elements of the context
+PASSAGE_SEPARATOR = "\n\n"
+
+
+def overlap_length(previous: str, following: str) -> int:
+    """Length of the longest suffix of previous that is also a prefix of following (0 if under MIN_OVERLAP_CHARS)"""
+    probe = following[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return 0
+    start = previous.find(probe, max(len(previous) - len(following), 0))
+    while start != -1:
+        # The first match from the left is the longest overlap
+        if following.startswith(previous[start:]):
+            return len(previous) - start
+        start = previous.find(probe, start + 1)
+    return 0
+
+
+def chunk_overlap_length(previous: Dict, following: Dict, previous_text: str) -> int:
+    """Characters at the start of following that repeat the end of previous (which reads previous_text)"""
+    if previous.get("end_char") is not None and following.get("start_char") is not None:
+        # Offsets into the same document: the overlap is exact
+        return min(max(previous["end_char"] - following["start_char"], 0), len(following["chunk_content"]))
+    return overlap_length(previous_text, following["chunk_content"])
+
+
+class ChunkPositionIndex:
+    """
+    Finds stored chunks by position: (file_name, chunk_id) -> chunk, so the neighbours and
+    the opening chunks of a retrieved chunk's document are dictionary lookups. A chunk that
+    was collapsed onto a near-duplicate is found at its own position, with the kept chunk's text.
+    """
+
+    def __init__(self, chunks: Iterable[Dict]):
+        self._chunks = {}
+        for chunk in chunks:
+            self._chunks[(chunk["file_name"], chunk["chunk_id"])] = chunk
+            for source in chunk.get("duplicate_sources", ()):
+                # Its text is only nearly the same, so it is stitched by text rather than by offsets
+                self._chunks.setdefault((source["file_name"], source["chunk_id"]),
+                                        {**source, "chunk_content": chunk["chunk_content"],
+                                         "start_char": None, "end_char": None})
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def get(self, file_name: str, chunk_id: int) -> Optional[Dict]:
+        return self._chunks.get((file_name, chunk_id))
+
+    def neighbours(self, chunk: Dict, num_previous: int, num_next: int) -> List[Dict]:
+        """Get the chunks around a chunk, closest first (previous ones before next ones)"""
+        found = []
+        for offsets in (range(-1, -num_previous - 1, -1), range(1, num_next + 1)):
+            for offset in offsets:
+                neighbour = self.get(chunk["file_name"], chunk["chunk_id"] + offset)
+                if neighbour is None:
+                    break
+                found.append(neighbour)
+        return found
+
+    def document_head(self, file_name: str, num_chunks: int) -> List[Dict]:
+        """Get the first num_chunks chunks of a document"""
+        head = []
+        for chunk_id in range(num_chunks):
+            chunk = self.get(file_name, chunk_id)
+            if chunk is None:
+                break
+            head.append(chunk)
+        return head
+
+
+class ContextBuilder:
+    """
+    Turns retrieved chunks (best first) into the context of the prompt. Chunks next to each
+    other in the same file are merged into one passage with their overlap stitched out, chunks
+    that mostly repeat text already in the context are dropped, and passages are added in rank
+    order until the estimated token budget of the context (<source> wrappers included) is used up. With a ChunkPositionIndex, the chunks
+    around every retrieved chunk and the opening chunks of its document are added after the
+    retrieved chunks, while the budget lasts.
+    """
+
+    def __init__(self,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 redundancy_threshold: Optional[float] = CONTEXT_REDUNDANCY_THRESHOLD,
+                 num_head_chunks: int = CONTEXT_HEAD_CHUNKS,
+                 num_previous_chunks: int = CONTEXT_PREVIOUS_CHUNKS,
+                 num_next_chunks: int = CONTEXT_NEXT_CHUNKS):
+        self.token_budget = token_budget
+        self.redundancy_threshold = redundancy_threshold
+        self.num_head_chunks = num_head_chunks
+        self.num_previous_chunks = num_previous_chunks
+        self.num_next_chunks = num_next_chunks
+        self.last_stats = {}
+
+    def expand(self, chunks: List[Dict], positions: ChunkPositionIndex) -> List[Dict]:
+        """Add the neighbours of the retrieved chunks, then the opening chunks of their documents
+
+        Args:
+            chunks (List[Dict]): retrieved chunks, best first
+            positions (ChunkPositionIndex): position index over the stored chunks
+
+        Returns:
+            List[Dict]: the retrieved chunks, then the neighbours and document heads (best first,
+            without repeats)
+        """
+        neighbours = chain.from_iterable(positions.neighbours(chunk, self.num_previous_chunks, self.num_next_chunks)
+                                         for chunk in chunks)
+        heads = chain.from_iterable(positions.document_head(file_name, self.num_head_chunks)
+                                    for file_name in dict.fromkeys(chunk["file_name"] for chunk in chunks))
+        expanded = {}
+        for chunk in chain(chunks, neighbours, heads):
+            expanded.setdefault((chunk["file_name"], chunk["chunk_id"]), chunk)
+        return list(expanded.values())
+
+    def pack(self, chunks: List[Dict]) -> List[Dict]:
+        """Pack ranked chunks into passages
+
+        Args:
+            chunks (List[Dict]): retrieved chunks, best first, with "file_name", "chunk_id" and "chunk_content"
+
+        Returns:
+            List[Dict]: passages ({"file_name", "first_chunk_id", "last_chunk_id", "text"}) in the
+            order of their best chunk
+        """
+        passages = []
+        kept_words = []
+        num_tokens = 0
+        num_redundant = 0
+        num_over_budget = 0
+        for chunk in chunks:
+            text = chunk["chunk_content"]
+            words = set(tokenize(text))
+            # 1. Skip chunks whose words are (almost) all in a chunk already packed
+            if self._is_redundant(words, kept_words):
+                num_redundant += 1
+                continue
+
+            # 2. Extend the passage this chunk is next to, join the two passages it fills the gap
+            # between, or start a new one
+            before, after = self._adjacent_passages(passages, chunk)
+            new_text = text
+            if before is not None:
+                previous = passages[before]
+                new_text = previous["text"] + text[chunk_overlap_length(previous["last"], chunk, previous["text"]):]
+            if after is not None:
+                following = {**passages[after]["first"], "chunk_content": passages[after]["text"]}
+                new_text = (new_text[:len(new_text) - chunk_overlap_length(chunk, following, new_text)]
+                            + following["chunk_content"])
+            first = chunk if before is None else passages[before]["first"]
+            last = chunk if after is None else passages[after]["last"]
+            merged = {"file_name": chunk["file_name"], "first_chunk_id": first["chunk_id"],
+                      "last_chunk_id": last["chunk_id"], "text": new_text, "first": first, "last": last}
+            joined = [i for i in (before, after) if i is not None]
+            # The formatted passages and the separators between them are what goes into the prompt
+            num_passages = len(passages) + 1 - len(joined)
+            cost = (self._formatted_tokens(merged) - sum(self._formatted_tokens(passages[i]) for i in joined)
+                    + estimate_tokens(PASSAGE_SEPARATOR) * (max(num_passages - 1, 0) - max(len(passages) - 1, 0)))
+
+            # 3. Keep going with smaller chunks when this one does not fit in what is left of the budget
+            if num_tokens + cost > self.token_budget:
+                num_over_budget += 1
+                continue
+            num_tokens += cost
+            kept_words.append(words)
+            if not joined:
+                passages.append(merged)
+            else:
+                # The joined passage takes the place of the better ranked of the two
+                passages[min(joined)] = merged
+                if len(joined) == 2:
+                    del passages[max(joined)]
+
+        self.last_stats = {"chunks": len(chunks), "passages": len(passages), "tokens": num_tokens,
+                           "redundant": num_redundant, "over_budget": num_over_budget}
+        # The end chunks were only kept to stitch on more chunks
+        return [{key: value for key, value in passage.items() if key not in ("first", "last")}
+                for passage in passages]
+
+    def build(self, chunks: List[Dict], positions: Optional[ChunkPositionIndex] = None) -> str:
+        """Pack ranked chunks into the context text, one <source> element per passage
+
+        Args:
+            chunks (List[Dict]): retrieved chunks, best first
+            positions (ChunkPositionIndex, optional): position index to expand the chunks with. Defaults to None.
+
+        Returns:
+            str: the context
+        """
+        if positions is not None:
+            chunks = self.expand(chunks, positions)
+        return PASSAGE_SEPARATOR.join(self.format_passage(passage) for passage in self.pack(chunks))
+
+    @staticmethod
+    def format_passage(passage: Dict) -> str:
+        chunk_ids = (str(passage["first_chunk_id"]) if passage["first_chunk_id"] == passage["last_chunk_id"]
+                     else f"{passage['first_chunk_id']}-{passage['last_chunk_id']}")
+        return f"<source file=\"{passage['file_name']}\" chunks=\"{chunk_ids}\">\n{passage['text']}\n</source>"
+
+    def _is_redundant(self, words: set, kept_words: List[set]) -> bool:
+        if self.redundancy_threshold is None or not words:
+            return False
+        return any(len(words & kept) / len(words) >= self.redundancy_threshold for kept in kept_words)
+
+    @classmethod
+    def _formatted_tokens(cls, passage: Dict) -> int:
+        return estimate_tokens(cls.format_passage(passage))
+
+    @staticmethod
+    def _adjacent_passages(passages: List[Dict], chunk: Dict) -> Tuple[Optional[int], Optional[int]]:
+        # Positions of the passage that ends right before the chunk and of the one that starts right after it
+        before = after = None
+        for i, passage in enumerate(passages):
+            if passage["file_name"] != chunk["file_name"]:
+                continue
+            if passage["last_chunk_id"] == chunk["chunk_id"] - 1:
+                before = i
+            elif passage["first_chunk_id"] == chunk["chunk_id"] + 1:
+                after = i
+        return before, after
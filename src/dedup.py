@@ -0,0 +1,146 @@
+# Near-duplicate chunk detection (MinHash + LSH) between chunking and embedding
+import logging
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from config.config import DEDUP_THRESHOLD, MINHASH_PERMUTATIONS, MINHASH_BANDS, SHINGLE_SIZE
+from utils.text_processing import estimate_tokens, tokenize
+
+logger = logging.getLogger("rag")
+
+# Permutations are h(x) = (a * x + b) mod p on 31-bit shingle hashes, so a * x fits in 64 bits
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class ChunkDeduplicator:
+    """
+    Collapses near-duplicate chunks (boilerplate repeated across documents) onto one chunk.
+    Every chunk gets a MinHash signature of its word shingles, LSH buckets on bands of the
+    signature find candidate pairs, and a candidate is a duplicate when the estimated
+    Jaccard similarity of the two chunks is at least threshold.
+    """
+
+    def __init__(self,
+                 threshold: float = DEDUP_THRESHOLD,
+                 num_permutations: int = MINHASH_PERMUTATIONS,
+                 num_bands: int = MINHASH_BANDS,
+                 shingle_size: int = SHINGLE_SIZE,
+                 seed: int = 0):
+        if num_permutations % num_bands:
+            raise ValueError(f"num_permutations ({num_permutations}) must be a multiple of num_bands ({num_bands})")
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MERSENNE_PRIME, num_permutations, dtype=np.uint64)
+        self._b = rng.integers(0, MERSENNE_PRIME, num_permutations, dtype=np.uint64)
+        self.last_stats = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature of the word shingles of a text"""
+        words = tokenize(text)
+        shingles = {" ".join(words[i:i + self.shingle_size])
+                    for i in range(max(len(words) - self.shingle_size + 1, 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) & MERSENNE_PRIME for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        # (num_permutations, num_shingles) -> min over the shingles
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+    def deduplicate(self, chunks: Iterable[Dict]) -> List[Dict]:
+        """Keep the first chunk of every group of near-duplicates
+
+        Args:
+            chunks (Iterable[Dict]): chunks with "file_name", "chunk_id" and "chunk_content"
+
+        Returns:
+            List[Dict]: the kept chunks, in order. A kept chunk that stands in for others lists them
+            in "duplicate_sources" ([{"file_name": ..., "chunk_id": ...}, ...], with the
+            "start_char"/"end_char" offsets of the collapsed chunk when it has them).
+        """
+        duplicate_sources = {}
+        kept = list(self.iter_unique(chunks, duplicate_sources))
+        for position, sources in duplicate_sources.items():
+            kept[position]["duplicate_sources"] = sources
+        return kept
+
+    def iter_unique(self, chunks: Iterable[Dict], duplicate_sources: Dict[int, List[Dict]]) -> Iterator[Dict]:
+        """Yield the first chunk of every group of near-duplicates as soon as it is read
+
+        Only the signatures of the kept chunks are held, so any number of chunks can stream through.
+        A duplicate can turn up after its kept chunk was yielded, so the chunks it collapses are not
+        added to the kept chunk but to duplicate_sources.
+
+        Args:
+            chunks (Iterable[Dict]): chunks with "file_name", "chunk_id" and "chunk_content"
+            duplicate_sources (Dict[int, List[Dict]]): filled with the position of a kept chunk (among
+                the yielded ones) -> the chunks collapsed onto it, in the format of deduplicate
+
+        Yields:
+            Dict: the kept chunks, in order
+        """
+        signatures = []
+        buckets = {}
+        num_chunks = 0
+        tokens_saved = 0
+        self.last_stats = {}
+        for chunk in chunks:
+            num_chunks += 1
+            signature = self.signature(chunk["chunk_content"])
+            bands = [(band, signature_band.tobytes())
+                     for band, signature_band in enumerate(np.split(signature, self.num_bands))]
+
+            # 1. Find kept chunks that share a band with this one, and keep the most similar
+            candidates = {i for key in bands for i in buckets.get(key, ())}
+            best, best_similarity = None, self.threshold
+            for i in candidates:
+                similarity = float(np.mean(signatures[i] == signature))
+                if similarity >= best_similarity:
+                    best, best_similarity = i, similarity
+
+            # 2. Collapse it onto that chunk, or keep it as a new chunk
+            if best is not None:
+                source = {"file_name": chunk["file_name"], "chunk_id": chunk["chunk_id"]}
+                if "start_char" in chunk:
+                    source.update(start_char=chunk["start_char"], end_char=chunk["end_char"])
+                duplicate_sources.setdefault(best, []).append(source)
+                tokens_saved += estimate_tokens(chunk["chunk_content"])
+                continue
+            for key in bands:
+                buckets.setdefault(key, []).append(len(signatures))
+            signatures.append(signature)
+            yield chunk
+
+        self.last_stats = {"chunks": num_chunks,
+                           "kept": len(signatures),
+                           "duplicates": num_chunks - len(signatures),
+                           "tokens_saved": tokens_saved}
+
+
+def iter_unique_chunks(chunks: Iterable[Dict],
+                       duplicate_sources: Dict[int, List[Dict]],
+                       threshold: Optional[float] = DEDUP_THRESHOLD) -> Iterator[Dict]:
+    """Collapse near-duplicate chunks as they stream through and print how much it saved
+
+    Args:
+        chunks (Iterable[Dict]): chunks with "file_name", "chunk_id" and "chunk_content"
+        duplicate_sources (Dict[int, List[Dict]]): filled as in ChunkDeduplicator.iter_unique
+        threshold (float, optional): see ChunkDeduplicator, None keeps every chunk. Defaults to DEDUP_THRESHOLD.
+
+    Yields:
+        Dict: the kept chunks, in order
+    """
+    if threshold is None:
+        yield from chunks
+        return
+    deduplicator = ChunkDeduplicator(threshold)
+    yield from deduplicator.iter_unique(chunks, duplicate_sources)
+    _log_stats(deduplicator.last_stats)
+
+
+def _log_stats(stats: Dict) -> None:
+    if stats["chunks"]:
+        logger.info("Collapsed %d near-duplicate chunks (%.0f%% of %d), ~%d tokens not embedded or indexed",
+                    stats["duplicates"], 100 * stats["duplicates"] / stats["chunks"], stats["chunks"],
+                    stats["tokens_saved"])
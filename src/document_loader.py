@@ -1,52 +1,161 @@
 # Extract text from PDFs, Word docs, etc.
-from utils.file_utils import load_pdf, load_txt, load_docx
+from utils.file_utils import load_pdf, load_txt, load_docx, count_pdf_pages, load_pdf_pages
+from utils.file_utils import load_cached_text, save_cached_text
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 import json
-from config.config import DOCUMENTS_DIR
+import logging
+import time
+from config.config import DOCUMENTS_DIR, EXTRACTION_WORKERS, PDF_PAGES_PER_TASK, INGEST_FILES_PER_BATCH
+from config.logging_config import telemetry
+
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".docx")
+
+logger = logging.getLogger("rag")
+
+
+def _run_extraction_task(task: Tuple) -> Tuple[str, int, Optional[str], float]:
+    """Extract one task (a whole file, or a page range of a PDF) in a worker process
+
+    Returns:
+        Tuple[str, int, Optional[str], float]: file name, part number, text (None if the file could
+        not be read, e.g. a corrupt PDF) and seconds it took
+    """
+    file_name, file_path, part, page_range = task
+    start_time = time.perf_counter()
+    try:
+        if page_range is not None:
+            text = load_pdf_pages(file_path, *page_range)
+        else:
+            text = DocumentLoader().load_document(file_path)
+    except Exception:
+        # One unreadable file must not stop the others from being extracted
+        logger.warning("Could not extract '%s'", file_name, exc_info=True)
+        text = None
+    return file_name, part, text, time.perf_counter() - start_time
+
 
 class DocumentLoader():
-    def load_document(self, file_path: str) -> str:
-        """Load a single document and return text content"""
+    def __init__(self, workers: Optional[int] = EXTRACTION_WORKERS, pdf_pages_per_task: int = PDF_PAGES_PER_TASK):
+        self.workers = workers
+        self.pdf_pages_per_task = pdf_pages_per_task
+        # Seconds spent extracting each file in the last load_all_documents (0 if it came from the cache)
+        self.extraction_times = {}
+
 
-        if file_path.endswith(".pdf"):
+    def load_document(self, file_path: str) -> Optional[str]:
+        """Load a single document and return text content (None if its extension is not supported)"""
+        # Extensions are matched case-insensitively, like the ingest scan ("REPORT.PDF" is a PDF)
+        extension = Path(file_path).suffix.lower()
+
+        if extension == ".pdf":
             return load_pdf(file_path)
-        
-        elif file_path.endswith(".txt"):
+
+        elif extension == ".txt":
             return load_txt(file_path)
-        
-        elif file_path.endswith(".docx"):
+
+        elif extension == ".docx":
             return load_docx(file_path)
-    
-    
+
+
     def load_all_documents(self, file_names: List[str]) -> Dict[str, str]:
         """Load all documents from the documents directory
 
+        Unchanged documents come from the extracted text cache. The rest are extracted in
+        a process pool, with large PDFs split into page ranges.
+
         Args:
             file_names (List[str]): Name of all the files to be loaded
 
         Returns:
             Dict[str, str]: key of the file_name and value of the text corresponding to that file
+            (None for the files that could not be extracted)
         """
-        # We are assuming that there are no files in subdirectories of self.document_dir
-        document_dict = {}
-         
-        # Fill document_dict with all the text from each file in self.document_dir
-        for file_name in file_names:
-            file_path = str(Path(DOCUMENTS_DIR) / file_name)
-            document_dict[file_name] = self.load_document(file_path)
-            
+        with telemetry.span("load", files=len(file_names)) as span:
+            # We are assuming that there are no files in subdirectories of self.document_dir
+            document_dict = {}
+            self.extraction_times = {}
+
+            # Use the cached text of every file that has not changed since it was extracted
+            tasks = []
+            num_parts = {}
+            num_cached = 0
+            for file_name in file_names:
+                file_path = str(Path(DOCUMENTS_DIR) / file_name)
+                cached_text = load_cached_text(file_path)
+                if cached_text is not None:
+                    document_dict[file_name] = cached_text
+                    self.extraction_times[file_name] = 0.0
+                    num_cached += 1
+                    continue
+
+                # Split large PDFs into page ranges, every other file is one task
+                page_ranges = [None]
+                if Path(file_path).suffix.lower() == ".pdf":
+                    try:
+                        num_pages = count_pdf_pages(file_path)
+                    except Exception:
+                        logger.warning("Could not extract '%s'", file_name, exc_info=True)
+                        document_dict[file_name] = None
+                        self.extraction_times[file_name] = 0.0
+                        continue
+                    if num_pages > self.pdf_pages_per_task:
+                        page_ranges = [(start, min(start + self.pdf_pages_per_task, num_pages))
+                                       for start in range(0, num_pages, self.pdf_pages_per_task)]
+                num_parts[file_name] = len(page_ranges)
+                for part, page_range in enumerate(page_ranges):
+                    tasks.append((file_name, file_path, part, page_range))
+
+            # Fill document_dict with the text extracted from the remaining files
+            if len(tasks) > 1 and self.workers != 1:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    results = list(executor.map(_run_extraction_task, tasks))
+            else:
+                results = [_run_extraction_task(task) for task in tasks]
+
+            parts = {}
+            for file_name, part, text, seconds in results:
+                parts.setdefault(file_name, [None] * num_parts[file_name])[part] = text
+                self.extraction_times[file_name] = self.extraction_times.get(file_name, 0.0) + seconds
+            for file_name, file_parts in parts.items():
+                # A file is only extracted if every one of its parts was
+                text = None if None in file_parts else "\n".join(file_parts)
+                document_dict[file_name] = text
+                if text is not None:
+                    save_cached_text(str(Path(DOCUMENTS_DIR) / file_name), text)
+                logger.debug("Extracted '%s' in %.2fs", file_name, self.extraction_times[file_name])
+            num_failed = sum(text is None for text in document_dict.values())
+            span.update(extracted=len(parts), cached=num_cached, failed=num_failed)
+            telemetry.increment("documents_extracted", len(parts))
+            telemetry.increment("extraction_cache_hits", num_cached)
+            telemetry.increment("extraction_failures", num_failed)
+
         # Return document_dict
-        return document_dict
-    
-    
+        return {file_name: document_dict[file_name] for file_name in file_names}
+
+
+    def iter_documents(self,
+                       file_names: List[str],
+                       files_per_batch: int = INGEST_FILES_PER_BATCH) -> Iterator[Tuple[str, Optional[str]]]:
+        """Load documents files_per_batch at a time, so only the text of one batch is held in memory
+
+        Args:
+            file_names (List[str]): Name of all the files to be loaded
+            files_per_batch (int, optional): files extracted together. Defaults to INGEST_FILES_PER_BATCH.
+
+        Yields:
+            Tuple[str, Optional[str]]: the name and text of every file, in order (None if it could not be extracted)
+        """
+        for start in range(0, len(file_names), files_per_batch):
+            yield from self.load_all_documents(file_names[start:start + files_per_batch]).items()
+
+
 def main():
-    loader = DocumentLoader("documents")
+    loader = DocumentLoader()
     # print(json.dumps(loader.load_all_documents(), indent=4))
     print(json.dumps(loader.load_document("CSC_226_Course_Syllabus.txt")))
 
 
 if __name__ == "__main__":
     main()
-    
-    
\ No newline at end of file
@@ -0,0 +1,185 @@
+# Pack texts into batches and embed them concurrently under the API rate limits
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from config.config import (EMBEDDING_MODEL, EMBEDDING_MAX_BATCH_ITEMS, EMBEDDING_MAX_BATCH_TOKENS,
+                           EMBEDDING_TOKENS_PER_MINUTE, EMBEDDING_REQUESTS_PER_MINUTE,
+                           EMBEDDING_MAX_CONCURRENCY, EMBEDDING_MAX_RETRIES)
+from config.logging_config import telemetry
+from utils.text_processing import estimate_tokens
+
+logger = logging.getLogger("rag")
+
+
+class RateLimiter:
+    """
+    Sliding window limiter for tokens per window and requests per window, shared between threads
+    """
+
+    def __init__(self,
+                 tokens_per_window: int,
+                 requests_per_window: int,
+                 window_seconds: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.tokens_per_window = tokens_per_window
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._events = deque()  # (timestamp, tokens) of every request in the current window
+        self._tokens_in_window = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, tokens: int) -> None:
+        """Block until a request of `tokens` tokens fits in the budget, then reserve it"""
+        with self._condition:
+            while True:
+                now = self._clock()
+                while self._events and self._events[0][0] <= now - self.window_seconds:
+                    self._tokens_in_window -= self._events.popleft()[1]
+
+                # An empty window always admits one request, even one bigger than the token budget
+                fits = (len(self._events) < self.requests_per_window
+                        and self._tokens_in_window + tokens <= self.tokens_per_window)
+                if fits or not self._events:
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+
+                # Wait for the oldest request to leave the window
+                self._condition.wait(timeout=self._events[0][0] + self.window_seconds - now)
+
+
+class EmbeddingScheduler:
+    """
+    Embeds a list of texts with as few requests as the model's limits allow, running
+    several requests at once while staying under the tokens/requests per minute budget
+    """
+
+    def __init__(self,
+                 voyageai_client,
+                 model: str = EMBEDDING_MODEL,
+                 max_batch_items: int = EMBEDDING_MAX_BATCH_ITEMS,
+                 max_batch_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+                 tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+                 requests_per_minute: int = EMBEDDING_REQUESTS_PER_MINUTE,
+                 max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+                 max_retries: int = EMBEDDING_MAX_RETRIES,
+                 window_seconds: float = 60.0,
+                 initial_backoff: float = 1.0,
+                 progress: Optional[Callable[[Dict], None]] = None):
+        self._client = voyageai_client
+        self.model = model
+        self.max_batch_items = max_batch_items
+        # A batch can never use more tokens than a whole window's budget
+        self.max_batch_tokens = min(max_batch_tokens, tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.rate_limiter = RateLimiter(tokens_per_minute, requests_per_minute, window_seconds)
+        self._progress = progress or self._log_progress
+        self._lock = threading.Lock()
+        self.last_run_stats = {}
+
+    def pack_batches(self, texts: List[str]) -> List[List[int]]:
+        """Greedily group text indices into batches under the per-request item and token limits
+
+        Args:
+            texts (List[str]): texts to embed
+
+        Returns:
+            List[List[int]]: the indices of the texts in each batch, in order
+        """
+        batches = []
+        current_batch = []
+        current_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if current_batch and (len(current_batch) >= self.max_batch_items
+                                  or current_tokens + tokens > self.max_batch_tokens):
+                batches.append(current_batch)
+                current_batch = []
+                current_tokens = 0
+            current_batch.append(i)
+            current_tokens += tokens
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    def embed(self, texts: List[str], input_type: str = "query") -> List[List[float]]:
+        """Embed every text, returning the embeddings in the same order as the texts
+
+        Args:
+            texts (List[str]): texts to embed
+            input_type (str, optional): Voyage input type. Defaults to "query".
+
+        Returns:
+            List[List[float]]: one embedding per text
+        """
+        embeddings = [None] * len(texts)
+        batches = self.pack_batches(texts)
+        stats = {"chunks": len(texts), "chunks_done": 0, "batches": len(batches),
+                 "tokens": 0, "retries": 0, "start_time": time.monotonic()}
+        self.last_run_stats = stats
+        if not batches:
+            return embeddings
+
+        def run_batch(batch: List[int]) -> None:
+            batch_texts = [texts[i] for i in batch]
+            result = self._embed_with_retries(batch_texts, input_type, stats)
+            for i, embedding in zip(batch, result.embeddings):
+                embeddings[i] = embedding
+            telemetry.increment("embedding_tokens", getattr(result, "total_tokens", 0) or 0)
+            with self._lock:
+                stats["chunks_done"] += len(batch)
+                stats["tokens"] += getattr(result, "total_tokens", 0) or 0
+                self._progress(self._snapshot(stats))
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            # list() re-raises the first exception of any batch
+            list(executor.map(run_batch, batches))
+
+        stats.update(self._snapshot(stats))
+        return embeddings
+
+    def _embed_with_retries(self, batch_texts: List[str], input_type: str, stats: Dict):
+        estimated_tokens = sum(estimate_tokens(text) for text in batch_texts)
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            telemetry.increment("embedding_api_calls")
+            try:
+                return self._client.embed(batch_texts, self.model, input_type=input_type)
+            # Only back off when the API actually tells us we are throttled (voyageai is only
+            # imported once a batch has failed, embedding never imports it on its own)
+            except Exception as e:
+                from voyageai.error import RateLimitError
+                if not isinstance(e, RateLimitError) or attempt == self.max_retries:
+                    raise
+                telemetry.increment("embedding_retries")
+                with self._lock:
+                    stats["retries"] += 1
+                time.sleep(backoff * (1 + random.random()))
+                backoff *= 2
+
+    def _snapshot(self, stats: Dict) -> Dict:
+        elapsed = max(time.monotonic() - stats["start_time"], 1e-9)
+        return {
+            "chunks": stats["chunks"],
+            "chunks_done": stats["chunks_done"],
+            "batches": stats["batches"],
+            "tokens": stats["tokens"],
+            "retries": stats["retries"],
+            "elapsed_seconds": elapsed,
+            "chunks_per_second": stats["chunks_done"] / elapsed,
+            "tokens_per_second": stats["tokens"] / elapsed
+        }
+
+    @staticmethod
+    def _log_progress(progress: Dict) -> None:
+        logger.info("Embedded %d/%d chunks (%.1f chunks/s, %.0f tokens/s)", progress["chunks_done"],
+                    progress["chunks"], progress["chunks_per_second"], progress["tokens_per_second"])
@@ -1,20 +1,46 @@
 # Generate and store embeddings, cosine similarity
 from dotenv import load_dotenv
-import voyageai
-from sklearn.metrics.pairwise import cosine_similarity
-from config.config import ANTHROPIC_API_KEY, VOYAGE_API_KEY, EMBEDDING_MODEL, CLAUDE_MODEL, EMBEDDINGS_DIR, TOP_K_RESULTS
-from typing import List, Dict
+from config.config import ANTHROPIC_API_KEY, VOYAGE_API_KEY, EMBEDDING_MODEL, CLAUDE_MODEL, EMBEDDINGS_DIR, TOP_K_RESULTS, DENSE_INDEX, QUANTIZATION, RERANK_CANDIDATES, COARSE_DIMENSIONS, COARSE_CANDIDATES, EMBED_BATCH_CHUNKS
+from typing import Iterable, List, Dict, Optional, Tuple
 from pathlib import Path
+from itertools import islice
 from utils import file_utils
+from utils.vector_utils import normalize_rows, exact_search, rerank
 import numpy as np
 import time
 import json
-from src.embeddings_io import EmbeddingsIO
+from src.embeddings_io import EmbeddingsIO, StoreWriter
+from src.embedding_scheduler import EmbeddingScheduler
+from src.ann_index import IVFIndex, chunk_fingerprint
+from src.quantization import QuantizedIndex
+from src.query_embedding_cache import QueryEmbeddingCache
+from config.logging_config import telemetry
+import logging
+
+logger = logging.getLogger("rag")
 
 
 class EmbeddingSystem():
-    def __init__(self):
-        self._voyageai_client = voyageai.Client()
+    def __init__(self, voyageai_client=None, query_cache: Optional[QueryEmbeddingCache] = None):
+        if voyageai_client is None:
+            # voyageai is slow to import, so it is only imported when a real client is needed
+            import voyageai
+            voyageai_client = voyageai.Client()
+        self._voyageai_client = voyageai_client
+        self.scheduler = EmbeddingScheduler(self._voyageai_client)
+        # Embeddings of queries seen before, so repeated queries skip the embed call
+        self.query_cache = query_cache if query_cache is not None else QueryEmbeddingCache()
+        # Resident search state: the chunks and their L2-normalized float32 embedding matrix
+        self._indexed_chunks = None
+        self._num_indexed = 0
+        self._normalized_matrix = None
+        # Approximate nearest-neighbour index over the matrix (None scans every chunk)
+        self.ann_index = IVFIndex() if DENSE_INDEX == "ivf" else None
+        # Compressed codes that replace the float32 matrix (None keeps the matrix)
+        self.quantized_index = QuantizedIndex(QUANTIZATION, RERANK_CANDIDATES) if QUANTIZATION else None
+        # Two-stage search: the resident matrix only holds the first coarse_dimensions (None for all)
+        self.coarse_dimensions = COARSE_DIMENSIONS
+        self.coarse_candidates = COARSE_CANDIDATES
     
     
     def get_embedding(self, text: str) -> List[float]:
@@ -28,101 +54,350 @@ class EmbeddingSystem():
             List[float]: list of all the embeddings
         """
         
-        result = self._voyageai_client.embed(text, EMBEDDING_MODEL, input_type="query")
-        return result.embeddings[0]
+        return self.get_embeddings([text])[0]
+    
+    
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Get embeddings for many queries with one API call
+
+        Args:
+            texts (List[str]): texts that embeddings will be created for
+
+        Returns:
+            List[List[float]]: one embedding per text, in the same order
+        """
+        texts = list(texts)
+        embeddings = self.query_cache.get_many(texts, EMBEDDING_MODEL, "query")
+        # Only the texts missing from the cache are embedded (once each, in one call)
+        missing = list(dict.fromkeys(text for text in texts if text not in embeddings))
+        telemetry.increment("query_embedding_cache_hits", len(texts) - len(missing))
+        if missing:
+            telemetry.increment("query_embedding_cache_misses", len(missing))
+            telemetry.increment("embedding_api_calls")
+            result = self._voyageai_client.embed(missing, EMBEDDING_MODEL, input_type="query")
+            telemetry.increment("embedding_tokens", getattr(result, "total_tokens", 0) or 0)
+            new_embeddings = dict(zip(missing, result.embeddings))
+            self.query_cache.put_many(new_embeddings, EMBEDDING_MODEL, "query")
+            embeddings.update(new_embeddings)
+        return [embeddings[text] for text in texts]
     
         
-    def embed_chunks(self, chunks: List[Dict]) -> List[Dict]:
+    def embed_chunks(self,
+                     chunks: Iterable[Dict],
+                     index: bool = True,
+                     replaced_files: Iterable[str] = (),
+                     duplicate_sources: Optional[Dict[int, List[Dict]]] = None,
+                     batch_size: int = EMBED_BATCH_CHUNKS) -> List[Dict]:
         """Generate embeddings for chunks of text from one or more files
 
+        The chunks are read, embedded and appended to the store batch_size at a time, so they can
+        stream in (e.g. from ChunkRecords through iter_unique_chunks) without being held in memory
+
         Args:
-            chunks (List[Dict]): a list of chunks of text with metadata
+            chunks (Iterable[Dict]): chunks of text with metadata (a list, or lazily read
+                chunks such as ChunkRecords)
+            index (bool, optional): make these chunks the searched ones. Pass False when they are
+                only part of the corpus and index_chunks is called with all of it afterwards.
+            replaced_files (Iterable[str], optional): files whose stored chunks are dropped even if
+                none of the chunks belongs to them (e.g. deleted files). Defaults to none.
+            duplicate_sources (Dict[int, List[Dict]], optional): filled by iter_unique_chunks while the
+                chunks stream in, stored with the chunks once they are all embedded
+            batch_size (int, optional): chunks embedded and appended to the store at a time.
+                Defaults to EMBED_BATCH_CHUNKS.
 
         Returns:
-            List[Dict]: list of all the chunks with now the embedding of that chunk
+            List[Dict]: the stored chunks of the files of these chunks, "chunk_embeddings" is a read
+            only view into the memory-mapped matrix
         """
-        BATCH_SIZE = 1
+        with telemetry.span("embed") as span, telemetry.profile("embed_chunks"):
+            input_type = "query"
+            # Every stored vector is keyed by a hash of (chunk text, model, input_type)
+            writer = StoreWriter(replaced_files)
+            file_names = set()
+            num_chunks = 0
+            num_reused = 0
+            num_embedded = 0
+            chunks = iter(chunks)
+            while True:
+                batch = list(islice(chunks, batch_size))
+                if not batch:
+                    break
+
+                # Reuse the stored vector of every chunk whose hash we have seen before, and collect
+                # the distinct new texts. We will embed these.
+                texts_to_embed = {}
+                for chunk in batch:
+                    chunk["content_hash"] = EmbeddingsIO.content_hash(chunk["chunk_content"], EMBEDDING_MODEL, input_type)
+                    file_names.add(chunk["file_name"])
+                    if writer.stored_row(chunk["content_hash"]) is None:
+                        texts_to_embed.setdefault(chunk["content_hash"], chunk["chunk_content"])
+                    else:
+                        num_reused += 1
+
+                # Embed the chunks that need to be embedded, packed into as few batches as
+                # the model allows and sent concurrently under the rate limits
+                embedding_results = self.scheduler.embed(list(texts_to_embed.values()), input_type=input_type)
+                new_embeddings = dict(zip(texts_to_embed, embedding_results))
+                for chunk in batch:
+                    if chunk["content_hash"] in new_embeddings:
+                        chunk["chunk_embeddings"] = new_embeddings[chunk["content_hash"]]
+
+                # Append the new vectors to the store, nothing of the batch is kept after this
+                writer.add(batch)
+                num_chunks += len(batch)
+                num_embedded += len(texts_to_embed)
+            logger.info("Reused %d cached embeddings, embedded %d new chunks", num_reused, num_embedded)
+            span.update(chunks=num_chunks, reused=num_reused, embedded=num_embedded)
+            telemetry.increment("embedding_cache_hits", num_reused)
+
+            # Replace the stored chunks of these files (vectors nobody references anymore are
+            # garbage-collected), unless nothing about them changed
+            writer.close(duplicate_sources)
+            # Point the chunks at the memory-mapped matrix
+            embedded_chunks = EmbeddingsIO.load_files_embeddings(file_names)
         
-        # Get a list of all file_names saved in the embeddings
-        embeddings_list_of_files = [str(file.name) for file in Path(EMBEDDINGS_DIR).glob("*")]
-        print(embeddings_list_of_files)
-        # Iterate through all the chunks. 
-        file_embeddings_to_import = set()
-        chunks_to_embed = []
-        chunks_content = []
-        for chunk in chunks:
-            # If the file the chunk is from IS NOT in the embeddings_list_of_files, 
-            # then add that to chunks_content. We will embed these.
-            if chunk["file_name"] + ".json" not in embeddings_list_of_files:
-                chunks_to_embed.append(chunk)
-                chunks_content.append(chunk["chunk_content"])
-            # If the file IS in the embeddings_list_of_files then add it to the
-            # set `file_embeddings_to_import`
+            # Build the resident search matrix once, here, instead of on every query
+            if index:
+                self.index_chunks(embedded_chunks)
+        return embedded_chunks
+    
+    
+    def index_chunks(self, embedded_chunks: List[Dict]) -> None:
+        """(Re)build the L2-normalized float32 matrix that similarity search scores against
+
+        Call this whenever the list of embedded chunks changes
+
+        Args:
+            embedded_chunks (List[Dict]): chunks that each have a "chunk_embeddings" vector
+        """
+        with telemetry.span("index", chunks=len(embedded_chunks)):
+            self._indexed_chunks = embedded_chunks
+            self._num_indexed = len(embedded_chunks)
+            if not embedded_chunks:
+                self._normalized_matrix = np.empty((0, 0), dtype=np.float32)
+                return
+            if self.quantized_index is not None:
+                # Only the codes stay in RAM, full vectors are read from the memory-mapped store
+                self._normalized_matrix = None
+                self._update_quantized_index(embedded_chunks)
+                return
+            if self.coarse_dimensions:
+                # The coarse pass scores this matrix, full vectors are only read to re-rank candidates
+                self._normalized_matrix = self._coarse_matrix(embedded_chunks)
             else:
-                # Keep track of files that already exist
-                file_embeddings_to_import.add(chunk["file_name"])
-
-        # Embed the chunks that need to be embedded, in batches.
-        embedding_results = []
-        for i in range(0, len(chunks_to_embed), BATCH_SIZE):
-            input_chunks = chunks_content[i:i+BATCH_SIZE]
-            print(f"Embedding up to chunk {i+len(input_chunks)}/{len(chunks_content)}")
-            
-            # Make the API call for the list of chunks
-            result = self._voyageai_client.embed(input_chunks, EMBEDDING_MODEL, input_type="query")
-            embedding_results.extend(result.embeddings)
-            
-            # Pause for 60 seconds to reset TPM
-            if i + BATCH_SIZE < len(chunks_content):
-                print("Sleeping for 60 seconds to reset tokens and embed new batch...")
-                time.sleep(60)
+                self._normalized_matrix = normalize_rows([chunk["chunk_embeddings"] for chunk in embedded_chunks])
+            self._update_ann_index(embedded_chunks)
+    
+    
+    def restore_index(self,
+                      embedded_chunks: List[Dict],
+                      normalized_matrix: Optional[np.ndarray],
+                      ann_index: Optional[IVFIndex] = None,
+                      quantized_index: Optional[QuantizedIndex] = None) -> None:
+        """Adopt a search state that index_chunks built earlier (src/snapshot.py) instead of rebuilding it
+
+        Args:
+            embedded_chunks (List[Dict]): the indexed chunks, in the order of the matrix rows
+            normalized_matrix (np.ndarray, optional): the matrix index_chunks built for them
+            ann_index (IVFIndex, optional): the ANN index built over normalized_matrix
+            quantized_index (QuantizedIndex, optional): the codes built for the chunks
+        """
+        self._indexed_chunks = embedded_chunks
+        self._num_indexed = len(embedded_chunks)
+        self._normalized_matrix = normalized_matrix
+        if self.ann_index is not None and ann_index is not None:
+            ann_index.nprobe = self.ann_index.nprobe
+            self.ann_index = ann_index
+        if self.quantized_index is not None and quantized_index is not None:
+            self.quantized_index = quantized_index
+    
+    
+    def _coarse_matrix(self, embedded_chunks: List[Dict]) -> np.ndarray:
+        # Gather the rows of the coarse matrix stored alongside the full one, or (for chunks
+        # that are not in the store) truncate and re-normalize their full vectors
+        if all("row" in chunk for chunk in embedded_chunks):
+            coarse_matrix = EmbeddingsIO.load_coarse_matrix(self.coarse_dimensions)
+            rows = np.array([chunk["row"] for chunk in embedded_chunks])
+            if coarse_matrix is not None and rows.max() < coarse_matrix.shape[0]:
+                return np.asarray(coarse_matrix[rows], dtype=np.float32)
+        return normalize_rows([chunk["chunk_embeddings"][:self.coarse_dimensions] for chunk in embedded_chunks])
+    
+    
+    def _update_quantized_index(self, embedded_chunks: List[Dict]) -> None:
+        # Reuse the codes saved in INDEXES_DIR when they were built for these chunks
+        fingerprint = chunk_fingerprint(embedded_chunks)
+        if self.quantized_index.fingerprint == fingerprint:
+            return
+        saved_index = QuantizedIndex.load(num_candidates=self.quantized_index.num_candidates)
+        if (saved_index is not None and saved_index.fingerprint == fingerprint
+                and saved_index.quantizer.kind == self.quantized_index.quantizer.kind):
+            self.quantized_index = saved_index
+            return
+        self.quantized_index.build(normalize_rows([chunk["chunk_embeddings"] for chunk in embedded_chunks]),
+                                   fingerprint)
+        self.quantized_index.save()
+    
+    
+    def _full_vectors(self, rows: np.ndarray) -> np.ndarray:
+        # Normalized full precision vectors of some indexed chunks (memory-mapped rows of the store)
+        return normalize_rows([self._indexed_chunks[row]["chunk_embeddings"] for row in rows])
+    
+    
+    def _ann_fingerprint(self, embedded_chunks: List[Dict]) -> str:
+        # The ANN index depends on the chunks and on how many dimensions the matrix keeps
+        return f"{chunk_fingerprint(embedded_chunks)}:{self.coarse_dimensions or 'full'}"
+    
+    
+    def _update_ann_index(self, embedded_chunks: List[Dict]) -> None:
+        # Reuse the IVF index saved in INDEXES_DIR when it was built for these chunks, insert
+        # into it when the chunks only grew at the end, and otherwise build a new one
+        if self.ann_index is None:
+            return
+        num_rows = len(embedded_chunks)
+        fingerprint = self._ann_fingerprint(embedded_chunks)
+        if self.ann_index.fingerprint == fingerprint:
+            return
+        if num_rows < self.ann_index.exact_threshold:
+            self.ann_index.build(self._normalized_matrix, fingerprint)
+            return
+        
+        saved_index = IVFIndex.load()
+        if saved_index is not None and saved_index.is_trained:
+            saved_index.nprobe = self.ann_index.nprobe
+            if saved_index.fingerprint == fingerprint:
+                self.ann_index = saved_index
+                return
+            if (saved_index.num_rows < num_rows 
+                    and saved_index.fingerprint == self._ann_fingerprint(embedded_chunks[:saved_index.num_rows])):
+                saved_index.add(self._normalized_matrix, fingerprint)
+                self.ann_index = saved_index
+                self.ann_index.save()
+                return
+        
+        self.ann_index.build(self._normalized_matrix, fingerprint)
+        self.ann_index.save()
+    
+    
+    def ensure_index(self, embedded_chunks: Optional[List[Dict]]) -> List[Dict]:
+        """Make sure the search matrix is built from these chunks (None means the current ones)"""
+        # Rebuild the matrix only if we were handed a different (or resized) list of chunks
+        if embedded_chunks is None:
+            embedded_chunks = self._indexed_chunks
+        if embedded_chunks is None:
+            raise ValueError("No embedded chunks to search, call embed_chunks or index_chunks first")
+        if embedded_chunks is not self._indexed_chunks or len(embedded_chunks) != self._num_indexed:
+            self.index_chunks(embedded_chunks)
+        return embedded_chunks
+    
+    
+    def _search_vectors(self,
+                        query_embeddings,
+                        top_k: int,
+                        row_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Score query vectors against the resident matrix
+
+        Args:
+            row_mask (np.ndarray, optional): bool per indexed chunk, only the True rows can be returned
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (num_queries, top_k) row indices and their cosine similarities
+        """
+        queries = normalize_rows(np.atleast_2d(query_embeddings))
+        if self.quantized_index is not None and self._num_indexed:
+            telemetry.increment("chunks_scanned", len(queries) * self._num_indexed)
+            return self.quantized_index.search(self._full_vectors, queries, top_k, row_mask)
         
-        # Add a key value pair to each index of chunks_to_embed that 
-        # contains that chunk's embeddings
-        for chunk, embedding in zip(chunks_to_embed, embedding_results):
-            chunk["chunk_embeddings"] = embedding
-           
-        # Save the embedded chunks to a file with the file they belong to
-        unique_files = {chunk["file_name"] for chunk in chunks_to_embed}
-        j = 0
-        for file_name in unique_files:
-            file_chunks_to_save = []
-            while j < len(chunks_to_embed) and chunks_to_embed[j]["file_name"] == file_name:
-                file_chunks_to_save.append(chunks_to_embed[j])
-                j += 1
-            EmbeddingsIO.save_embeddings(file_chunks_to_save, file_name)
-                    
-        # Import any files that already have their embeddings in the embeddings dir
-        for file_name in file_embeddings_to_import:
-            chunks.extend(EmbeddingsIO.load_embeddings(file_name))
-            
-        return chunks
+        search_queries, num_candidates = queries, top_k
+        if self.coarse_dimensions:
+            # Coarse pass over the re-normalized prefixes, then re-rank with the full vectors
+            search_queries = normalize_rows(queries[:, :self.coarse_dimensions])
+            num_candidates = max(top_k, self.coarse_candidates)
+        if self.ann_index is not None:
+            idxs, scores = self.ann_index.search(self._normalized_matrix, search_queries, num_candidates,
+                                                 row_mask=row_mask)
+        else:
+            telemetry.increment("chunks_scanned", len(search_queries) * self._normalized_matrix.shape[0])
+            idxs, scores = exact_search(self._normalized_matrix, search_queries, num_candidates, row_mask)
+        if self.coarse_dimensions:
+            return rerank(idxs, queries, self._full_vectors, top_k)
+        return idxs, scores
     
         
     def similarity_search(self, 
                           query: str, 
-                          embedded_chunks: List[Dict], 
+                          embedded_chunks: Optional[List[Dict]] = None, 
                           top_k: int = TOP_K_RESULTS) -> List[Dict]:
         """Find the most similar chunks of text to a query using cosine similarity
 
         Args:
-            query (str): _description_
-            embedded_chunks (List[Dict]): _description_
-            top_k (int, optional): _description_. Defaults to TOP_K_RESULTS.
+            query (str): the user query
+            embedded_chunks (List[Dict], optional): chunks to search. Defaults to the indexed chunks.
+            top_k (int, optional): number of chunks to return. Defaults to TOP_K_RESULTS.
+
+        Returns:
+            List[Dict]: the top_k most similar chunks, most similar first
+        """
+        return self.similarity_search_many([query], embedded_chunks, top_k)[0]
+    
+    
+    def similarity_search_many(self,
+                               queries: List[str],
+                               embedded_chunks: Optional[List[Dict]] = None,
+                               top_k: int = TOP_K_RESULTS,
+                               query_embeddings: Optional[List[List[float]]] = None,
+                               row_mask: Optional[np.ndarray] = None) -> List[List[Dict]]:
+        """Find the most similar chunks for many queries with one embed call and one matrix product
+
+        Args:
+            queries (List[str]): the user queries
+            embedded_chunks (List[Dict], optional): chunks to search. Defaults to the indexed chunks.
+            top_k (int, optional): number of chunks to return per query. Defaults to TOP_K_RESULTS.
+            query_embeddings (List[List[float]], optional): embeddings of the queries. Defaults to
+                embedding the queries here.
+            row_mask (np.ndarray, optional): bool per chunk (e.g. MetadataIndex.mask), only the chunks
+                that are True are searched. Defaults to searching every chunk.
+
+        Returns:
+            List[List[Dict]]: the top_k most similar chunks for each query, most similar first
+        """
+        results = self.similarity_search_many_with_scores(queries, embedded_chunks, top_k, query_embeddings,
+                                                          row_mask)
+        return [[chunk for chunk, _ in query_results] for query_results in results]
+    
+    
+    def similarity_search_many_with_scores(self,
+                                           queries: List[str],
+                                           embedded_chunks: Optional[List[Dict]] = None,
+                                           top_k: int = TOP_K_RESULTS,
+                                           query_embeddings: Optional[List[List[float]]] = None,
+                                           row_mask: Optional[np.ndarray] = None) -> List[List[Tuple[Dict, float]]]:
+        """Same as similarity_search_many, but every chunk comes with its cosine similarity
+
+        Args:
+            query_embeddings (List[List[float]], optional): embeddings of the queries, if the caller
+                already has them. Defaults to embedding the queries here.
+            row_mask (np.ndarray, optional): bool per chunk, only the chunks that are True are searched
 
         Returns:
-            List[Dict]: _description_
+            List[List[Tuple[Dict, float]]]: (chunk, cosine similarity) pairs for each query, most similar first
         """
-        # 1. Get query embedding
-        query_embedding = self.get_embedding(query)
+        embedded_chunks = self.ensure_index(embedded_chunks)
+        if not queries:
+            return []
+        if row_mask is not None and len(row_mask) != len(embedded_chunks):
+            raise ValueError(f"row_mask has {len(row_mask)} rows but {len(embedded_chunks)} chunks are indexed")
         
-        # 2. Calculate cosine similarity with all chunk embeddings
-        chunk_embeddings = np.array([chunk["chunk_embeddings"] for chunk in embedded_chunks])
-        cosine_similarity_with_chunks = cosine_similarity([query_embedding], chunk_embeddings)[0]
+        # 1. Get the query embeddings
+        if query_embeddings is None:
+            query_embeddings = self.get_embeddings(queries)
         
+        # 2. Cosine similarity is a dot product against the pre-normalized matrix
         # 3. Return top_k most similar chunks with all meta data
-        top_k_similarity_scores_idxs = np.argsort(cosine_similarity_with_chunks)[::-1][:top_k]   
-        return [embedded_chunks[i] for i in top_k_similarity_scores_idxs]
+        with telemetry.span("dense_search", queries=len(queries)), telemetry.profile("similarity_search"):
+            idxs, scores = self._search_vectors(query_embeddings, top_k, row_mask)
+        # (an approximate index marks missing results with row -1)
+        return [[(embedded_chunks[i], float(score)) for i, score in zip(idx_row, score_row) if i >= 0]
+                for idx_row, score_row in zip(idxs, scores)]
 
         
 
@@ -1,32 +1,437 @@
 from utils import file_utils
 from pathlib import Path
-from config.config import EMBEDDINGS_DIR
-from typing import List, Dict
+from config.config import EMBEDDINGS_DIR, EMBEDDING_STORE_DTYPE, EMBEDDING_MODEL, COARSE_DIMENSIONS
+from typing import Dict, Iterable, List, Optional, Tuple
+from utils.vector_utils import normalize_rows
+import numpy as np
+import hashlib
+import io
+import logging
+import os
+
+logger = logging.getLogger("rag")
+
+# The embedding store is one contiguous matrix (one row per vector) plus a sidecar
+# holding the metadata of every chunk and the row its vector lives in
+MATRIX_FILE = "embeddings.npy"
+METADATA_FILE = "embeddings_meta.json"
+# Re-normalized prefixes of the rows, for the coarse pass of two-stage search
+COARSE_MATRIX_FILE = "embeddings_coarse.npy"
+# Old per-file JSON embeddings are moved here once they have been migrated
+LEGACY_DIR = "legacy_json"
+
 
 class EmbeddingsIO:
+    @staticmethod
+    def load_store() -> Tuple[Optional[np.ndarray], List[Dict]]:
+        """Open the embedding matrix (memory-mapped, read only) and the chunk metadata
+
+        Returns:
+            Tuple[Optional[np.ndarray], List[Dict]]: the matrix (None if nothing is stored yet)
+            and a list of chunk records, each with a "row" into the matrix
+        """
+        # Move any old per-file JSON embeddings into the store first
+        EmbeddingsIO.migrate_json_embeddings()
+
+        matrix_path = Path(EMBEDDINGS_DIR) / MATRIX_FILE
+        metadata_path = Path(EMBEDDINGS_DIR) / METADATA_FILE
+        if not matrix_path.exists() or not metadata_path.exists():
+            return None, []
+
+        metadata = file_utils.load_json(str(metadata_path))
+        matrix = np.load(str(matrix_path), mmap_mode="r")
+        return matrix, metadata["chunks"]
+
+
+    @staticmethod
+    def save_store(matrix: np.ndarray, records: List[Dict]) -> None:
+        """Write the embedding matrix and chunk metadata, replacing what is on disk
+
+        Args:
+            matrix (np.ndarray): 2D array with one embedding per row
+            records (List[Dict]): chunk metadata, every record's "row" must index into matrix
+        """
+        file_utils.ensure_directory_exists(EMBEDDINGS_DIR)
+        tmp_matrix_path = Path(EMBEDDINGS_DIR) / (MATRIX_FILE + ".tmp")
+        with open(tmp_matrix_path, "wb") as f:
+            np.save(f, matrix)
+        EmbeddingsIO._commit_store(records, tmp_matrix_path)
+
+
+    @staticmethod
+    def _commit_store(records: List[Dict], tmp_matrix_path: Optional[Path] = None) -> None:
+        # Write the metadata of records and swap it in, together with the matrix written to
+        # tmp_matrix_path (None when the matrix in place already holds every row)
+        matrix_path = Path(EMBEDDINGS_DIR) / MATRIX_FILE
+        metadata_path = Path(EMBEDDINGS_DIR) / METADATA_FILE
+        matrix = np.load(str(tmp_matrix_path or matrix_path), mmap_mode="r")
+
+        # Group the records by file so every file owns one contiguous range of records
+        records_by_file = {}
+        for record in records:
+            records_by_file.setdefault(record["file_name"], []).append(record)
+        ordered_records = []
+        files = {}
+        for file_name, file_records in records_by_file.items():
+            files[file_name] = [len(ordered_records), len(ordered_records) + len(file_records)]
+            ordered_records.extend(file_records)
+
+        coarse_dim = COARSE_DIMENSIONS if COARSE_DIMENSIONS and COARSE_DIMENSIONS < matrix.shape[1] else None
+        metadata = {
+            "dtype": str(matrix.dtype),
+            "shape": list(matrix.shape),
+            "coarse_dim": coarse_dim,
+            "files": files,
+            "chunks": ordered_records
+        }
+
+        # Write to temporary files and swap them in so a crash never leaves half a store
+        if coarse_dim:
+            EmbeddingsIO._save_coarse_matrix(matrix, coarse_dim)
+        del matrix
+        tmp_metadata_path = EmbeddingsIO._write_tmp_metadata(metadata)
+        if tmp_matrix_path is not None:
+            os.replace(tmp_matrix_path, matrix_path)
+        os.replace(tmp_metadata_path, metadata_path)
+
+
+    @staticmethod
+    def _write_tmp_metadata(metadata: Dict) -> Path:
+        # Write the sidecar next to the real one, the caller swaps it in with os.replace
+        tmp_metadata_path = Path(EMBEDDINGS_DIR) / (METADATA_FILE + ".tmp")
+        file_utils.save_json(metadata, str(tmp_metadata_path), indent=None)
+        return tmp_metadata_path
+
+
+    @staticmethod
+    def load_coarse_matrix(coarse_dim: int) -> Optional[np.ndarray]:
+        """Open the coarse matrix (re-normalized first coarse_dim dimensions of every row), memory-mapped
+
+        Builds it from the full matrix if the store does not have one with this many dimensions yet
+
+        Args:
+            coarse_dim (int): number of leading dimensions kept
+
+        Returns:
+            Optional[np.ndarray]: the coarse matrix, rows match the full matrix. None if nothing is stored.
+        """
+        matrix_path = Path(EMBEDDINGS_DIR) / MATRIX_FILE
+        metadata_path = Path(EMBEDDINGS_DIR) / METADATA_FILE
+        coarse_path = Path(EMBEDDINGS_DIR) / COARSE_MATRIX_FILE
+        if not matrix_path.exists() or not metadata_path.exists():
+            return None
+        metadata = file_utils.load_json(str(metadata_path))
+        if metadata.get("coarse_dim") != coarse_dim or not coarse_path.exists():
+            EmbeddingsIO._save_coarse_matrix(np.load(str(matrix_path), mmap_mode="r"), coarse_dim)
+            metadata["coarse_dim"] = coarse_dim
+            # Swapped in whole, a crash while writing never leaves a truncated sidecar
+            os.replace(EmbeddingsIO._write_tmp_metadata(metadata), metadata_path)
+        return np.load(str(coarse_path), mmap_mode="r")
+
+
+    @staticmethod
+    def _save_coarse_matrix(matrix: np.ndarray, coarse_dim: int, batch_size: int = 65536) -> None:
+        coarse_path = Path(EMBEDDINGS_DIR) / COARSE_MATRIX_FILE
+        tmp_coarse_path = coarse_path.with_name(COARSE_MATRIX_FILE + ".tmp")
+        coarse_matrix = np.lib.format.open_memmap(str(tmp_coarse_path), mode="w+", dtype=np.float32,
+                                                  shape=(matrix.shape[0], coarse_dim))
+        for start in range(0, matrix.shape[0], batch_size):
+            coarse_matrix[start:start + batch_size] = normalize_rows(matrix[start:start + batch_size, :coarse_dim])
+        coarse_matrix.flush()
+        del coarse_matrix
+        os.replace(tmp_coarse_path, coarse_path)
+
+
+    @staticmethod
+    def open_matrix() -> Optional[np.ndarray]:
+        """Open only the embedding matrix (memory-mapped, read only), without parsing the metadata"""
+        matrix_path = Path(EMBEDDINGS_DIR) / MATRIX_FILE
+        if not matrix_path.exists():
+            return None
+        return np.load(str(matrix_path), mmap_mode="r")
+
+
+    @staticmethod
+    def store_signature() -> Optional[Dict]:
+        """Size and modification time of the store's files, which change whenever the store is rewritten"""
+        signature = {}
+        for file_name in (MATRIX_FILE, METADATA_FILE):
+            path = Path(EMBEDDINGS_DIR) / file_name
+            if not path.exists():
+                return None
+            stat = path.stat()
+            signature[file_name] = [stat.st_size, stat.st_mtime_ns]
+        return signature
+
+
+    @staticmethod
+    def stored_files() -> set:
+        """Get the names of all the files that have embeddings in the store"""
+        metadata_path = Path(EMBEDDINGS_DIR) / METADATA_FILE
+        EmbeddingsIO.migrate_json_embeddings()
+        if not metadata_path.exists():
+            return set()
+        return set(file_utils.load_json(str(metadata_path))["files"])
+
+
     @staticmethod
     def load_embeddings(file_name: str) -> List[Dict]:
-        """Load an embedding list from a file
+        """Load the embedded chunks of one file from the store
+
+        Args:
+            file_name (str): name of the file the chunks belong to
+
+        Returns:
+            List[Dict]: chunks of the file, "chunk_embeddings" is a read only view into the matrix
+        """
+        return EmbeddingsIO.load_files_embeddings([file_name])
+
+
+    @staticmethod
+    def load_files_embeddings(file_names: Iterable[str]) -> List[Dict]:
+        """Load the embedded chunks of several files, opening the store only once
 
         Args:
-            file_name (str): _description_
+            file_names (Iterable[str]): names of the files to load
 
         Returns:
-            List[Dict]: _description_
+            List[Dict]: chunks of the files, "chunk_embeddings" is a read only view into the matrix
         """
-        json_file = file_name + ".json"
-        path = Path(EMBEDDINGS_DIR) / json_file
-        return file_utils.load_json(str(path))
-    
-    
+        file_names = set(file_names)
+        matrix, records = EmbeddingsIO.load_store()
+        return [EmbeddingsIO._record_to_chunk(record, matrix)
+                for record in records if record["file_name"] in file_names]
+
+
+    @staticmethod
+    def save_embeddings(embedded_chunks: List[Dict], file_name: Optional[str] = None) -> None:
+        """Save embedded chunks to the store, replacing any stored chunks of the same files
+
+        Chunks with the same "content_hash" share one row, and rows that are no longer
+        referenced by any chunk are dropped (garbage-collected)
+
+        Args:
+            embedded_chunks (List[Dict]): chunks that each have a "chunk_embeddings" vector
+            file_name (str, optional): only save the chunks of this file. Defaults to all files.
+        """
+        if file_name is not None:
+            embedded_chunks = [chunk for chunk in embedded_chunks if chunk["file_name"] == file_name]
+        if not embedded_chunks:
+            return
+        writer = StoreWriter()
+        writer.add(embedded_chunks)
+        writer.close()
+
+
     @staticmethod
-    def save_embeddings(embedded_chunks: List[Dict], file_name: str) -> None:
-        """Save the embeddings list to a file
+    def remove_embeddings(file_names: Iterable[str]) -> None:
+        """Remove the chunks of some files from the store and drop their unreferenced vectors
 
         Args:
-            embedded_chunks (List[Dict]): _description_
-            file_name (str): _description_
+            file_names (Iterable[str]): names of the files to remove
+        """
+        StoreWriter(replaced_files=file_names).close()
+
+
+    @staticmethod
+    def content_hash(text: str, model: str, input_type: str) -> str:
+        """Key an embedding by everything that determines it: the text, the model and the input type"""
+        return hashlib.sha256(f"{model}\0{input_type}\0{text}".encode("utf-8")).hexdigest()
+
+
+    @staticmethod
+    def migrate_json_embeddings() -> int:
+        """Move old "<file_name>.json" embedding files into the store (runs once per file)
+
+        Returns:
+            int: number of JSON files that were migrated
         """
-        json_file = file_name + ".json"
-        path = Path(EMBEDDINGS_DIR) / json_file
-        file_utils.save_json(embedded_chunks, str(path))
\ No newline at end of file
+        embeddings_dir = Path(EMBEDDINGS_DIR)
+        if not embeddings_dir.exists():
+            return 0
+        legacy_files = [path for path in embeddings_dir.glob("*.json") if path.name != METADATA_FILE]
+        if not legacy_files:
+            return 0
+
+        legacy_chunks = []
+        for path in legacy_files:
+            legacy_chunks.extend(file_utils.load_json(str(path)))
+        # The JSON embeddings were all made with the configured model as "query" inputs
+        for chunk in legacy_chunks:
+            chunk["content_hash"] = EmbeddingsIO.content_hash(chunk["chunk_content"], EMBEDDING_MODEL, "query")
+
+        # Move the JSON files out of the way before saving, so load_store does not recurse
+        legacy_dir = embeddings_dir / LEGACY_DIR
+        file_utils.ensure_directory_exists(legacy_dir)
+        for path in legacy_files:
+            os.replace(path, legacy_dir / path.name)
+
+        EmbeddingsIO.save_embeddings(legacy_chunks)
+        logger.info("Migrated %d JSON embedding files into %s", len(legacy_files), MATRIX_FILE)
+        return len(legacy_files)
+
+
+    @staticmethod
+    def _record_to_chunk(record: Dict, matrix: np.ndarray) -> Dict:
+        # The chunk keeps its "row" so other matrices of the store (e.g. the coarse one) can be indexed
+        chunk = dict(record)
+        chunk["chunk_embeddings"] = matrix[record["row"]]
+        return chunk
+
+
+
+class StoreWriter:
+    """
+    Adds embedded chunks to the store a batch at a time, without ever holding the matrix in memory.
+    The vectors of every batch are appended to the end of the matrix file as they arrive, and
+    close() writes the metadata once, dropping the stored chunks of the replaced files and copying
+    the rows that are still referenced (a block at a time) only when some rows are no longer used.
+    """
+
+    def __init__(self, replaced_files: Iterable[str] = ()):
+        """
+        Args:
+            replaced_files (Iterable[str], optional): files whose stored chunks are dropped, on top of
+                the files of the added chunks (e.g. deleted files). Defaults to none.
+        """
+        _, self._old_records = EmbeddingsIO.load_store()
+        # Count the rows in the file, which includes any rows a crashed writer appended
+        matrix = EmbeddingsIO.open_matrix()
+        self._num_old_rows = 0 if matrix is None else matrix.shape[0]
+        self._num_rows = self._num_old_rows
+        self._dim = None if matrix is None else matrix.shape[1]
+        del matrix
+        # Every chunk with a stored content hash reuses its row
+        self._rows_by_hash = {}
+        for record in self._old_records:
+            if record.get("content_hash"):
+                self._rows_by_hash.setdefault(record["content_hash"], record["row"])
+        self.replaced_files = set(replaced_files)
+        # Metadata of the added chunks, in the order they were added
+        self.records = []
+
+
+    def stored_row(self, content_hash: str) -> Optional[int]:
+        """Row of the vector stored (or added) under content_hash, None if there is none yet"""
+        return self._rows_by_hash.get(content_hash)
+
+
+    def add(self, chunks: List[Dict]) -> None:
+        """Add a batch of chunks, appending the vectors that are not stored yet to the matrix
+
+        Args:
+            chunks (List[Dict]): chunks with their metadata. A chunk whose "content_hash" is already
+                stored reuses that row, every other chunk needs a "chunk_embeddings" vector.
+        """
+        vectors = []
+        for chunk in chunks:
+            record = {key: value for key, value in chunk.items() if key not in ("chunk_embeddings", "row")}
+            row = self._rows_by_hash.get(chunk["content_hash"]) if chunk.get("content_hash") else None
+            if row is None:
+                row = self._num_rows + len(vectors)
+                vectors.append(chunk["chunk_embeddings"])
+                if chunk.get("content_hash"):
+                    self._rows_by_hash[chunk["content_hash"]] = row
+            record["row"] = row
+            self.records.append(record)
+            # A chunk stands in for its near-duplicates, so their files are replaced too
+            self.replaced_files.add(chunk["file_name"])
+            self.replaced_files.update(source["file_name"] for source in chunk.get("duplicate_sources", ()))
+        if vectors:
+            self._append_rows(vectors)
+
+
+    def close(self, duplicate_sources: Optional[Dict[int, List[Dict]]] = None) -> bool:
+        """Write the metadata, replacing the stored chunks of the replaced files, and drop unused rows
+
+        Args:
+            duplicate_sources (Dict[int, List[Dict]], optional): position of an added chunk -> the chunks
+                collapsed onto it (see ChunkDeduplicator.iter_unique), stored with its record
+
+        Returns:
+            bool: False if nothing about the replaced files changed, so the store was left as it was
+        """
+        for position, sources in (duplicate_sources or {}).items():
+            self.records[position]["duplicate_sources"] = sources
+            self.replaced_files.update(source["file_name"] for source in sources)
+        replaced_records = [record for record in self._old_records if record["file_name"] in self.replaced_files]
+        if self._num_rows == self._num_old_rows and self._same_chunks(replaced_records, self.records):
+            return False
+        records = [record for record in self._old_records if record["file_name"] not in self.replaced_files]
+        records.extend(self.records)
+
+        # Copy the rows that are still referenced into a new matrix, in their current order
+        tmp_matrix_path = None
+        referenced_rows = np.unique(np.array([record["row"] for record in records], dtype=np.int64))
+        if len(referenced_rows) < self._num_rows:
+            tmp_matrix_path = self._copy_rows(referenced_rows)
+            new_rows = np.empty(self._num_rows, dtype=np.int64)
+            new_rows[referenced_rows] = np.arange(len(referenced_rows))
+            records = [{**record, "row": int(new_rows[record["row"]])} for record in records]
+        EmbeddingsIO._commit_store(records, tmp_matrix_path)
+        return True
+
+
+    @staticmethod
+    def _same_chunks(stored_records: List[Dict], records: List[Dict]) -> bool:
+        # True if the records describe the same chunks, whatever rows their vectors are in
+        def metadata(item):
+            return {key: value for key, value in item.items() if key != "row"}
+        key = lambda item: (item["file_name"], item["chunk_id"])
+        return (sorted(map(metadata, stored_records), key=key) == sorted(map(metadata, records), key=key))
+
+
+    def _append_rows(self, vectors: List) -> None:
+        # Write the vectors after the last row of the matrix file and grow the shape in its header
+        dim = self._dim if self._dim is not None else len(vectors[0])
+        for vector in vectors:
+            if len(vector) != dim:
+                raise ValueError(f"Embedding dimension {len(vector)} does not match stored dimension {dim}")
+        matrix_path = Path(EMBEDDINGS_DIR) / MATRIX_FILE
+        if not matrix_path.exists():
+            file_utils.ensure_directory_exists(EMBEDDINGS_DIR)
+            np.save(str(matrix_path), np.asarray(vectors, dtype=EMBEDDING_STORE_DTYPE))
+        elif not self._append_in_place(matrix_path, vectors):
+            # Matrices saved by older numpy have no room in the header for a longer shape,
+            # so the rows are copied once into a file that has
+            os.replace(self._copy_rows(np.arange(self._num_rows)), matrix_path)
+            self._append_in_place(matrix_path, vectors)
+        self._num_rows += len(vectors)
+        self._dim = dim
+
+
+    def _append_in_place(self, matrix_path: Path, vectors: List) -> bool:
+        with open(matrix_path, "r+b") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                read_header, write_header = np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0
+            else:
+                read_header, write_header = np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            header_length = f.tell()
+            header = io.BytesIO()
+            write_header(header, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                  "fortran_order": False,
+                                  "shape": (shape[0] + len(vectors), shape[1])})
+            if fortran_order or len(header.getvalue()) != header_length:
+                return False
+            # Rows go right after the last complete row, then the header is updated to include them
+            f.seek(header_length + shape[0] * shape[1] * dtype.itemsize)
+            f.write(np.asarray(vectors, dtype=dtype).tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header.getvalue())
+        return True
+
+
+    def _copy_rows(self, rows: np.ndarray, batch_size: int = 65536) -> Path:
+        # Copy some rows of the matrix, in order, into a temporary matrix file a block at a time
+        matrix = EmbeddingsIO.open_matrix()
+        tmp_matrix_path = Path(EMBEDDINGS_DIR) / (MATRIX_FILE + ".tmp")
+        new_matrix = np.lib.format.open_memmap(str(tmp_matrix_path), mode="w+", dtype=EMBEDDING_STORE_DTYPE,
+                                               shape=(len(rows), matrix.shape[1]))
+        for start in range(0, len(rows), batch_size):
+            new_matrix[start:start + batch_size] = matrix[rows[start:start + batch_size]]
+        new_matrix.flush()
+        del new_matrix, matrix
+        return tmp_matrix_path
@@ -0,0 +1,196 @@
+# Retrieval quality vs. cost sweep over chunking settings and retrieval modes (python -m src.evaluation)
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config.config import (EMBEDDING_MODEL, EVALUATION_QUERIES_FILE, EVALUATION_CUTOFFS, EVALUATION_CHUNKINGS,
+                           EVALUATION_RETRIEVAL_MODES, EVALUATION_EMBEDDINGS_FILE)
+from src.bm25 import BM25Search
+from src.chunker import TextChunker
+from src.document_loader import DocumentLoader
+from src.embeddings import EmbeddingSystem
+from src.embeddings_io import EmbeddingsIO
+from src.multi_index import MultiIndex
+from src.query_embedding_cache import QueryEmbeddingCache
+from utils import file_utils
+from utils.evaluation_metrics import evaluate_rankings
+from utils.text_processing import estimate_tokens
+
+
+def load_labelled_queries(path: str = EVALUATION_QUERIES_FILE) -> List[Dict]:
+    """Load the labelled queries ([{"query": ..., "relevant": [{"file_name": ..., "text": ...}]}])"""
+    if not Path(path).exists() or not Path(path).read_text().strip():
+        raise ValueError(f"No labelled queries in '{path}'")
+    return file_utils.load_json(path)
+
+
+class RetrievalEvaluator:
+    """
+    Measures retrieval quality (recall@k, precision@k, MRR, nDCG@k) next to its cost for
+    several chunking settings and retrieval modes. A labelled passage is found by the first
+    retrieved chunk that overlaps it, and each passage counts once however many chunks it was
+    split into, so the same labels score every chunking alike.
+    Chunk embeddings come from the embedding store when the text was already ingested, then
+    from an evaluation cache, and only the rest is embedded (and cached).
+    """
+
+    def __init__(self,
+                 embedding_system: EmbeddingSystem,
+                 labelled_queries: List[Dict],
+                 cutoffs=EVALUATION_CUTOFFS,
+                 cache_path: Optional[str] = EVALUATION_EMBEDDINGS_FILE):
+        self.embedding_system = embedding_system
+        self.labelled_queries = labelled_queries
+        self.cutoffs = sorted(cutoffs)
+        self.chunk_cache = QueryEmbeddingCache(max_entries=100_000, path=cache_path, max_disk_entries=10_000_000)
+        self.text_chunker = TextChunker()
+        file_names = sorted({passage["file_name"] for query in labelled_queries for passage in query["relevant"]})
+        self.document_texts = DocumentLoader().load_all_documents(file_names)
+        self.passage_spans = [self._passage_spans(query) for query in labelled_queries]
+        self._query_embeddings = None
+
+    def run(self,
+            chunkings: List[Dict] = EVALUATION_CHUNKINGS,
+            retrieval_modes: List[str] = EVALUATION_RETRIEVAL_MODES) -> List[Dict]:
+        """Evaluate every chunking with every retrieval mode
+
+        Returns:
+            List[Dict]: one result per (chunking, retrieval mode) with the quality metrics,
+            "query_latency_ms" (p50/p95), "index_bytes", "embedding_tokens" (to embed the
+            documents with this chunking) and "tokens_embedded" (embedded by this run)
+        """
+        if self._query_embeddings is None:
+            self._query_embeddings = self.embedding_system.get_embeddings(
+                [query["query"] for query in self.labelled_queries])
+        results = []
+        for chunking in chunkings:
+            # 1. Chunk the labelled documents and get their embeddings
+            chunks = [chunk for file_name, text in self.document_texts.items() if text
+                      for chunk in self.text_chunker.chunk_records(file_name, text, **chunking)]
+            embedding_tokens, tokens_embedded = self._embed(chunks)
+            relevant = [self._passage_chunks(spans, chunks) for spans in self.passage_spans]
+            for retrieval_mode in retrieval_modes:
+                # 2. Index them and retrieve the top results of every query, one query at a time
+                search, index_bytes = self._build_index(chunks, retrieval_mode)
+                retrieved = []
+                latencies = []
+                for query, query_embedding in zip(self.labelled_queries, self._query_embeddings):
+                    start_time = time.perf_counter()
+                    ranking = search(query["query"], query_embedding)
+                    latencies.append(time.perf_counter() - start_time)
+                    retrieved.append([(chunk["file_name"], chunk["chunk_id"]) for chunk in ranking])
+
+                # 3. Score the rankings
+                result = {**chunking, "retrieval_mode": retrieval_mode, "chunks": len(chunks)}
+                result.update(evaluate_rankings(retrieved, relevant, self.cutoffs))
+                result.update({"query_latency_ms": {"p50": float(np.percentile(latencies, 50) * 1000),
+                                                    "p95": float(np.percentile(latencies, 95) * 1000)},
+                               "index_bytes": index_bytes,
+                               "embedding_tokens": embedding_tokens,
+                               "tokens_embedded": tokens_embedded})
+                results.append(result)
+                print(f"{chunking['chunk_by']} {chunking.get('chunk_size')}/{chunking.get('chunk_overlap')} "
+                      f"{retrieval_mode}: recall@{self.cutoffs[-1]} {result[f'recall@{self.cutoffs[-1]}']:.3f}, "
+                      f"MRR {result['mrr']:.3f}, {len(chunks)} chunks, ~{embedding_tokens} tokens")
+        return results
+
+    def _passage_spans(self, query: Dict) -> List:
+        # (file_name, start, end) of every labelled passage found in its document
+        spans = []
+        for passage in query["relevant"]:
+            start = (self.document_texts.get(passage["file_name"]) or "").find(passage["text"])
+            if start == -1:
+                print(f"Labelled passage of '{query['query']}' not found in '{passage['file_name']}'")
+                continue
+            spans.append((passage["file_name"], start, start + len(passage["text"])))
+        return spans
+
+    @staticmethod
+    def _passage_chunks(spans: List, chunks: List[Dict]) -> List[set]:
+        # The keys of the chunks that overlap each labelled passage
+        return [{(chunk["file_name"], chunk["chunk_id"]) for chunk in chunks
+                 if chunk["file_name"] == file_name and chunk["start_char"] < end and chunk["end_char"] > start}
+                for file_name, start, end in spans]
+
+    def _embed(self, chunks: List[Dict]) -> tuple:
+        # Attach an embedding to every chunk, returning (tokens to embed every distinct text, tokens embedded now)
+        texts = list(dict.fromkeys(chunk["chunk_content"] for chunk in chunks))
+        matrix, records = EmbeddingsIO.load_store()
+        stored_rows = {record["content_hash"]: record["row"] for record in records if record.get("content_hash")}
+        embeddings = {}
+        for text in texts:
+            row = stored_rows.get(EmbeddingsIO.content_hash(text, EMBEDDING_MODEL, "query"))
+            if row is not None:
+                embeddings[text] = matrix[row]
+        embeddings.update(self.chunk_cache.get_many([text for text in texts if text not in embeddings],
+                                                    EMBEDDING_MODEL, "query"))
+        missing = [text for text in texts if text not in embeddings]
+        if missing:
+            new_embeddings = dict(zip(missing, self.embedding_system.scheduler.embed(missing, input_type="query")))
+            self.chunk_cache.put_many(new_embeddings, EMBEDDING_MODEL, "query")
+            embeddings.update(new_embeddings)
+        for chunk in chunks:
+            chunk["chunk_embeddings"] = embeddings[chunk["chunk_content"]]
+        return sum(estimate_tokens(text) for text in texts), sum(estimate_tokens(text) for text in missing)
+
+    def _build_index(self, chunks: List[Dict], retrieval_mode: str) -> tuple:
+        # A search function (query, query embedding) -> ranked chunks, and the size of the index in bytes.
+        # Dense search is exact so the metrics only reflect chunking and retrieval mode.
+        top_k = self.cutoffs[-1]
+        embedding_system = EmbeddingSystem(voyageai_client=self.embedding_system._voyageai_client,
+                                           query_cache=self.embedding_system.query_cache)
+        embedding_system.ann_index = None
+        embedding_system.quantized_index = None
+        embedding_system.coarse_dimensions = None
+        embedding_system.index_chunks(chunks)
+        index_bytes = embedding_system._normalized_matrix.nbytes
+        if retrieval_mode == "dense":
+            return (lambda query, query_embedding: embedding_system.similarity_search_many(
+                [query], top_k=top_k, query_embeddings=[query_embedding])[0]), index_bytes
+        multi_index = MultiIndex(embedding_system, BM25Search())
+        multi_index.index_chunks(chunks)
+        with tempfile.TemporaryDirectory() as index_dir:
+            multi_index.bm25.save(index_dir)
+            index_bytes += sum(path.stat().st_size for path in Path(index_dir).iterdir())
+        return (lambda query, query_embedding: multi_index.search_many(
+            [query], top_k=top_k, query_embeddings=[query_embedding])[0]), index_bytes
+
+
+def cheapest_configuration(results: List[Dict], metric: str, minimum: float) -> Optional[Dict]:
+    """Pick the result that reaches minimum on metric with the fewest embedding tokens (then the smallest index)"""
+    passing = [result for result in results if result[metric] >= minimum]
+    if not passing:
+        return None
+    return min(passing, key=lambda result: (result["embedding_tokens"], result["index_bytes"],
+                                            result["query_latency_ms"]["p50"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chunking settings and retrieval modes on labelled queries")
+    parser.add_argument("--queries", default=EVALUATION_QUERIES_FILE, help="labelled queries (JSON)")
+    parser.add_argument("--metric", default=f"recall@{max(EVALUATION_CUTOFFS)}", help="metric of the accuracy bar")
+    parser.add_argument("--minimum", type=float, default=0.9, help="accuracy bar the configuration must meet")
+    parser.add_argument("--output", help="write every result to this JSON file")
+    args = parser.parse_args()
+
+    evaluator = RetrievalEvaluator(EmbeddingSystem(), load_labelled_queries(args.queries))
+    results = evaluator.run()
+    if args.output:
+        file_utils.save_json(results, args.output)
+    best = cheapest_configuration(results, args.metric, args.minimum)
+    if best is None:
+        print(f"No configuration reaches {args.metric} >= {args.minimum}")
+    else:
+        print(f"Cheapest configuration with {args.metric} >= {args.minimum}: {best['chunk_by']} "
+              f"{best.get('chunk_size')}/{best.get('chunk_overlap')} {best['retrieval_mode']} "
+              f"({args.metric} {best[args.metric]:.3f}, ~{best['embedding_tokens']} tokens, "
+              f"{best['index_bytes'] / 1e6:.1f}MB index, p50 {best['query_latency_ms']['p50']:.1f}ms)")
+
+
+if __name__ == "__main__":
+    main()
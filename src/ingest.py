@@ -0,0 +1,217 @@
+# Non-interactive ingestion of DOCUMENTS_DIR (python -m src.ingest [--watch])
+import argparse
+import logging
+import os
+import time
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+from config.config import DOCUMENTS_DIR, INDEXES_DIR, CHUNKING_POLICY, INGEST_WATCH_INTERVAL
+from config.logging_config import configure_logging, telemetry
+from src.bm25 import BM25Search
+from src.chunker import TextChunker
+from src.dedup import iter_unique_chunks
+from src.document_loader import DocumentLoader, SUPPORTED_EXTENSIONS
+from src.embeddings_io import EmbeddingsIO
+from utils import file_utils
+
+MANIFEST_FILE = "ingest_manifest.json"
+
+logger = logging.getLogger("rag")
+
+
+class Ingestor:
+    """
+    Keeps the embedding store and the indexes in sync with DOCUMENTS_DIR. A manifest of the
+    ingested files (size, modification time and chunking policy) tells which files were added,
+    modified or deleted since the last run, and only those are re-chunked and re-embedded.
+    """
+
+    def __init__(self,
+                 embedding_system,
+                 bm25: Optional[BM25Search] = None,
+                 policy: Dict[str, Dict] = CHUNKING_POLICY,
+                 index_dir: str = INDEXES_DIR):
+        self.embedding_system = embedding_system
+        self.bm25 = bm25 if bm25 is not None else (BM25Search.load(index_dir) or BM25Search())
+        self.policy = policy
+        self.index_dir = index_dir
+        self.document_loader = DocumentLoader()
+        self.text_chunker = TextChunker()
+        # All the stored chunks after the last ingest
+        self.embedded_chunks = None
+
+    def chunking_policy(self, file_name: str) -> Dict:
+        """Get the chunk_by (and optional chunk_size/chunk_overlap) of the first glob matching the file"""
+        for pattern, file_policy in self.policy.items():
+            if fnmatch(file_name, pattern):
+                return dict(file_policy)
+        raise ValueError(f"No chunking policy matches '{file_name}', add a \"*\" entry to CHUNKING_POLICY")
+
+    def scan(self) -> Dict[str, Dict]:
+        """Get the signature (size, modification time and chunking policy) of every supported document"""
+        signatures = {}
+        for path in sorted(Path(DOCUMENTS_DIR).glob("*")):
+            if not path.is_file() or path.suffix.lower() not in SUPPORTED_EXTENSIONS:
+                continue
+            stat = os.stat(path)
+            signatures[path.name] = {"size": stat.st_size,
+                                     "mtime_ns": stat.st_mtime_ns,
+                                     "policy": self.chunking_policy(path.name)}
+        return signatures
+
+    def changes(self, force: bool = False) -> Dict[str, List[str]]:
+        """Compare DOCUMENTS_DIR with the manifest of the last ingest
+
+        Args:
+            force (bool, optional): treat every document as modified. Defaults to False.
+
+        Returns:
+            Dict[str, List[str]]: the "added", "modified" and "deleted" file names
+        """
+        manifest = self._load_manifest()
+        current = self.scan()
+        return {"added": [name for name in current if name not in manifest],
+                "modified": [name for name in current if name in manifest and (force or current[name] != manifest[name])],
+                "deleted": [name for name in manifest if name not in current]}
+
+    def ingest(self, force: bool = False, quiet: bool = False) -> Dict[str, List[str]]:
+        """Apply the added, modified and deleted documents to the embedding store and the indexes
+
+        Args:
+            force (bool, optional): re-ingest every document. Defaults to False.
+            quiet (bool, optional): print nothing when nothing changed. Defaults to False.
+
+        Returns:
+            Dict[str, List[str]]: the "added", "modified" and "deleted" file names that were applied
+        """
+        with telemetry.span("ingest", force=force) as span:
+            changes = self.changes(force)
+            if not any(changes.values()):
+                if not quiet:
+                    logger.info("Documents are up to date")
+                if self.embedded_chunks is None:
+                    self._index_stored_chunks()
+                return changes
+            logger.info("%d added, %d modified, %d deleted", len(changes["added"]), len(changes["modified"]),
+                        len(changes["deleted"]))
+            start_time = time.perf_counter()
+            signatures = self.scan()
+            deleted = set(changes["deleted"])
+            # Files whose chunks were collapsed onto chunks of a changed file (or the other way around)
+            # are re-ingested with it, so no chunk loses the vector it shares
+            to_ingest = set(changes["added"]) | set(changes["modified"])
+            to_ingest |= self._dedup_related_files(to_ingest | deleted) & set(signatures)
+            span.update(files=len(to_ingest), deleted=len(deleted))
+
+            # 1. Drop the deleted files and the old chunks of the re-ingested files from the keyword index
+            self.bm25.remove_files(deleted | to_ingest)
+
+            # 2. Stream the added and modified files through extraction, chunking, dedup and embedding,
+            # holding the text of a few files and one batch of chunks at a time. The stored chunks of the
+            # deleted and re-ingested files are replaced, so files with no chunks left (deleted, empty or
+            # fully collapsed elsewhere) leave the store.
+            file_names = sorted(to_ingest)
+            failed_files = set()
+            duplicate_sources = {}
+            unique_chunks = iter_unique_chunks(self._chunk_documents(file_names, signatures, failed_files),
+                                               duplicate_sources)
+            embedded_chunks = self.embedding_system.embed_chunks(unique_chunks, index=False,
+                                                                 replaced_files=deleted | to_ingest,
+                                                                 duplicate_sources=duplicate_sources)
+            self.bm25.add_chunks(embedded_chunks)
+
+            # 3. Rebuild (or update) the dense index over every stored chunk and save the indexes
+            self._index_stored_chunks()
+            self.bm25.save(self.index_dir)
+            # Files whose extraction failed stay out of the manifest, so the next run retries them
+            self._save_manifest({file_name: signature for file_name, signature in signatures.items()
+                                 if file_name not in failed_files})
+            logger.info("Ingested %d files and removed %d in %.2fs (%d chunks stored)", len(file_names),
+                        len(deleted), time.perf_counter() - start_time, len(self.embedded_chunks))
+            return changes
+
+    def watch(self, interval: float = INGEST_WATCH_INTERVAL) -> None:
+        """Ingest, then keep applying changes to DOCUMENTS_DIR every interval seconds until interrupted"""
+        self.ingest()
+        logger.info("Watching '%s' for changes (Ctrl+C to stop)", DOCUMENTS_DIR)
+        try:
+            while True:
+                time.sleep(interval)
+                try:
+                    self.ingest(quiet=True)
+                except Exception:
+                    # Keep watching, the failed changes are picked up again by the next scan
+                    logger.exception("Ingest failed, retrying in %.0fs", interval)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+
+    def _index_stored_chunks(self) -> None:
+        self.embedded_chunks = EmbeddingsIO.load_files_embeddings(EmbeddingsIO.stored_files())
+        self.embedding_system.index_chunks(self.embedded_chunks)
+
+    @staticmethod
+    def _dedup_related_files(file_names: Set[str]) -> Set[str]:
+        # Files linked to any of file_names through a chain of deduplicated chunks (A shares a
+        # chunk with B, B with C, ...), found with a worklist until the set stops growing
+        _, records = EmbeddingsIO.load_store()
+        links = {}
+        for record in records:
+            for source in record.get("duplicate_sources", ()):
+                links.setdefault(record["file_name"], set()).add(source["file_name"])
+                links.setdefault(source["file_name"], set()).add(record["file_name"])
+        related = set(file_names)
+        worklist = list(file_names)
+        while worklist:
+            for linked_file in links.get(worklist.pop(), ()):
+                if linked_file not in related:
+                    related.add(linked_file)
+                    worklist.append(linked_file)
+        return related - file_names
+
+    def _chunk_documents(self,
+                         file_names: List[str],
+                         signatures: Dict[str, Dict],
+                         failed_files: Set[str]) -> Iterator[Dict]:
+        # Chunks of every file, extracted a few files at a time (files that could not be
+        # extracted are added to failed_files)
+        for file_name, text in self.document_loader.iter_documents(file_names):
+            if text is None:
+                failed_files.add(file_name)
+            elif text:
+                yield from self.text_chunker.chunk_records(file_name, text, **signatures[file_name]["policy"])
+
+    def _load_manifest(self) -> Dict[str, Dict]:
+        path = Path(self.index_dir) / MANIFEST_FILE
+        return file_utils.load_json(str(path)) if path.exists() else {}
+
+    def _save_manifest(self, signatures: Dict[str, Dict]) -> None:
+        file_utils.ensure_directory_exists(self.index_dir)
+        path = Path(self.index_dir) / MANIFEST_FILE
+        tmp_path = path.with_name(MANIFEST_FILE + ".tmp")
+        file_utils.save_json(signatures, str(tmp_path))
+        tmp_path.replace(path)
+
+
+def main():
+    from src.embeddings import EmbeddingSystem
+
+    parser = argparse.ArgumentParser(description=f"Embed and index the documents in '{DOCUMENTS_DIR}'")
+    parser.add_argument("--watch", action="store_true", help="keep applying added, modified and deleted files")
+    parser.add_argument("--interval", type=float, default=INGEST_WATCH_INTERVAL, help="seconds between scans")
+    parser.add_argument("--force", action="store_true", help="re-ingest every document")
+    args = parser.parse_args()
+
+    configure_logging()
+    ingestor = Ingestor(EmbeddingSystem())
+    if args.force:
+        ingestor.ingest(force=True)
+    if args.watch:
+        ingestor.watch(args.interval)
+    elif not args.force:
+        ingestor.ingest()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Query-time metadata filters: the rows of the search matrix that have each file name, extension,
+# chunking mode and document tag, combined into one bitmap per query
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from config.config import DOCUMENT_TAGS
+
+FILTER_FIELDS = ("file_name", "extension", "chunk_by", "tags")
+
+
+def document_tags(file_name: str, tag_patterns: Dict[str, List[str]] = DOCUMENT_TAGS) -> List[str]:
+    """Get the tags of a document: those of every glob in tag_patterns that matches its file name"""
+    return sorted({tag for pattern, tags in tag_patterns.items() if fnmatch(file_name, pattern) for tag in tags})
+
+
+class MetadataIndex:
+    """
+    Precomputes, for every value of the filterable fields, the rows (positions in the list of
+    indexed chunks) that have it. A filter is a dict of field -> accepted values: a row passes
+    when it has one of the values of every field, and is dropped when it has any of the values
+    in filters["exclude"] (a dict of the same form). A chunk that stands in for near-duplicates
+    has the file name, extension and tags of every document it was collapsed from.
+    """
+
+    def __init__(self, chunks: Iterable[Dict], tag_patterns: Dict[str, List[str]] = DOCUMENT_TAGS):
+        rows_by_value = {field: {} for field in FILTER_FIELDS}
+        tags_by_file = {}
+        num_rows = 0
+        for row, chunk in enumerate(chunks):
+            num_rows += 1
+            for source in [chunk, *chunk.get("duplicate_sources", ())]:
+                file_name = source["file_name"]
+                if file_name not in tags_by_file:
+                    tags_by_file[file_name] = document_tags(file_name, tag_patterns)
+                values = {"file_name": [file_name],
+                          "extension": [Path(file_name).suffix.lower()],
+                          "chunk_by": [source.get("chunk_by", chunk.get("chunk_by"))],
+                          "tags": tags_by_file[file_name]}
+                for field, field_values in values.items():
+                    for value in field_values:
+                        if value is not None:
+                            rows_by_value[field].setdefault(value, []).append(row)
+        self.num_rows = num_rows
+        # value -> sorted row ids (a row is listed once even if several of its sources have the value)
+        self._rows = {field: {value: np.unique(np.array(rows, dtype=np.int64)) for value, rows in values.items()}
+                      for field, values in rows_by_value.items()}
+
+    def values(self, field: str) -> List[str]:
+        """Get every value of a field that some row has"""
+        self._check_fields([field])
+        return sorted(self._rows[field])
+
+    def mask(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        """Combine the bitmaps of the filter's values into the rows that pass it
+
+        Args:
+            filters (Dict, optional): field -> accepted value(s), and optionally "exclude": {field -> value(s)}
+
+        Returns:
+            Optional[np.ndarray]: bool array with one entry per row, or None if there is nothing to filter
+        """
+        if not filters:
+            return None
+        filters = dict(filters)
+        exclude = filters.pop("exclude", None) or {}
+        self._check_fields(filters)
+        self._check_fields(exclude)
+        mask = np.ones(self.num_rows, dtype=bool)
+        for field, values in filters.items():
+            mask &= self._bitmap(field, values)
+        for field, values in exclude.items():
+            mask &= ~self._bitmap(field, values)
+        return mask
+
+    def _bitmap(self, field: str, values) -> np.ndarray:
+        # The rows that have any of the values (OR of their bitmaps)
+        bitmap = np.zeros(self.num_rows, dtype=bool)
+        for value in [values] if isinstance(values, str) else values:
+            if field == "extension":
+                value = "." + value.lower().lstrip(".")
+            rows = self._rows[field].get(value)
+            if rows is not None:
+                bitmap[rows] = True
+        return bitmap
+
+    @staticmethod
+    def _check_fields(fields: Iterable[str]) -> None:
+        unknown = set(fields) - set(FILTER_FIELDS)
+        if unknown:
+            raise ValueError(f"Can only filter on {list(FILTER_FIELDS)}, got {sorted(unknown)}")
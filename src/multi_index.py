@@ -1 +1,171 @@
-# Multi-index routing logic
\ No newline at end of file
+# Multi-index routing logic
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config.config import TOP_K_RESULTS, FUSION_METHOD, RRF_K, DENSE_WEIGHT, HYBRID_CANDIDATES
+from src.bm25 import BM25Search
+
+
+class MultiIndex:
+    """
+    Sends one query to the dense (embedding) index and the BM25 index at the same
+    time and fuses their rankings into one list of chunks
+    """
+
+    def __init__(self,
+                 embedding_system,
+                 bm25: Optional[BM25Search] = None,
+                 fusion: str = FUSION_METHOD,
+                 rrf_k: int = RRF_K,
+                 dense_weight: float = DENSE_WEIGHT,
+                 num_candidates: int = HYBRID_CANDIDATES):
+        valid_fusion = ["rrf", "weighted"]
+        if fusion not in valid_fusion:
+            raise ValueError(f"fusion must be one of {valid_fusion}, got {fusion}")
+        self.embedding_system = embedding_system
+        self.bm25 = bm25 if bm25 is not None else BM25Search()
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.dense_weight = dense_weight
+        self.num_candidates = num_candidates
+        self._chunks_by_key = {}
+        # (file_name, chunk_id) -> the chunk's row in the dense index (its position in the indexed chunks)
+        self._rows_by_key = {}
+        # The row of every BM25 doc among the indexed chunks (-1 if not loaded), built on the first filter
+        self._bm25_rows = None
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+    def index_chunks(self, embedded_chunks: List[Dict], update_bm25: bool = True) -> None:
+        """Index embedded chunks in both retrievers
+
+        Args:
+            embedded_chunks (List[Dict]): chunks that each have a "chunk_embeddings" vector
+            update_bm25 (bool, optional): add the chunks to the BM25 index. Pass False when it
+                was loaded from disk and already holds them.
+        """
+        self.embedding_system.ensure_index(embedded_chunks)
+        if update_bm25:
+            self.bm25.add_chunks(embedded_chunks)
+        self._chunks_by_key = {}
+        self._rows_by_key = {}
+        for row, chunk in enumerate(embedded_chunks):
+            key = (chunk["file_name"], chunk["chunk_id"])
+            self._chunks_by_key[key] = chunk
+            self._rows_by_key[key] = row
+        self._bm25_rows = None
+
+    def search(self, query: str, top_k: int = TOP_K_RESULTS) -> List[Dict]:
+        """Find the top_k chunks for a query by fusing dense and BM25 results
+
+        Args:
+            query (str): the user query
+            top_k (int, optional): number of chunks to return. Defaults to TOP_K_RESULTS.
+
+        Returns:
+            List[Dict]: copies of the top_k chunks, best first, each with a "fused_score" and the
+            "retriever_scores" ({"dense": ..., "bm25": ...}) of the retrievers that found it
+        """
+        return self.search_many([query], top_k)[0]
+
+    def search_many(self,
+                    queries: List[str],
+                    top_k: int = TOP_K_RESULTS,
+                    query_embeddings: Optional[List[List[float]]] = None,
+                    row_mask: Optional[np.ndarray] = None) -> List[List[Dict]]:
+        """Same as search for many queries, with one embed call and one matrix product for all of them
+
+        Args:
+            query_embeddings (List[List[float]], optional): embeddings of the queries, if the caller
+                already has them. Defaults to embedding the queries here.
+            row_mask (np.ndarray, optional): bool per indexed chunk (e.g. MetadataIndex.mask), both
+                retrievers only score the chunks that are True. Defaults to every chunk.
+
+        Returns:
+            List[List[Dict]]: the top_k fused chunks for each query
+        """
+        if not queries:
+            return []
+        num_candidates = max(top_k, self.num_candidates)
+        # 1. Query both retrievers concurrently (the dense side waits on the embedding API)
+        dense_future = self._executor.submit(self._dense_candidates, queries, num_candidates, query_embeddings,
+                                             row_mask)
+        doc_mask = self._bm25_doc_mask(row_mask)
+        bm25_rankings = [self._bm25_candidates(query, num_candidates, doc_mask) for query in queries]
+        dense_rankings = dense_future.result()
+        return [self._fuse({"dense": dense_ranking, "bm25": bm25_ranking}, top_k)
+                for dense_ranking, bm25_ranking in zip(dense_rankings, bm25_rankings)]
+
+    def _fuse(self, rankings: Dict[str, List], top_k: int) -> List[Dict]:
+        # 2. Fuse the rankings
+        if self.fusion == "rrf":
+            fused_scores = self._reciprocal_rank_fusion(rankings)
+        else:
+            fused_scores = self._weighted_score_fusion(rankings)
+
+        # 3. Return the top_k chunks with the score each retriever gave them
+        retriever_scores = {}
+        for retriever, ranking in rankings.items():
+            for key, score in ranking:
+                retriever_scores.setdefault(key, {})[retriever] = score
+        best_keys = sorted(fused_scores, key=fused_scores.get, reverse=True)[:top_k]
+        return [{**self._chunks_by_key[key],
+                 "fused_score": fused_scores[key],
+                 "retriever_scores": retriever_scores[key]}
+                for key in best_keys]
+
+    def _dense_candidates(self,
+                          queries: List[str],
+                          num_candidates: int,
+                          query_embeddings: Optional[List[List[float]]] = None,
+                          row_mask: Optional[np.ndarray] = None) -> List[List[Tuple[Tuple[str, int], float]]]:
+        results = self.embedding_system.similarity_search_many_with_scores(queries, top_k=num_candidates,
+                                                                           query_embeddings=query_embeddings,
+                                                                           row_mask=row_mask)
+        return [[((chunk["file_name"], chunk["chunk_id"]), score) for chunk, score in query_results]
+                for query_results in results]
+
+    def _bm25_doc_mask(self, row_mask: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        # Translate a mask over the indexed chunks to one over the BM25 doc ids
+        if row_mask is None:
+            return None
+        if self._bm25_rows is None or len(self._bm25_rows) != len(self.bm25):
+            self._bm25_rows = np.array([self._rows_by_key.get(key, -1) for key in self.bm25.doc_keys()],
+                                       dtype=np.int64)
+        doc_mask = np.zeros(len(self._bm25_rows), dtype=bool)
+        loaded = self._bm25_rows >= 0
+        doc_mask[loaded] = row_mask[self._bm25_rows[loaded]]
+        return doc_mask
+
+    def _bm25_candidates(self,
+                         query: str,
+                         num_candidates: int,
+                         doc_mask: Optional[np.ndarray] = None) -> List[Tuple[Tuple[str, int], float]]:
+        # The persisted BM25 index can hold files that are not loaded right now, skip those
+        num_unloaded = max(len(self.bm25) - len(self._chunks_by_key), 0)
+        results = self.bm25.search(query, top_k=num_candidates + num_unloaded, doc_mask=doc_mask)
+        ranking = [((result["file_name"], result["chunk_id"]), result["score"]) for result in results]
+        return [(key, score) for key, score in ranking if key in self._chunks_by_key][:num_candidates]
+
+    def _reciprocal_rank_fusion(self, rankings: Dict[str, List]) -> Dict[Tuple[str, int], float]:
+        # score = sum over retrievers of 1 / (rrf_k + rank)
+        fused_scores = {}
+        for ranking in rankings.values():
+            for rank, (key, _) in enumerate(ranking, start=1):
+                fused_scores[key] = fused_scores.get(key, 0.0) + 1.0 / (self.rrf_k + rank)
+        return fused_scores
+
+    def _weighted_score_fusion(self, rankings: Dict[str, List]) -> Dict[Tuple[str, int], float]:
+        # Min-max normalize each retriever's scores to [0, 1], then take a weighted sum
+        weights = {"dense": self.dense_weight, "bm25": 1.0 - self.dense_weight}
+        fused_scores = {}
+        for retriever, ranking in rankings.items():
+            if not ranking:
+                continue
+            scores = [score for _, score in ranking]
+            low, high = min(scores), max(scores)
+            for key, score in ranking:
+                normalized = (score - low) / (high - low) if high > low else 1.0
+                fused_scores[key] = fused_scores.get(key, 0.0) + weights[retriever] * normalized
+        return fused_scores
@@ -0,0 +1,271 @@
+# Compress normalized embeddings (int8 scalar or product quantization) for approximate scoring
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from config.config import INDEXES_DIR, PQ_SUBVECTORS
+from utils import file_utils
+from utils.vector_utils import exact_search, recall_at_k, rerank, top_k_indices
+
+QUANTIZED_INDEX_FILE = "quantized_index.npz"
+# Rows scored per step, bounds the float32 copy of the codes that scoring makes
+SCORE_BATCH_SIZE = 65536
+
+
+class ScalarQuantizer:
+    """
+    int8 scalar quantization: every dimension is mapped linearly from its [min, max]
+    onto 0..255, so a vector takes 1 byte per dimension instead of 4
+    """
+    kind = "int8"
+
+    def __init__(self):
+        self.minimums = None
+        self.scales = None
+        self.codes = None
+
+    def train(self, normalized_matrix: np.ndarray) -> None:
+        self.minimums = normalized_matrix.min(axis=0).astype(np.float32)
+        self.scales = ((normalized_matrix.max(axis=0) - self.minimums) / 255).astype(np.float32)
+        self.scales[self.scales == 0] = 1.0
+
+    def encode(self, normalized_matrix: np.ndarray) -> None:
+        self.codes = np.clip(np.rint((normalized_matrix - self.minimums) / self.scales), 0, 255).astype(np.uint8)
+
+    def score(self, normalized_queries: np.ndarray) -> np.ndarray:
+        """Approximate cosine similarity of every query with every encoded row"""
+        # q . x ~= (q * scale) . code + q . min
+        queries = np.atleast_2d(normalized_queries)
+        scaled_queries = queries * self.scales
+        offsets = queries @ self.minimums
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), SCORE_BATCH_SIZE):
+            codes = self.codes[start:start + SCORE_BATCH_SIZE].astype(np.float32)
+            scores[:, start:start + SCORE_BATCH_SIZE] = scaled_queries @ codes.T
+        return scores + offsets[:, None]
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.codes.shape[1] if self.codes is not None else 0
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"minimums": self.minimums, "scales": self.scales, "codes": self.codes}
+
+    def load_arrays(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.minimums = arrays["minimums"]
+        self.scales = arrays["scales"]
+        self.codes = arrays["codes"]
+
+
+class ProductQuantizer:
+    """
+    Product quantization: the vector is split into num_subvectors pieces and each piece
+    is replaced by the id (1 byte) of its nearest of 256 centroids learned with k-means
+    """
+    kind = "pq"
+
+    def __init__(self, num_subvectors: int = PQ_SUBVECTORS, num_centroids: int = 256,
+                 kmeans_iterations: int = 10, seed: int = 0):
+        self.num_subvectors = num_subvectors
+        self.num_centroids = num_centroids
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.split_points = None
+        self.codebooks = []
+        self.codes = None
+
+    def train(self, normalized_matrix: np.ndarray) -> None:
+        rng = np.random.default_rng(self.seed)
+        num_rows, dim = normalized_matrix.shape
+        self.num_subvectors = min(self.num_subvectors, dim)
+        self.split_points = np.linspace(0, dim, self.num_subvectors + 1).astype(np.int64)
+        num_centroids = min(self.num_centroids, num_rows)
+        sample = normalized_matrix[rng.choice(num_rows, min(num_rows, 256 * num_centroids), replace=False)]
+        self.codebooks = [_kmeans(sample[:, start:end], num_centroids, self.kmeans_iterations, rng)
+                          for start, end in zip(self.split_points[:-1], self.split_points[1:])]
+
+    def encode(self, normalized_matrix: np.ndarray) -> None:
+        self.codes = np.empty((len(normalized_matrix), self.num_subvectors), dtype=np.uint8)
+        for m, (start, end) in enumerate(zip(self.split_points[:-1], self.split_points[1:])):
+            self.codes[:, m] = _nearest_centroids(normalized_matrix[:, start:end], self.codebooks[m])
+
+    def score(self, normalized_queries: np.ndarray) -> np.ndarray:
+        """Approximate cosine similarity of every query with every encoded row"""
+        # Asymmetric distance computation: a lookup table of query piece . centroid per subvector,
+        # then every row's score is the sum of its num_subvectors table entries
+        queries = np.atleast_2d(normalized_queries)
+        scores = np.zeros((len(queries), len(self.codes)), dtype=np.float32)
+        for m, (start, end) in enumerate(zip(self.split_points[:-1], self.split_points[1:])):
+            lookup_table = queries[:, start:end] @ self.codebooks[m].T
+            scores += lookup_table[:, self.codes[:, m]]
+        return scores
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.num_subvectors
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"split_points": self.split_points, "codes": self.codes}
+        for m, codebook in enumerate(self.codebooks):
+            arrays[f"codebook_{m}"] = codebook
+        return arrays
+
+    def load_arrays(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.split_points = arrays["split_points"]
+        self.num_subvectors = len(self.split_points) - 1
+        self.codebooks = [arrays[f"codebook_{m}"] for m in range(self.num_subvectors)]
+        self.codes = arrays["codes"]
+
+
+QUANTIZERS = {"int8": ScalarQuantizer, "pq": ProductQuantizer}
+
+
+class QuantizedIndex:
+    """
+    Scores queries against compressed codes, then re-scores a shortlist of the best
+    candidates at full precision before returning the top_k
+    """
+
+    def __init__(self, kind: str, num_candidates: int = 100):
+        if kind not in QUANTIZERS:
+            raise ValueError(f"Quantization must be one of {list(QUANTIZERS)}, got {kind}")
+        self.quantizer = QUANTIZERS[kind]()
+        self.num_candidates = num_candidates
+        self.fingerprint = None
+
+    def __len__(self) -> int:
+        codes = self.quantizer.codes
+        return 0 if codes is None else len(codes)
+
+    def build(self, normalized_matrix: np.ndarray, fingerprint: Optional[str] = None) -> None:
+        """Train the quantizer on the matrix and encode every row"""
+        self.fingerprint = fingerprint
+        self.quantizer.train(normalized_matrix)
+        self.quantizer.encode(normalized_matrix)
+
+    def search(self, get_full_vectors, normalized_queries: np.ndarray, top_k: int,
+               row_mask: Optional[np.ndarray] = None):
+        """Find the top_k rows for each query
+
+        Args:
+            get_full_vectors (Callable[[np.ndarray], np.ndarray]): returns the normalized full precision
+                vectors of some rows, used to re-score the shortlist
+            normalized_queries (np.ndarray): normalized query vectors
+            top_k (int): number of rows to return per query
+            row_mask (np.ndarray, optional): bool per row, only the True rows can be returned
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (num_queries, top_k) row indices and their cosine similarities
+        """
+        queries = np.atleast_2d(normalized_queries)
+        scores = self.quantizer.score(queries)
+        num_candidates = max(top_k, self.num_candidates)
+        if row_mask is not None:
+            # Mask the approximate scores so the shortlist only holds rows that pass the filter
+            scores = np.where(row_mask, scores, -np.inf)
+            num_candidates = min(num_candidates, int(row_mask.sum()))
+        shortlists = top_k_indices(scores, num_candidates)
+        return rerank(shortlists, queries, get_full_vectors, top_k)
+
+    def save(self, index_dir: str = INDEXES_DIR) -> None:
+        """Save the codes and codebooks to one binary .npz file in index_dir"""
+        file_utils.ensure_directory_exists(index_dir)
+        path = Path(index_dir) / QUANTIZED_INDEX_FILE
+        tmp_path = path.with_name(QUANTIZED_INDEX_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     kind=np.frombuffer(self.quantizer.kind.encode("utf-8"), dtype=np.uint8),
+                     fingerprint=np.frombuffer((self.fingerprint or "").encode("utf-8"), dtype=np.uint8),
+                     **self.quantizer.arrays())
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, index_dir: str = INDEXES_DIR, num_candidates: int = 100) -> Optional["QuantizedIndex"]:
+        """Load an index saved with save(), or None if there is no saved index"""
+        path = Path(index_dir) / QUANTIZED_INDEX_FILE
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            index = cls(data["kind"].tobytes().decode("utf-8"), num_candidates)
+            index.fingerprint = data["fingerprint"].tobytes().decode("utf-8") or None
+            index.quantizer.load_arrays({key: data[key] for key in data.files})
+        return index
+
+
+def quantization_report(normalized_matrix: np.ndarray,
+                        normalized_queries: np.ndarray,
+                        kinds: Iterable[str] = ("int8", "pq"),
+                        top_k: int = 10,
+                        num_candidates: int = 100) -> List[Dict]:
+    """Measure memory per vector and recall@top_k of each quantizer against exact float32 search
+
+    Returns:
+        List[Dict]: one row per quantizer with "kind", "bytes_per_vector", "compression",
+        "recall_codes_only", "recall_rescored" and "latency_ms"
+    """
+    exact_idxs, _ = exact_search(normalized_matrix, normalized_queries, top_k)
+    float_bytes = normalized_matrix.shape[1] * 4
+    report = []
+    for kind in kinds:
+        index = QuantizedIndex(kind, num_candidates)
+        index.build(normalized_matrix)
+        codes_only_idxs = top_k_indices(index.quantizer.score(normalized_queries), top_k)
+        start = time.perf_counter()
+        rescored_idxs, _ = index.search(lambda rows: normalized_matrix[rows], normalized_queries, top_k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(normalized_queries)
+        report.append({"kind": kind,
+                       "bytes_per_vector": index.quantizer.bytes_per_vector,
+                       "compression": float_bytes / index.quantizer.bytes_per_vector,
+                       "recall_codes_only": recall_at_k(codes_only_idxs, exact_idxs),
+                       "recall_rescored": recall_at_k(rescored_idxs, exact_idxs),
+                       "latency_ms": latency_ms})
+    return report
+
+
+def _kmeans(vectors: np.ndarray, num_centroids: int, iterations: int, rng) -> np.ndarray:
+    # Plain (Euclidean) k-means, used to learn the codebook of one subvector
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), num_centroids, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest_centroids(vectors, centroids)
+        counts = np.bincount(assignments, minlength=num_centroids)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(vectors[np.argsort(assignments, kind="stable")],
+                                           starts[counts > 0], axis=0)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
+
+
+def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin ||x - c||^2 == argmax (x . c - ||c||^2 / 2)
+    half_norms = 0.5 * np.sum(centroids ** 2, axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCORE_BATCH_SIZE):
+        batch = np.asarray(vectors[start:start + SCORE_BATCH_SIZE], dtype=np.float32)
+        assignments[start:start + SCORE_BATCH_SIZE] = np.argmax(batch @ centroids.T - half_norms, axis=1)
+    return assignments
+
+
+def main():
+    # Print memory per vector and recall of each quantizer on the stored embeddings
+    from src.embeddings_io import EmbeddingsIO
+    from utils.vector_utils import normalize_rows
+
+    matrix, _ = EmbeddingsIO.load_store()
+    if matrix is None:
+        print("No embeddings stored yet")
+        return
+    matrix = normalize_rows(matrix)
+    queries = matrix[np.random.default_rng(0).choice(len(matrix), min(100, len(matrix)), replace=False)]
+    for row in quantization_report(matrix, queries):
+        print(f"{row['kind']:>4}: {row['bytes_per_vector']} bytes/vector ({row['compression']:.0f}x smaller)  "
+              f"recall@10 codes only={row['recall_codes_only']:.3f}  rescored={row['recall_rescored']:.3f}  "
+              f"latency={row['latency_ms']:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
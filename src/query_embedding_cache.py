@@ -0,0 +1,121 @@
+# Exact cache of query embeddings: in-process LRU backed by an optional SQLite file
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config.config import QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_FILE, QUERY_EMBEDDING_CACHE_DISK_ENTRIES
+from src.embeddings_io import EmbeddingsIO
+from utils import file_utils
+
+
+class QueryEmbeddingCache:
+    """
+    Embeddings keyed by (text, model, input_type). The most recently used max_entries live in
+    memory; with a path, every embedding is also written to a SQLite file so later processes
+    (the REPL, evaluations, the server) skip the embed call for queries seen before.
+    """
+
+    def __init__(self,
+                 max_entries: int = QUERY_EMBEDDING_CACHE_SIZE,
+                 path: Optional[str] = QUERY_EMBEDDING_CACHE_FILE,
+                 max_disk_entries: int = QUERY_EMBEDDING_CACHE_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    @staticmethod
+    def key(text: str, model: str, input_type: str) -> str:
+        return EmbeddingsIO.content_hash(text, model, input_type)
+
+    def get_many(self, texts: List[str], model: str, input_type: str) -> Dict[str, List[float]]:
+        """Get the cached embedding of every text that has one
+
+        Returns:
+            Dict[str, List[float]]: text -> embedding, only for the texts found in the cache
+        """
+        found = {}
+        with self._lock:
+            disk_keys = {}
+            for text in texts:
+                key = self.key(text, model, input_type)
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[text] = self._memory[key]
+                    self.stats["hits"] += 1
+                else:
+                    disk_keys[key] = text
+            # Look the rest up on disk and promote what we find into memory
+            for key, embedding in self._read_disk(list(disk_keys)).items():
+                found[disk_keys[key]] = embedding
+                self._remember(key, embedding)
+                self.stats["disk_hits"] += 1
+            self.stats["misses"] += sum(text not in found for text in disk_keys.values())
+        return found
+
+    def put_many(self, embeddings: Dict[str, List[float]], model: str, input_type: str) -> None:
+        """Cache the embeddings of some texts (text -> embedding)"""
+        with self._lock:
+            rows = []
+            for text, embedding in embeddings.items():
+                key = self.key(text, model, input_type)
+                self._remember(key, list(embedding))
+                rows.append((key, np.asarray(embedding, dtype=np.float32).tobytes(), time.time()))
+            self._write_disk(rows)
+
+    def metrics(self) -> Dict:
+        """Hits (memory and disk), misses, hit rate and size of the cache"""
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hit_rate = (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.0
+        return {**self.stats, "hit_rate": hit_rate, "entries": len(self._memory)}
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        if self._connection is None:
+            file_utils.ensure_directory_exists(Path(self.path).parent)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS query_embeddings "
+                                     "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)")
+        return self._connection
+
+    def _read_disk(self, keys: List[str]) -> Dict[str, List[float]]:
+        if not keys or self.path is None or not Path(self.path).exists():
+            return {}
+        db = self._db()
+        placeholders = ",".join("?" * len(keys))
+        rows = db.execute(f"SELECT key, embedding FROM query_embeddings WHERE key IN ({placeholders})", keys).fetchall()
+        if rows:
+            with db:
+                db.executemany("UPDATE query_embeddings SET last_used = ? WHERE key = ?",
+                               [(time.time(), key) for key, _ in rows])
+        return {key: np.frombuffer(blob, dtype=np.float32).tolist() for key, blob in rows}
+
+    def _write_disk(self, rows: List) -> None:
+        db = self._db()
+        if db is None or not rows:
+            return
+        with db:
+            db.executemany("INSERT OR REPLACE INTO query_embeddings (key, embedding, last_used) VALUES (?, ?, ?)", rows)
+            # Keep the file bounded: drop the least recently used rows once it is 10% over the limit
+            (num_rows,) = db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()
+            if num_rows > self.max_disk_entries * 1.1:
+                db.execute("DELETE FROM query_embeddings WHERE key NOT IN "
+                           "(SELECT key FROM query_embeddings ORDER BY last_used DESC LIMIT ?)", (self.max_disk_entries,))
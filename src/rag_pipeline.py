@@ -1,24 +1,64 @@
 # Main RAG orchestration logic
-import anthropic
-from typing import List, Dict, Optional
+import asyncio
+import time
+from collections import deque
+from itertools import chain
+from typing import AsyncIterator, Iterator, List, Dict, Optional, Tuple
 from pathlib import Path
 
+import numpy as np
+
 from src.document_loader import DocumentLoader
 from src.chunker import TextChunker
+from src.dedup import iter_unique_chunks
 from src.embeddings import EmbeddingSystem
+from src.embeddings_io import EmbeddingsIO
+from src.bm25 import BM25Search
+from src.multi_index import MultiIndex
+from src.answer_cache import SemanticAnswerCache
+from src.context_builder import ContextBuilder, ChunkPositionIndex
+from src.ann_index import chunk_fingerprint
+from src.snapshot import save_snapshot, load_snapshot
+from src.metadata_filter import MetadataIndex
+from utils.text_processing import estimate_tokens
+
+from config.logging_config import telemetry
 
 from config.config import *
 
+# Instructions every query shares, the first block of the system prompt
+SYSTEM_PROMPT = ("Answer the user query only using the pieces of information in <information> as context, "
+                 "without using any external data. SUMMARIZE YOUR ANSWER. DO NOT QUOTE THE SOURCES.")
+
 
 class RAGSystem:
-    def __init__(self):
-        # Initialize the anthorpic client
-        self.client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+    def __init__(self, anthropic_client=None, async_anthropic_client=None, voyageai_client=None):
+        # Initialize the anthorpic clients (the async one is used by aquery/aquery_stream). anthropic
+        # is slow to import, so it is only imported when a real client is needed
+        if anthropic_client is None or async_anthropic_client is None:
+            import anthropic
+            anthropic_client = anthropic_client or anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+            async_anthropic_client = async_anthropic_client or anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+        self.client = anthropic_client
+        self.async_client = async_anthropic_client
         # Initialize an object for every class we've made to help in the RAG Pipeline
         self.document_loader = DocumentLoader()
         self.text_chunker = TextChunker()
-        self.embedding_system = EmbeddingSystem()
+        self.embedding_system = EmbeddingSystem(voyageai_client)
+        # Hybrid retrieval: dense embeddings + the BM25 index persisted in INDEXES_DIR
+        self.multi_index = MultiIndex(self.embedding_system, BM25Search.load() or BM25Search())
         self.embedded_chunks = None
+        # Retrieval time, time to first token and total latency of the most recent queries
+        self.query_timings = deque(maxlen=QUERY_TIMINGS_KEPT)
+        # Answers to earlier queries, reused for paraphrases of them (None disables the cache)
+        self.answer_cache = SemanticAnswerCache() if ANSWER_CACHE_THRESHOLD is not None else None
+        # Packs the retrieved chunks into the prompt within CONTEXT_TOKEN_BUDGET
+        self.context_builder = ContextBuilder()
+        # (file_name, chunk_id) -> stored chunk, to add the neighbours of retrieved chunks to the context
+        self.chunk_positions = None
+        # The rows of every file name, extension, chunking mode and tag, to filter queries without
+        # re-indexing (built by the first filtered query)
+        self.metadata_index = None
         
         
     def embed_documents(self, 
@@ -43,7 +83,7 @@ class RAGSystem:
         #print("----Chunking Documents----")
         # Get how to chunk each document
         document_chunk_by = {}
-        print('Press "c" for "Character" and "s" for "Sentence"')
+        print('Press "c" for "Character", "s" for "Sentence" and "t" for "Token"')
         for file_name in file_names:
             while True:
                 chunk_by = input(f"Chunk '{file_name}' by: ").lower().strip()
@@ -53,6 +93,9 @@ class RAGSystem:
                 elif chunk_by == "s":
                     chunk_by = "sentence"
                     break
+                elif chunk_by == "t":
+                    chunk_by = "token"
+                    break
                 else:
                     continue
             document_chunk_by[file_name] = chunk_by
@@ -65,121 +108,318 @@ class RAGSystem:
                 "text": document_texts[file_name],
                 "chunk_by": document_chunk_by[file_name]
                 }
-            if chunk_size:
+            if chunk_size is not None:
                 kwargs["chunk_size"] = chunk_size
-            if chunk_overlap:
+            if chunk_overlap is not None:
                 kwargs["chunk_overlap"] = chunk_overlap
                 
-            document_chunks = self.text_chunker.chunk_document(**kwargs)
-            chunked_documents.extend(document_chunks)
+            # Offsets only, the chunk texts are sliced out when they are embedded
+            chunk_records = self.text_chunker.chunk_records(**kwargs)
+            chunked_documents.append(chunk_records)
+            print(f"'{file_name}': {len(chunk_records)} chunks, ~{chunk_records.total_tokens()} tokens")
+        total_tokens = sum(chunk_records.total_tokens() for chunk_records in chunked_documents)
+        print(f"~{total_tokens} tokens to embed across {len(file_names)} files (before cached chunks are skipped)")
         
         # Calculate the embeddings for each chunk in each document
         #print("----Calculating Embeddings----")
-        self.embedded_chunks = self.embedding_system.embed_chunks(chunked_documents)
+        # Collapse near-duplicate chunks (repeated boilerplate) so each is embedded and indexed once
+        duplicate_sources = {}
+        unique_chunks = iter_unique_chunks(chain.from_iterable(chunked_documents), duplicate_sources)
+        self.embedded_chunks = self.embedding_system.embed_chunks(unique_chunks, duplicate_sources=duplicate_sources)
+        
+        # Update the keyword index with these chunks and save it for next time
+        if RETRIEVAL_MODE == "hybrid":
+            self.multi_index.index_chunks(self.embedded_chunks)
+            self.multi_index.bm25.save()
+        self._index_loaded()
         
         print("-----------------------------------------------------------------------------------")
         print(f"System initialized with {len(self.embedded_chunks)} chunks from {len(file_names)} files")
         print("-----------------------------------------------------------------------------------")
         
             
+    def load_index(self) -> int:
+        """Load the chunks ingested earlier (python -m src.ingest) instead of re-embedding documents
+
+        The dense and keyword indexes saved with them are reused when they match the chunks, and
+        with WARM_START_SNAPSHOT the whole built state is restored while the store is unchanged
+
+        Returns:
+            int: number of chunks loaded
+        """
+        if WARM_START_SNAPSHOT and self._restore_snapshot():
+            return len(self.embedded_chunks)
+        
+        self.embedded_chunks = EmbeddingsIO.load_files_embeddings(EmbeddingsIO.stored_files())
+        if RETRIEVAL_MODE == "hybrid":
+            # Only re-index keywords if the saved BM25 index is missing some of the files
+            stored_files = {chunk["file_name"] for chunk in self.embedded_chunks}
+            self.multi_index.index_chunks(self.embedded_chunks,
+                                          update_bm25=not stored_files <= self.multi_index.bm25.indexed_files())
+        else:
+            self.embedding_system.index_chunks(self.embedded_chunks)
+        fingerprint = chunk_fingerprint(self.embedded_chunks)
+        self._index_loaded(fingerprint)
+        if WARM_START_SNAPSHOT:
+            save_snapshot(self.embedding_system, self.multi_index.bm25 if RETRIEVAL_MODE == "hybrid" else None,
+                          fingerprint)
+        return len(self.embedded_chunks)
+    
+    
+    def _restore_snapshot(self) -> bool:
+        # Adopt the chunks and indexes of the snapshot instead of rebuilding them
+        snapshot = load_snapshot()
+        if snapshot is None:
+            return False
+        self.embedded_chunks = snapshot["chunks"]
+        self.embedding_system.restore_index(self.embedded_chunks, snapshot["search_matrix"],
+                                            snapshot["ann_index"], snapshot["quantized_index"])
+        if snapshot["bm25"] is not None:
+            self.multi_index.bm25 = snapshot["bm25"]
+            self.multi_index.index_chunks(self.embedded_chunks, update_bm25=False)
+        self._index_loaded(snapshot["fingerprint"])
+        return True
+        
+        
     def _get_specified_files(self, 
                              only_include: Optional[List[str]] = None, 
                              exclude_documents: Optional[List[str]] = None):
         # Get a list of the file name of every document in the documents directory
-        file_names = []
-        for file in Path(DOCUMENTS_DIR).glob("*"):
-            file_names.append(file.name)
+        file_names = [file.name for file in Path(DOCUMENTS_DIR).glob("*")]
             
-        # Exclude the specified documents that were inputted
-        if exclude_documents:
-            for file_name in file_names:
-                for excluded_document in exclude_documents:
-                    if file_name == excluded_document:
-                        file_names.remove(file_name)
-                    
-        # If the user specified to only include certain file names return only those
-        included_file_names = []
-        if only_include:
-            for file_name in file_names:
-                for included_document in only_include:
-                    if file_name == included_document:
-                        included_file_names.append(file_name)
-            return included_file_names
-        else:
-            return file_names
+        # Exclude the specified documents, and if the user specified to only include certain
+        # file names keep only those (query-time filters are in MetadataIndex)
+        excluded = set(exclude_documents or ())
+        included = set(only_include or ())
+        return [file_name for file_name in file_names
+                if file_name not in excluded and (not included or file_name in included)]
         
     
-    def query(self, user_query: str) -> str:
+    def query(self, user_query: str, filters: Optional[Dict] = None) -> str:
         """Answer a user query using engineered RAG pipline"""
-        # 1. Find the TOP_K_RESULT relavent chunks
-        relavent_chunks = self.embedding_system.similarity_search(query=user_query,
-                                                                  embedded_chunks=self.embedded_chunks,
-                                                                  top_k=TOP_K_RESULTS)
-        # 2. Combine all chunks into a string to put into prompt
-        chunks_combined = self._combine_chunks(relavent_chunks)
-        
-        # 3. Create the query string
-        prompt = self._create_prompt(user_query, chunks_combined)
-        
-        # 4. Get an answer from claude
-        response = self.client.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=1000,
-            messages=[{"role": "user",
-                       "content": prompt}]
-        )
-        
-        return response.content[0].text
-        
+        # A sampled fraction of queries runs under cProfile (PROFILE_SAMPLE_RATE)
+        with telemetry.profile("query"):
+            return "".join(self.query_stream(user_query, filters))
+    
+    
+    def query_stream(self, user_query: str, filters: Optional[Dict] = None) -> Iterator[str]:
+        """Answer a user query, yielding the text of the answer as Claude generates it
 
+        Args:
+            user_query (str): the user query
+            filters (Dict, optional): only retrieve chunks that pass these metadata filters (see
+                MetadataIndex.mask), e.g. {"extension": [".pdf"], "tags": ["course"]}. Defaults to none.
 
-    def _combine_chunks(self, chunks: List[Dict]) -> str:
-        return "\n\n".join([chunk["chunk_content"] for chunk in chunks])
+        Returns:
+            Iterator[str]: pieces of the answer, in order
+        """
+        with telemetry.span("query") as span:
+            timings = self._start_timings(user_query)
+            # 1. Embed the query and retrieve the relavent chunks
+            query_embedding, relavent_chunks = self.embed_and_retrieve_many([user_query], filters)[0]
+            timings["retrieval_seconds"] = time.perf_counter() - timings["start"]
+            
+            try:
+                # 2. Reuse the answer to a similar query that was answered from the same chunks
+                cached_answer = self._cached_answer(query_embedding, relavent_chunks, timings)
+                if cached_answer is not None:
+                    yield cached_answer
+                    return
+                
+                # 3. Stream the answer from claude
+                answer = []
+                params = self._message_params(user_query, relavent_chunks)
+                with telemetry.span("generate", chunks=len(relavent_chunks)):
+                    with self.client.messages.stream(**params) as stream:
+                        for text in stream.text_stream:
+                            self._record_token(timings)
+                            answer.append(text)
+                            yield text
+                        final_message = stream.get_final_message()
+                self._count_generation(final_message)
+                self._cache_answer(user_query, query_embedding, relavent_chunks, answer)
+            finally:
+                self._finish_timings(timings, span)
     
     
-    def _create_prompt(self, all_chunks: str, query: str) -> str:
-        return f"""
-        <information>
-        Answer the following user query only using on these peices of information as context without using any external data. SUMMARIZE YOUR ANSWER. DO NOT QUOTE THE SOURCES:
-        {all_chunks}
-        
-        </information>
-        
-        <user_query>
-        {query}
-        </user_query>
+    async def aquery(self, user_query: str, filters: Optional[Dict] = None) -> str:
+        """Async version of query: other queries can run while this one waits on the APIs"""
+        return "".join([text async for text in self.aquery_stream(user_query, filters=filters)])
+    
+    
+    async def aquery_stream(self, 
+                            user_query: str, 
+                            relavent_chunks: Optional[List[Dict]] = None,
+                            query_embedding: Optional[List[float]] = None,
+                            filters: Optional[Dict] = None) -> AsyncIterator[str]:
+        """Async version of query_stream
+
+        Args:
+            user_query (str): the user query
+            relavent_chunks (List[Dict], optional): chunks already retrieved for the query (e.g. in a
+                batch with other queries). Defaults to retrieving them here.
+            query_embedding (List[float], optional): the query's embedding, if it was already embedded
+            filters (Dict, optional): metadata filters of the retrieval (unused if relavent_chunks is given)
+
+        Returns:
+            AsyncIterator[str]: pieces of the answer, in order
         """
+        # (not profiled: cProfile cannot attribute the time spent awaiting to this query)
+        with telemetry.span("query") as span:
+            timings = self._start_timings(user_query)
+            # 1. Embed the query and retrieve in a worker thread so the event loop is never blocked
+            if relavent_chunks is None:
+                query_embedding, relavent_chunks = (await asyncio.to_thread(self.embed_and_retrieve_many,
+                                                                            [user_query], filters))[0]
+            elif query_embedding is None and self.answer_cache is not None:
+                query_embedding = await asyncio.to_thread(self.embedding_system.get_embedding, user_query)
+            timings["retrieval_seconds"] = time.perf_counter() - timings["start"]
             
-            
+            try:
+                # 2. Reuse the answer to a similar query that was answered from the same chunks
+                # (the cache is searched and updated in a worker thread as well)
+                cached_answer = await asyncio.to_thread(self._cached_answer, query_embedding, relavent_chunks, timings)
+                if cached_answer is not None:
+                    yield cached_answer
+                    return
                 
+                # 3. Stream the answer from claude
+                answer = []
+                params = self._message_params(user_query, relavent_chunks)
+                with telemetry.span("generate", chunks=len(relavent_chunks)):
+                    async with self.async_client.messages.stream(**params) as stream:
+                        async for text in stream.text_stream:
+                            self._record_token(timings)
+                            answer.append(text)
+                            yield text
+                        final_message = await stream.get_final_message()
+                self._count_generation(final_message)
+                await asyncio.to_thread(self._cache_answer, user_query, query_embedding, relavent_chunks, answer)
+            finally:
+                self._finish_timings(timings, span)
     
     
+    def retrieve(self, user_query: str, filters: Optional[Dict] = None) -> List[Dict]:
+        """Find the TOP_K_RESULTS relavent chunks for a query"""
+        return self.retrieve_many([user_query], filters=filters)[0]
     
-    # Finish this method to add EXTENDED CONTEXT feature (need to remove chunk overlap)
-    """ 
-    def _build_extended_context(self, 
-                       chunks: List[Dict],
-                       num_start_chunks: int = 4,
-                       num_previous_chunks: int = 3) -> str:
-    
-        # Get the actual start and previous chunks
-        for chunk in chunks:
-            # Check if the chunk and start_chunks will overlap
-            if num_start_chunks-1 >= chunk["id"]:
-                num_start_chunks = chunk["id"]
-                num_previous_chunks = 0
-            # Check if previous chunk and start_chunk will overlap
-            if chunk["id"] - num_previous_chunks <= num_start_chunks-1:
-                num_previous_chunks = chunk["i"] - num_start_chunks
-            # Get the actual chunks if was chunked_by character
-            start_chunks = " ".join(self.embedded_chunks[0:num_start_chunks])
-            previous_chunks = " ".join(self.embedded_chunks[chunk["id"]-num_previous_chunks:chunk["id"]])
-            
-            # Get the actual chunks if was chunked by sentence (Get rid of overlap if chunks right next to each other)
-            
-            
-            chunk["chunk_content"] = start_chunks + " " + previous_chunks + " " + chunk["chunk_content"]
-    """
+    
+    def retrieve_many(self, 
+                      user_queries: List[str], 
+                      query_embeddings: Optional[List[List[float]]] = None,
+                      filters: Optional[Dict] = None) -> List[List[Dict]]:
+        """Find the TOP_K_RESULTS relavent chunks for many queries with one embed call and one matrix product
+
+        Args:
+            filters (Dict, optional): only chunks that pass these metadata filters are scored (see
+                MetadataIndex.mask), the loaded indexes are reused as they are. Defaults to none.
+        """
+        with telemetry.span("retrieve", queries=len(user_queries), mode=RETRIEVAL_MODE):
+            row_mask = self._filter_mask(filters)
+            if RETRIEVAL_MODE == "hybrid":
+                return self.multi_index.search_many(user_queries, top_k=TOP_K_RESULTS,
+                                                    query_embeddings=query_embeddings, row_mask=row_mask)
+            return self.embedding_system.similarity_search_many(user_queries,
+                                                                embedded_chunks=self.embedded_chunks,
+                                                                top_k=TOP_K_RESULTS,
+                                                                query_embeddings=query_embeddings,
+                                                                row_mask=row_mask)
+    
+    
+    def embed_and_retrieve_many(self,
+                                user_queries: List[str],
+                                filters: Optional[Dict] = None) -> List[Tuple[List[float], List[Dict]]]:
+        """Embed many queries with one call, then retrieve their relavent chunks with those embeddings
+
+        Returns:
+            List[Tuple[List[float], List[Dict]]]: (query embedding, relavent chunks) of each query
+        """
+        with telemetry.span("embed_query", queries=len(user_queries)):
+            query_embeddings = self.embedding_system.get_embeddings(user_queries) if user_queries else []
+        return list(zip(query_embeddings, self.retrieve_many(user_queries, query_embeddings, filters)))
+    
+    
+    def _cached_answer(self, query_embedding, relavent_chunks: List[Dict], timings: Dict) -> Optional[str]:
+        if self.answer_cache is None or query_embedding is None:
+            return None
+        cached_answer = self.answer_cache.lookup(query_embedding, relavent_chunks)
+        timings["cached"] = cached_answer is not None
+        if cached_answer is not None:
+            telemetry.increment("answer_cache_hits")
+            self._record_token(timings)
+        return cached_answer
+    
+    
+    def _cache_answer(self, user_query: str, query_embedding, relavent_chunks: List[Dict], answer: List[str]) -> None:
+        if self.answer_cache is not None and query_embedding is not None:
+            self.answer_cache.add(user_query, query_embedding, relavent_chunks, "".join(answer))
+    
+    
+    def close(self) -> None:
+        """Save what is only held in memory (answers cached since the answer cache was last saved)"""
+        if self.answer_cache is not None:
+            self.answer_cache.flush()
+    
+    
+    def _index_loaded(self, fingerprint: Optional[str] = None) -> None:
+        self.chunk_positions = ChunkPositionIndex(self.embedded_chunks)
+        self.metadata_index = None
+        # The answers cached for an older version of the documents no longer apply
+        if self.answer_cache is not None:
+            self.answer_cache.set_corpus(fingerprint or chunk_fingerprint(self.embedded_chunks))
+    
+    
+    def _filter_mask(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        # The rows of the loaded chunks that pass the filters (None when nothing is filtered)
+        if not filters:
+            return None
+        if self.metadata_index is None or self.metadata_index.num_rows != len(self.embedded_chunks):
+            self.metadata_index = MetadataIndex(self.embedded_chunks)
+        return self.metadata_index.mask(filters)
+    
+    
+    @staticmethod
+    def _start_timings(user_query: str) -> Dict:
+        return {"query": user_query, "start": time.perf_counter(), "retrieval_seconds": None,
+                "time_to_first_token": None, "total_seconds": None, "num_chunks_streamed": 0, "cached": False}
+    
+    
+    @staticmethod
+    def _record_token(timings: Dict) -> None:
+        if timings["time_to_first_token"] is None:
+            timings["time_to_first_token"] = time.perf_counter() - timings["start"]
+        timings["num_chunks_streamed"] += 1
+    
+    
+    def _finish_timings(self, timings: Dict, span: Optional[Dict] = None) -> None:
+        timings["total_seconds"] = time.perf_counter() - timings.pop("start")
+        self.query_timings.append(timings)
+        if span is not None:
+            span.update(cached=timings["cached"], retrieval_seconds=timings["retrieval_seconds"],
+                        time_to_first_token=timings["time_to_first_token"])
+    
+    
+    @staticmethod
+    def _count_generation(message) -> None:
+        # The token usage the API reports for the call. input_tokens only counts the part of the prompt
+        # after the last cache breakpoint, so the cache counters show whether prompt caching pays off
+        telemetry.increment("llm_calls")
+        for field in ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens", "output_tokens"):
+            telemetry.increment(field, getattr(message.usage, field, None) or 0)
+
+
+    def _message_params(self, user_query: str, relavent_chunks: List[Dict]) -> Dict:
+        # The instructions and the packed context make up the system prompt, so the prefix that repeats
+        # whenever the same chunks are retrieved again ends right before the query
+        context = f"<information>\n{self.context_builder.build(relavent_chunks, self.chunk_positions)}\n</information>"
+        system = [{"type": "text", "text": SYSTEM_PROMPT}, {"type": "text", "text": context}]
+        # The API ignores breakpoints after a prefix shorter than PROMPT_CACHE_MIN_TOKENS
+        if PROMPT_CACHING and estimate_tokens(SYSTEM_PROMPT + context) >= PROMPT_CACHE_MIN_TOKENS:
+            system[-1]["cache_control"] = {"type": "ephemeral"}
+        return {"model": CLAUDE_MODEL,
+                "max_tokens": 1000,
+                "system": system,
+                "messages": [{"role": "user", "content": f"<user_query>\n{user_query}\n</user_query>"}]}
 
 
 def main():
@@ -0,0 +1,194 @@
+# Local HTTP query service around RAGSystem (python -m src.server)
+import asyncio
+import time
+from typing import Any, Callable, List
+
+from aiohttp import web
+
+from config.config import (SERVER_HOST, SERVER_PORT, QUERY_BATCH_WAIT_MS, QUERY_BATCH_MAX_SIZE,
+                           SERVER_MAX_LLM_CONCURRENCY, SERVER_MAX_PENDING_REQUESTS)
+from config.logging_config import configure_logging, telemetry
+
+
+class QueryBatcher:
+    """
+    Groups the queries that arrive within max_wait_ms of each other (or max_batch_size of them)
+    and retrieves them with one retrieve_many call, i.e. one embed call and one matrix product
+    """
+
+    def __init__(self,
+                 retrieve_many: Callable[[List[str]], List[Any]],
+                 max_wait_ms: float = QUERY_BATCH_WAIT_MS,
+                 max_batch_size: int = QUERY_BATCH_MAX_SIZE):
+        self.retrieve_many = retrieve_many
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.num_batches = 0
+        self.num_queries = 0
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def retrieve(self, query: str) -> Any:
+        """Get retrieve_many's result for one query, retrieved in a batch with any queries that arrive meanwhile"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List) -> None:
+        self.num_batches += 1
+        self.num_queries += len(batch)
+        try:
+            # Embedding and the matrix product run in a worker thread so the event loop is never blocked
+            results = await asyncio.to_thread(self.retrieve_many, [query for query, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class QueryServer:
+    """
+    Answers POST /query requests ({"query": ..., "stream": false}) with a RAGSystem whose
+    indexes are loaded once. Retrieval is micro-batched across concurrent requests, at most
+    max_llm_concurrency answers are generated at a time, and once max_pending_requests are
+    being handled new requests get a 503 with Retry-After instead of queueing without bound.
+    """
+
+    def __init__(self,
+                 rag_system,
+                 max_llm_concurrency: int = SERVER_MAX_LLM_CONCURRENCY,
+                 max_pending_requests: int = SERVER_MAX_PENDING_REQUESTS,
+                 batch_wait_ms: float = QUERY_BATCH_WAIT_MS,
+                 max_batch_size: int = QUERY_BATCH_MAX_SIZE):
+        self.rag_system = rag_system
+        self.max_llm_concurrency = max_llm_concurrency
+        self.max_pending_requests = max_pending_requests
+        self.batcher = QueryBatcher(rag_system.embed_and_retrieve_many, batch_wait_ms, max_batch_size)
+        self.num_pending = 0
+        self.num_rejected = 0
+        self._llm_semaphore = None
+
+    def create_app(self) -> web.Application:
+        """Build the aiohttp application"""
+        app = web.Application()
+        app.router.add_post("/query", self.handle_query)
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_cleanup(self, app: web.Application) -> None:
+        await asyncio.to_thread(self.rag_system.close)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok",
+                                  "chunks": len(self.rag_system.embedded_chunks or []),
+                                  "pending_requests": self.num_pending,
+                                  "rejected_requests": self.num_rejected,
+                                  "retrieval_batches": self.batcher.num_batches,
+                                  "batched_queries": self.batcher.num_queries,
+                                  "answer_cache": (self.rag_system.answer_cache.metrics()
+                                                   if self.rag_system.answer_cache is not None else None),
+                                  "query_embedding_cache": self.rag_system.embedding_system.query_cache.metrics()})
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        # Latency percentiles of every pipeline stage and the counters since the server started
+        return web.json_response({"spans": telemetry.summary(), "counters": telemetry.counters()})
+
+    async def handle_query(self, request: web.Request) -> web.StreamResponse:
+        # Backpressure: refuse work we could not start soon instead of queueing it
+        if self.num_pending >= self.max_pending_requests:
+            self.num_rejected += 1
+            return web.json_response({"error": "Too many pending requests"}, status=503,
+                                     headers={"Retry-After": "1"})
+        self.num_pending += 1
+        try:
+            try:
+                body = await request.json()
+            except ValueError:
+                return web.json_response({"error": "Body must be JSON"}, status=400)
+            query = body.get("query") if isinstance(body, dict) else None
+            if not isinstance(query, str) or not query.strip():
+                return web.json_response({"error": "\"query\" must be a non-empty string"}, status=400)
+            filters = body.get("filters")
+            if filters is not None and not isinstance(filters, dict):
+                return web.json_response({"error": "\"filters\" must be an object"}, status=400)
+            start_time = time.perf_counter()
+
+            # 1. Retrieve in a batch with the other queries that arrive meanwhile (a filtered
+            # query is retrieved on its own, the batch shares one search)
+            if filters:
+                try:
+                    query_embedding, relavent_chunks = (await asyncio.to_thread(
+                        self.rag_system.embed_and_retrieve_many, [query], filters))[0]
+                except ValueError as e:
+                    return web.json_response({"error": str(e)}, status=400)
+            else:
+                query_embedding, relavent_chunks = await self.batcher.retrieve(query)
+            retrieval_seconds = time.perf_counter() - start_time
+
+            # 2. Generate the answer once one of the LLM slots is free
+            if self._llm_semaphore is None:
+                self._llm_semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+            async with self._llm_semaphore:
+                answer_stream = self.rag_system.aquery_stream(query, relavent_chunks, query_embedding)
+                if body.get("stream"):
+                    return await self._stream_answer(request, answer_stream)
+                answer = []
+                time_to_first_token = None
+                async for text in answer_stream:
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start_time
+                    answer.append(text)
+            return web.json_response({"answer": "".join(answer),
+                                      "sources": [{"file_name": chunk["file_name"], "chunk_id": chunk["chunk_id"]}
+                                                  for chunk in relavent_chunks],
+                                      "timings": {"retrieval_seconds": retrieval_seconds,
+                                                  "time_to_first_token": time_to_first_token,
+                                                  "total_seconds": time.perf_counter() - start_time}})
+        finally:
+            self.num_pending -= 1
+
+    @staticmethod
+    async def _stream_answer(request: web.Request, answer_stream) -> web.StreamResponse:
+        # Send the answer as plain text, one HTTP chunk per piece Claude generates
+        response = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        async for text in answer_stream:
+            await response.write(text.encode("utf-8"))
+        await response.write_eof()
+        return response
+
+
+def main():
+    from src.rag_pipeline import RAGSystem
+
+    configure_logging()
+    rag_system = RAGSystem()
+    print(f"Loaded {rag_system.load_index()} chunks")
+    web.run_app(QueryServer(rag_system).create_app(), host=SERVER_HOST, port=SERVER_PORT)
+
+
+if __name__ == "__main__":
+    main()
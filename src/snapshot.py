@@ -0,0 +1,117 @@
+# Warm-start snapshot of the built retrieval state, restored on startup instead of re-indexing the store
+import os
+import pickle
+import shutil
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from config.config import (SNAPSHOT_DIR, EMBEDDING_MODEL, RETRIEVAL_MODE, DENSE_INDEX, ANN_EXACT_THRESHOLD,
+                           ANN_NLIST, QUANTIZATION, PQ_SUBVECTORS, RERANK_CANDIDATES, COARSE_DIMENSIONS)
+from src.ann_index import IVFIndex
+from src.bm25 import BM25Search
+from src.embeddings_io import EmbeddingsIO
+from src.quantization import QuantizedIndex
+
+SNAPSHOT_FILE = "snapshot.pkl"
+SEARCH_MATRIX_FILE = "search_matrix.npy"
+# Bump when the layout of the snapshot changes, older snapshots are then rebuilt
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_settings() -> Dict:
+    """Every setting that shapes the built state, a snapshot is only restored under the same ones
+
+    (Query-time settings such as ANN_NPROBE or RERANK_CANDIDATES are applied to the restored indexes)
+    """
+    return {"embedding_model": EMBEDDING_MODEL, "retrieval_mode": RETRIEVAL_MODE, "dense_index": DENSE_INDEX,
+            "ann_exact_threshold": ANN_EXACT_THRESHOLD, "ann_nlist": ANN_NLIST, "quantization": QUANTIZATION,
+            "pq_subvectors": PQ_SUBVECTORS, "coarse_dimensions": COARSE_DIMENSIONS}
+
+
+def save_snapshot(embedding_system,
+                  bm25: Optional[BM25Search],
+                  fingerprint: str,
+                  snapshot_dir: str = SNAPSHOT_DIR) -> bool:
+    """Save the chunk metadata, search matrix and indexes of an indexed EmbeddingSystem (and the BM25 index)
+
+    The chunk vectors are not copied, the restored chunks point into the memory-mapped embedding store again
+
+    Args:
+        embedding_system (EmbeddingSystem): the system whose index_chunks has been called
+        bm25 (BM25Search, optional): the keyword index over the same chunks (None in dense mode)
+        fingerprint (str): chunk_fingerprint of the indexed chunks
+        snapshot_dir (str, optional): where to save the snapshot. Defaults to SNAPSHOT_DIR.
+
+    Returns:
+        bool: False when there is nothing to save (no chunks, or chunks that are not in the store)
+    """
+    chunks = embedding_system._indexed_chunks
+    store_signature = EmbeddingsIO.store_signature()
+    if not chunks or store_signature is None or any("row" not in chunk for chunk in chunks):
+        return False
+
+    # 1. Write the snapshot into a temporary directory
+    snapshot_path = Path(snapshot_dir)
+    tmp_path = snapshot_path.with_name(snapshot_path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    if embedding_system._normalized_matrix is not None:
+        np.save(tmp_path / SEARCH_MATRIX_FILE, embedding_system._normalized_matrix)
+    if embedding_system.ann_index is not None:
+        embedding_system.ann_index.save(str(tmp_path))
+    if embedding_system.quantized_index is not None:
+        embedding_system.quantized_index.save(str(tmp_path))
+    if bm25 is not None:
+        bm25.save(str(tmp_path))
+    snapshot = {"version": SNAPSHOT_VERSION,
+                "settings": snapshot_settings(),
+                "store": store_signature,
+                "fingerprint": fingerprint,
+                "chunks": [{key: value for key, value in chunk.items() if key != "chunk_embeddings"}
+                           for chunk in chunks]}
+    with open(tmp_path / SNAPSHOT_FILE, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # 2. Swap it in so a crash never leaves half a snapshot
+    old_path = snapshot_path.with_name(snapshot_path.name + ".old")
+    shutil.rmtree(old_path, ignore_errors=True)
+    if snapshot_path.exists():
+        os.replace(snapshot_path, old_path)
+    os.replace(tmp_path, snapshot_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return True
+
+
+def load_snapshot(snapshot_dir: str = SNAPSHOT_DIR) -> Optional[Dict]:
+    """Load a snapshot saved with save_snapshot
+
+    Returns:
+        Optional[Dict]: "chunks" (with their vectors), "fingerprint", "search_matrix" (memory-mapped),
+        "ann_index", "quantized_index" and "bm25", or None if there is no snapshot or it was built
+        from another version of the embedding store or with other settings
+    """
+    snapshot_path = Path(snapshot_dir)
+    if not (snapshot_path / SNAPSHOT_FILE).exists():
+        return None
+    # The snapshot is a local file this module wrote, so it is trusted like the rest of data/
+    with open(snapshot_path / SNAPSHOT_FILE, "rb") as f:
+        snapshot = pickle.load(f)
+    if (snapshot.get("version") != SNAPSHOT_VERSION or snapshot["settings"] != snapshot_settings()
+            or snapshot["store"] != EmbeddingsIO.store_signature()):
+        return None
+
+    # A plain ndarray view of the memory map, its rows are much cheaper to slice than memmap rows
+    matrix = np.asarray(EmbeddingsIO.open_matrix())
+    chunks = snapshot["chunks"]
+    for chunk in chunks:
+        chunk["chunk_embeddings"] = matrix[chunk["row"]]
+    search_matrix_path = snapshot_path / SEARCH_MATRIX_FILE
+    return {"chunks": chunks,
+            "fingerprint": snapshot["fingerprint"],
+            "search_matrix": np.load(search_matrix_path, mmap_mode="r") if search_matrix_path.exists() else None,
+            "ann_index": IVFIndex.load(snapshot_dir) if DENSE_INDEX == "ivf" else None,
+            "quantized_index": (QuantizedIndex.load(snapshot_dir, num_candidates=RERANK_CANDIDATES)
+                                if QUANTIZATION else None),
+            "bm25": BM25Search.load(snapshot_dir) if RETRIEVAL_MODE == "hybrid" else None}
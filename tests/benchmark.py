@@ -0,0 +1,287 @@
+# Offline benchmark of ingest and query on synthetic corpora (python -m tests.benchmark)
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Corpus sizes (in chunks) benchmarked by default
+DEFAULT_SIZES = (10, 1_000, 10_000, 100_000)
+# Synthetic documents are cut into character chunks of this size and overlap
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+# Documents are made long enough for this many chunks each (the last one may be shorter)
+CHUNKS_PER_DOCUMENT = 200
+VOCABULARY_SIZE = 5000
+DEFAULT_OUTPUT_DIR = "data/benchmarks"
+# Stages faster than this (in both runs) are timer noise and not compared
+MIN_COMPARED_SECONDS = 0.01
+
+
+def synthetic_corpus(num_chunks: int, seed: int = 0) -> Dict[str, str]:
+    """Generate .txt documents that together cut into about num_chunks character chunks
+
+    Words are drawn from a fixed vocabulary with a Zipf-like distribution, so keyword and
+    dense search see realistic term frequencies.
+
+    Returns:
+        Dict[str, str]: file name -> text
+    """
+    rng = np.random.default_rng(seed)
+    syllables = np.array(["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "an", "el", "or", "us", "qui", "dre", "ph"])
+    vocabulary = np.array(["".join(rng.choice(syllables, rng.integers(1, 4))) + str(i)
+                           for i in range(VOCABULARY_SIZE)])
+    weights = 1.0 / np.arange(1, VOCABULARY_SIZE + 1)
+    weights /= weights.sum()
+
+    step = CHUNK_SIZE - CHUNK_OVERLAP
+    documents = {}
+    for doc_id in range(math.ceil(num_chunks / CHUNKS_PER_DOCUMENT)):
+        doc_chunks = min(CHUNKS_PER_DOCUMENT, num_chunks - doc_id * CHUNKS_PER_DOCUMENT)
+        # n chunks of CHUNK_SIZE stepping by step cover (n - 1) * step + CHUNK_SIZE characters
+        target_length = (doc_chunks - 1) * step + CHUNK_SIZE
+        # Average word is ~7 characters with its space, generate a few too many and cut
+        words = vocabulary[rng.choice(VOCABULARY_SIZE, target_length // 5, p=weights)]
+        sentence_ends = rng.random(len(words)) < 0.08
+        text = " ".join(word + "." if end else word for word, end in zip(words, sentence_ends))
+        documents[f"doc_{doc_id:05d}.txt"] = text[:target_length]
+    return documents
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 and mean of some latencies (seconds)"""
+    values = [value for value in values if value is not None]
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(values))}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(num_chunks: int,
+                  num_queries: int = 200,
+                  embed_latency: float = 0.05,
+                  first_token_latency: float = 0.0,
+                  token_latency: float = 0.0,
+                  dim: int = 256,
+                  seed: int = 0) -> Dict:
+    """Ingest and query a synthetic corpus of num_chunks chunks with fake API clients
+
+    Everything is written under a temporary directory, which is the working directory while it runs
+
+    Args:
+        num_chunks (int): size of the corpus in chunks
+        num_queries (int, optional): queries timed through RAGSystem.query. Defaults to 200.
+        embed_latency (float, optional): seconds every embed call takes. Defaults to 0.05.
+        first_token_latency (float, optional): seconds before the answer's first token. Defaults to 0.0.
+        token_latency (float, optional): seconds between the answer's tokens. Defaults to 0.0.
+        dim (int, optional): embedding dimension. Defaults to 256.
+        seed (int, optional): seed of the corpus and the queries. Defaults to 0.
+
+    Returns:
+        Dict: the measurements of every stage
+    """
+    from config.config import DOCUMENTS_DIR
+    from src.chunker import TextChunker
+    from src.document_loader import DocumentLoader
+    from src.embedding_scheduler import EmbeddingScheduler
+    from src.embeddings import EmbeddingSystem
+    from src.query_embedding_cache import QueryEmbeddingCache
+    from src.rag_pipeline import RAGSystem
+    from tests.fakes import FakeAnthropicClient, FakeVoyageClient
+    from utils.text_processing import estimate_tokens
+
+    results = {"num_chunks": num_chunks}
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            # 1. Write the corpus and extract it
+            documents = synthetic_corpus(num_chunks, seed)
+            Path(DOCUMENTS_DIR).mkdir(parents=True)
+            for file_name, text in documents.items():
+                (Path(DOCUMENTS_DIR) / file_name).write_text(text, encoding="utf-8")
+            num_bytes = sum(len(text) for text in documents.values())
+            start_time = time.perf_counter()
+            texts = DocumentLoader().load_all_documents(sorted(documents))
+            seconds = time.perf_counter() - start_time
+            results["extraction"] = {"documents": len(documents), "megabytes": num_bytes / 1e6,
+                                     "seconds": seconds, "megabytes_per_second": num_bytes / 1e6 / seconds}
+
+            # 2. Chunk it every way
+            chunker = TextChunker()
+            results["chunking"] = {}
+            for chunk_by, chunk_size, chunk_overlap in (("character", CHUNK_SIZE, CHUNK_OVERLAP),
+                                                        ("sentence", None, None), ("token", None, None)):
+                start_time = time.perf_counter()
+                records = [chunker.chunk_records(file_name, text, chunk_by, chunk_size, chunk_overlap)
+                           for file_name, text in texts.items()]
+                seconds = time.perf_counter() - start_time
+                chunk_count = sum(len(document_records) for document_records in records)
+                results["chunking"][chunk_by] = {"chunks": chunk_count, "seconds": seconds,
+                                                 "chunks_per_second": chunk_count / seconds}
+                if chunk_by == "character":
+                    chunks = [chunk for document_records in records for chunk in document_records]
+
+            # 3. Embed the character chunks (without the account rate limits, only the API latency)
+            client = FakeVoyageClient(dim, embed_latency)
+            embedding_system = EmbeddingSystem(voyageai_client=client, query_cache=QueryEmbeddingCache(path=None))
+            embedding_system.scheduler = EmbeddingScheduler(client, tokens_per_minute=10 ** 12,
+                                                            requests_per_minute=10 ** 9, progress=lambda progress: None)
+            num_tokens = sum(estimate_tokens(chunk["chunk_content"]) for chunk in chunks)
+            start_time = time.perf_counter()
+            embedding_system.embed_chunks(chunks, index=False)
+            seconds = time.perf_counter() - start_time
+            results["embedding"] = {"chunks": len(chunks), "api_calls": len(client.calls), "seconds": seconds,
+                                    "chunks_per_second": len(chunks) / seconds, "tokens_per_second": num_tokens / seconds}
+
+            # 4. Load the store and build the dense and keyword indexes
+            rag_system = RAGSystem(anthropic_client=FakeAnthropicClient("The answer is in the documents.",
+                                                                        first_token_latency, token_latency),
+                                   voyageai_client=FakeVoyageClient(dim, embed_latency))
+            start_time = time.perf_counter()
+            rag_system.load_index()
+            results["index_build"] = {"seconds": time.perf_counter() - start_time}
+            # A restart restores the state load_index built from its warm-start snapshot
+            start_time = time.perf_counter()
+            RAGSystem(anthropic_client=rag_system.client, voyageai_client=FakeVoyageClient(dim, embed_latency)).load_index()
+            results["warm_start"] = {"seconds": time.perf_counter() - start_time}
+
+            # 5. Time queries made of words from random chunks
+            rng = np.random.default_rng(seed + 1)
+            queries = []
+            for i in rng.integers(len(chunks), size=num_queries):
+                words = chunks[i]["chunk_content"].split()
+                start = int(rng.integers(max(len(words) - 6, 1)))
+                queries.append(" ".join(words[start:start + 6]))
+            latencies = []
+            for query in queries:
+                start_time = time.perf_counter()
+                rag_system.query(query)
+                latencies.append(time.perf_counter() - start_time)
+            timings = list(rag_system.query_timings)[-num_queries:]
+            results["query"] = {"queries": num_queries,
+                                "latency_seconds": percentiles(latencies),
+                                "retrieval_seconds": percentiles([timing["retrieval_seconds"] for timing in timings]),
+                                "time_to_first_token": percentiles([timing["time_to_first_token"] for timing in timings])}
+        finally:
+            os.chdir(previous_dir)
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def _flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float = 0.2) -> List[str]:
+    """Find the measurements that got more than tolerance (a fraction) worse than in a baseline run
+
+    Durations, latencies and memory are worse when higher, throughputs (*_per_second) when lower.
+    Counts are not compared.
+
+    Returns:
+        List[str]: one line per regression
+    """
+    baseline_by_size = {run["num_chunks"]: _flatten(run) for run in baseline}
+    regressions = []
+    for run in results:
+        old = baseline_by_size.get(run["num_chunks"])
+        if old is None:
+            continue
+        flat = _flatten(run)
+        for key, value in flat.items():
+            if key not in old or not old[key]:
+                continue
+            if key.endswith("per_second"):
+                seconds_key = key.rsplit(".", 1)[0] + ".seconds"
+                if max(old.get(seconds_key, 0), flat.get(seconds_key, 0)) < MIN_COMPARED_SECONDS:
+                    continue
+                change = (old[key] - value) / old[key]
+            elif key == "peak_rss_mb":
+                change = (value - old[key]) / old[key]
+            elif "seconds" in key or "time_to_first_token" in key:
+                if max(old[key], value) < MIN_COMPARED_SECONDS:
+                    continue
+                change = (value - old[key]) / old[key]
+            else:
+                continue
+            if change > tolerance:
+                regressions.append(f"{run['num_chunks']} chunks: {key} {old[key]:.4g} -> {value:.4g} ({change:.0%} worse)")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark ingest and query on synthetic corpora with fake API clients")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=list(DEFAULT_SIZES), help="corpus sizes in chunks, comma separated")
+    parser.add_argument("--queries", type=int, default=200, help="queries timed per corpus")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embed call")
+    parser.add_argument("--first-token-latency", type=float, default=0.0, help="seconds before the first answer token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between answer tokens")
+    parser.add_argument("--dim", type=int, default=256, help="embedding dimension")
+    parser.add_argument("--output", help=f"JSON results file (defaults to a timestamped file in {DEFAULT_OUTPUT_DIR})")
+    parser.add_argument("--compare", help="JSON results of an earlier run to report regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction a measurement may get worse by")
+    args = parser.parse_args(argv)
+
+    runs = []
+    # Every size runs in a fresh process, so its peak RSS is its own
+    context = multiprocessing.get_context("spawn")
+    for num_chunks in args.sizes:
+        print(f"Benchmarking {num_chunks} chunks...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            run = executor.submit(run_benchmark, num_chunks, args.queries, args.embed_latency,
+                                  args.first_token_latency, args.token_latency, args.dim).result()
+        runs.append(run)
+        print(f"  embedded {run['embedding']['chunks_per_second']:.0f} chunks/s, "
+              f"indexed in {run['index_build']['seconds']:.2f}s, "
+              f"query p50/p95/p99 {run['query']['latency_seconds']['p50'] * 1000:.1f}/"
+              f"{run['query']['latency_seconds']['p95'] * 1000:.1f}/"
+              f"{run['query']['latency_seconds']['p99'] * 1000:.1f}ms, "
+              f"peak RSS {run['peak_rss_mb']:.0f}MB")
+
+    output = args.output or str(Path(DEFAULT_OUTPUT_DIR) / f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+                   "runs": runs}, f, indent=2)
+    print(f"Results written to '{output}'")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(runs, json.load(f)["runs"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions against '{args.compare}'")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
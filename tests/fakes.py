@@ -0,0 +1,184 @@
+# Local stand-ins for the Voyage and Anthropic clients so tests never touch the network
+import asyncio
+import re
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import List
+
+import numpy as np
+
+from utils.text_processing import estimate_tokens
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class FakeVoyageClient:
+    """Deterministic bag-of-words embeddings: texts that share words get similar vectors"""
+
+    def __init__(self, dim: int = 64, latency: float = 0.0):
+        self.dim = dim
+        # Seconds every embed call takes, like a round trip to the API
+        self.latency = latency
+        self.calls = []
+
+    def embed_text(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim)
+        for word in _words(text):
+            vector[zlib.crc32(word.encode()) % self.dim] += 1.0
+        return vector.tolist()
+
+    def embed(self, texts, model=None, input_type=None, truncation=True,
+              output_dtype=None, output_dimension=None):
+        if isinstance(texts, str):
+            texts = [texts]
+        self.calls.append(list(texts))
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(embeddings=[self.embed_text(text) for text in texts],
+                               total_tokens=sum(len(_words(text)) for text in texts))
+
+
+class RateLimitedFakeVoyageClient(FakeVoyageClient):
+    """FakeVoyageClient that raises RateLimitError like the API when a per-window budget is exceeded"""
+
+    def __init__(self, dim: int = 64, tokens_per_window: int = 10_000, requests_per_window: int = 3,
+                 window_seconds: float = 60.0, max_batch_items: int = 1000, latency: float = 0.0):
+        super().__init__(dim, latency)
+        self.tokens_per_window = tokens_per_window
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.max_batch_items = max_batch_items
+        self.throttled = 0
+        self._requests = []
+        self._lock = threading.Lock()
+
+    def embed(self, texts, model=None, input_type=None, truncation=True,
+              output_dtype=None, output_dimension=None):
+        # Imported here like the pipeline does, so using the fakes never imports voyageai on its own
+        import voyageai.error
+        if isinstance(texts, str):
+            texts = [texts]
+        if len(texts) > self.max_batch_items:
+            raise voyageai.error.InvalidRequestError(f"Batch of {len(texts)} is over {self.max_batch_items}")
+        tokens = sum(estimate_tokens(text) for text in texts)
+        with self._lock:
+            now = time.monotonic()
+            self._requests = [(t, n) for t, n in self._requests if t > now - self.window_seconds]
+            if (len(self._requests) >= self.requests_per_window
+                    or sum(n for _, n in self._requests) + tokens > self.tokens_per_window):
+                self.throttled += 1
+                raise voyageai.error.RateLimitError("Rate limit exceeded")
+            self._requests.append((now, tokens))
+        result = super().embed(texts, model, input_type)
+        result.total_tokens = tokens
+        return result
+
+
+class _FakeStream:
+    # Mimics the MessageStream context manager of anthropic's client.messages.stream()
+    def __init__(self, tokens: List[str], first_token_latency: float, token_latency: float,
+                 usage: SimpleNamespace = None):
+        self._tokens = tokens
+        self._first_token_latency = first_token_latency
+        self._token_latency = token_latency
+        self._usage = usage
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self):
+        time.sleep(self._first_token_latency)
+        for i, token in enumerate(self._tokens):
+            if i:
+                time.sleep(self._token_latency)
+            yield token
+
+    def get_final_message(self):
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text="".join(self._tokens))], usage=self._usage)
+
+
+class FakeAnthropicClient:
+    """Answers every prompt with the same text, streamed word by word with configurable latency"""
+
+    def __init__(self, answer: str = "This is the answer.", first_token_latency: float = 0.0,
+                 token_latency: float = 0.0):
+        self.answer = answer
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.prompts = []
+        # Every argument of every call, e.g. to check the system prompt is marked for caching
+        self.requests = []
+        # Prompt prefixes written to the cache, like the API's prompt cache (which never expires here)
+        self.cached_prefixes = set()
+        self.messages = SimpleNamespace(create=self._create, stream=self._stream)
+
+    def _tokens(self) -> List[str]:
+        return re.findall(r"\S+\s*", self.answer)
+
+    def _usage(self, system, messages) -> SimpleNamespace:
+        # The usage the API reports: the prefix up to a cache_control breakpoint is either written to or
+        # read from the cache, input_tokens is the rest of the prompt
+        blocks = system if isinstance(system, list) else [{"type": "text", "text": system or ""}]
+        cached = max((i + 1 for i, block in enumerate(blocks) if "cache_control" in block), default=0)
+        prefix = "".join(block["text"] for block in blocks[:cached])
+        rest = "".join(block["text"] for block in blocks[cached:])
+        rest += "".join(message["content"] for message in messages or [])
+        usage = SimpleNamespace(input_tokens=estimate_tokens(rest), cache_creation_input_tokens=0,
+                                cache_read_input_tokens=0, output_tokens=estimate_tokens(self.answer))
+        if prefix in self.cached_prefixes:
+            usage.cache_read_input_tokens = estimate_tokens(prefix)
+        elif prefix:
+            self.cached_prefixes.add(prefix)
+            usage.cache_creation_input_tokens = estimate_tokens(prefix)
+        return usage
+
+    def _create(self, model=None, max_tokens=None, messages=None, **kwargs):
+        self.prompts.append(messages)
+        self.requests.append({"model": model, "max_tokens": max_tokens, "messages": messages, **kwargs})
+        time.sleep(self.first_token_latency + self.token_latency * max(len(self._tokens()) - 1, 0))
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text=self.answer)],
+                               usage=self._usage(kwargs.get("system"), messages))
+
+    def _stream(self, model=None, max_tokens=None, messages=None, **kwargs):
+        self.prompts.append(messages)
+        self.requests.append({"model": model, "max_tokens": max_tokens, "messages": messages, **kwargs})
+        return _FakeStream(self._tokens(), self.first_token_latency, self.token_latency,
+                           self._usage(kwargs.get("system"), messages))
+
+
+class _FakeAsyncStream(_FakeStream):
+    # Mimics the AsyncMessageStream context manager of anthropic's AsyncAnthropic
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    async def text_stream(self):
+        await asyncio.sleep(self._first_token_latency)
+        for i, token in enumerate(self._tokens):
+            if i:
+                await asyncio.sleep(self._token_latency)
+            yield token
+
+    async def get_final_message(self):
+        return _FakeStream.get_final_message(self)
+
+
+class FakeAsyncAnthropicClient(FakeAnthropicClient):
+    """Async version of FakeAnthropicClient (client.messages.stream is an async context manager)"""
+
+    def _stream(self, model=None, max_tokens=None, messages=None, **kwargs):
+        self.prompts.append(messages)
+        self.requests.append({"model": model, "max_tokens": max_tokens, "messages": messages, **kwargs})
+        return _FakeAsyncStream(self._tokens(), self.first_token_latency, self.token_latency,
+                                self._usage(kwargs.get("system"), messages))
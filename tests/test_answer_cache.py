@@ -0,0 +1,75 @@
+# Unit tests for the semantic answer cache
+import numpy as np
+from src.answer_cache import SemanticAnswerCache
+
+CHUNKS = [{"file_name": "f.txt", "chunk_id": 0, "chunk_content": "the final exam is on May 5", "content_hash": "a"}]
+OTHER_CHUNKS = [{"file_name": "f.txt", "chunk_id": 1, "chunk_content": "labs start in week two", "content_hash": "b"}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def vector(*values):
+    return np.array(values + (0.0,) * (4 - len(values)))
+
+
+def test_similar_query_with_the_same_chunks_hits(tmp_path):
+    cache = SemanticAnswerCache(threshold=0.95, index_dir=str(tmp_path))
+    cache.add("when is the final exam", vector(1.0, 0.1), CHUNKS, "May 5")
+    assert cache.lookup(vector(1.0, 0.12), CHUNKS) == "May 5"
+    assert cache.lookup(vector(1.0, 0.12), OTHER_CHUNKS) is None
+    assert cache.lookup(vector(0.0, 1.0), CHUNKS) is None
+    assert cache.metrics()["hits"] == 1 and cache.metrics()["misses"] == 2
+    assert abs(cache.hit_rate() - 1 / 3) < 1e-9
+
+
+def test_ttl_and_size_eviction(tmp_path):
+    clock = FakeClock()
+    cache = SemanticAnswerCache(threshold=0.95, max_entries=2, ttl_seconds=60, index_dir=None, clock=clock)
+    cache.add("q1", vector(1.0), CHUNKS, "a1")
+    clock.now += 1
+    cache.add("q2", vector(0.0, 1.0), CHUNKS, "a2")
+    clock.now += 1
+    assert cache.lookup(vector(1.0), CHUNKS) == "a1"
+    # q2 is the least recently used
+    cache.add("q3", vector(0.0, 0.0, 1.0), CHUNKS, "a3")
+    assert cache.lookup(vector(0.0, 1.0), CHUNKS) is None
+    assert len(cache) == 2
+    clock.now += 120
+    assert cache.lookup(vector(1.0), CHUNKS) is None
+    assert len(cache) == 0 and cache.metrics()["evictions"] == 3
+
+
+def test_persists_and_is_invalidated_by_a_new_corpus(tmp_path):
+    cache = SemanticAnswerCache(threshold=0.95, index_dir=str(tmp_path))
+    cache.set_corpus("corpus-1")
+    cache.add("when is the final exam", vector(1.0), CHUNKS, "May 5")
+    cache.flush()
+
+    reloaded = SemanticAnswerCache(threshold=0.95, index_dir=str(tmp_path))
+    reloaded.set_corpus("corpus-1")
+    assert reloaded.lookup(vector(1.0), CHUNKS) == "May 5"
+    reloaded.set_corpus("corpus-2")
+    assert reloaded.lookup(vector(1.0), CHUNKS) is None
+    assert len(SemanticAnswerCache(threshold=0.95, index_dir=str(tmp_path))) == 0
+
+
+def test_adds_are_saved_on_an_interval_into_a_preallocated_matrix(tmp_path):
+    clock = FakeClock()
+    cache = SemanticAnswerCache(threshold=0.95, index_dir=str(tmp_path), save_interval=10, clock=clock)
+    cache.add("q1", vector(1.0), CHUNKS, "a1")
+    matrix = cache._embeddings
+    cache.add("q2", vector(0.0, 1.0), CHUNKS, "a2")
+    # Nothing was written yet, and the second answer went into the same matrix
+    assert not (tmp_path / "answer_cache.npz").exists()
+    assert cache._embeddings is matrix and len(matrix) > len(cache)
+
+    clock.now += 10
+    cache.add("q3", vector(0.0, 0.0, 1.0), CHUNKS, "a3")
+    reloaded = SemanticAnswerCache(threshold=0.95, index_dir=str(tmp_path), clock=clock)
+    assert len(reloaded) == 3 and reloaded.lookup(vector(0.0, 1.0), CHUNKS) == "a2"
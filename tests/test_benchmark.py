@@ -0,0 +1,32 @@
+# Smoke tests for the offline benchmark (python -m tests.benchmark)
+import os
+
+from tests.benchmark import compare, run_benchmark, synthetic_corpus
+
+
+def test_synthetic_corpus_has_about_the_requested_chunks():
+    documents = synthetic_corpus(450)
+    assert len(documents) == 3
+    assert synthetic_corpus(450) == documents
+
+
+def test_run_benchmark_measures_every_stage():
+    working_dir = os.getcwd()
+    run = run_benchmark(10, num_queries=5, embed_latency=0.0, dim=32)
+    assert os.getcwd() == working_dir
+    assert run["embedding"]["chunks"] >= 10 and run["index_build"]["seconds"] >= 0
+    assert run["query"]["queries"] == 5
+    latency = run["query"]["latency_seconds"]
+    assert latency["p50"] <= latency["p95"] <= latency["p99"]
+    assert run["peak_rss_mb"] > 0
+
+
+def test_compare_reports_only_regressions_past_the_tolerance():
+    baseline = [{"num_chunks": 10, "index_build": {"seconds": 1.0},
+                 "embedding": {"chunks": 10, "seconds": 1.0, "chunks_per_second": 100.0}}]
+    faster = [{"num_chunks": 10, "index_build": {"seconds": 0.5},
+               "embedding": {"chunks": 20, "seconds": 1.1, "chunks_per_second": 90.0}}]
+    slower = [{"num_chunks": 10, "index_build": {"seconds": 1.5},
+               "embedding": {"chunks": 10, "seconds": 1.0, "chunks_per_second": 50.0}}]
+    assert compare(faster, baseline, tolerance=0.2) == []
+    assert len(compare(slower, baseline, tolerance=0.2)) == 2
@@ -1,49 +1,74 @@
 # Unit tests for chunking logic
+import re
 import pytest
-from src.document_loader import DocumentLoader
-from src.chunker import TextChunker
-import json
-
-# Get test from a document
-loader = DocumentLoader("documents")
-csc_226_syllabus_text = loader.load_document("CSC_226_Course_Syllabus.txt")
-
-# Make chunkers
-sentence_chunker = TextChunker("CSC_226_Course_Syllabus.txt",
-                               csc_226_syllabus_text,
-                               chunk_by="sentence",
-                               chunk_size=5,
-                               chunk_overlap=1)
-character_chunker = TextChunker("CSC_226_Course_Syllabus.txt",
-                                csc_226_syllabus_text,
-                                chunk_by="character",
-                                chunk_size=500,
-                                chunk_overlap=100)
-
-# Get the chunks
-sentence_chunks = sentence_chunker.chunk_text()
-character_chunks = character_chunker.chunk_text()
-
-
-def test_set_chunk_by_valid():
-    assert sentence_chunker._chunk_by == "sentence"
-    assert character_chunker._chunk_by == "character"
-    
-def test_set_chunk_by_invalid():
+from src.chunker import ChunkRecords, TextChunker
+from utils.text_processing import estimate_tokens
+
+TEXT = ("The course meets twice a week. Labs start in week two! Are office hours online? "
+        "Yes, on Fridays. The final exam is cumulative. Late work loses ten percent. "
+        "Bring a laptop to every lab.")
+
+chunker = TextChunker()
+
+
+def test_chunk_by_invalid():
     with pytest.raises(ValueError) as e:
-        invalid_chunker = TextChunker(
-                                "CSC_226_Course_Syllabus.txt",
-                               csc_226_syllabus_text,
-                               chunk_by="paragraph",
-                               chunk_size=5,
-                               chunk_overlap=1
-                            )
-    assert str(e.value) == "Chunk_by must be one of ['character', 'sentence'], got paragraph"
-
-def test_chunk_text():
-    print(json.dumps(sentence_chunks, indent=4))
-    print(len(sentence_chunks))
-    print()
-    print()
-    print(json.dumps(character_chunks, indent=4))
-    print(len(character_chunks))
\ No newline at end of file
+        chunker.chunk_document("syllabus.txt", TEXT, chunk_by="paragraph")
+    assert str(e.value) == "Chunk_by must be one of ['character', 'sentence', 'token'], got paragraph"
+
+
+def test_overlap_must_be_smaller_than_size():
+    with pytest.raises(ValueError):
+        chunker.chunk_document("syllabus.txt", TEXT, chunk_by="character", chunk_size=10, chunk_overlap=10)
+
+
+def test_character_chunks_overlap():
+    chunks = chunker.chunk_document("syllabus.txt", TEXT, chunk_by="character", chunk_size=50, chunk_overlap=10)
+    assert [chunk["chunk_id"] for chunk in chunks] == list(range(len(chunks)))
+    assert all(len(chunk["chunk_content"]) <= 50 for chunk in chunks)
+    assert chunks[1]["chunk_content"][:10] == chunks[0]["chunk_content"][-10:]
+    assert chunks[0] == {"chunk_id": 0, "chunk_content": TEXT[:50], "file_name": "syllabus.txt",
+                         "start_char": 0, "end_char": 50,
+                         "chunk_by": "character", "chunk_size": 50, "chunk_overlap": 10}
+
+
+def test_sentence_chunks_match_splitting_the_whole_text():
+    sentences = re.split(r"(?<=[!?.])\s+", TEXT)
+    for chunk_size, chunk_overlap in [(2, 1), (3, 1), (5, 1), (3, 2)]:
+        expected = []
+        start_idx = 0
+        while start_idx < len(sentences):
+            expected.append(" ".join(sentences[start_idx:start_idx + chunk_size]))
+            start_idx += chunk_size - chunk_overlap
+        chunks = chunker.chunk_document("syllabus.txt", TEXT, "sentence", chunk_size, chunk_overlap)
+        assert [chunk["chunk_content"] for chunk in chunks] == expected
+
+
+def test_chunk_records_are_offsets_into_the_text():
+    records = chunker.chunk_records("syllabus.txt", TEXT, chunk_by="sentence", chunk_size=2, chunk_overlap=1)
+    assert isinstance(records, ChunkRecords)
+    assert not hasattr(records, "__dict__")
+    start, end = records.span(1)
+    assert records.chunk_text(1) == TEXT[start:end] == "Labs start in week two! Are office hours online?"
+    assert list(records.texts()) == [chunk["chunk_content"] for chunk in records]
+    assert list(records) == chunker.chunk_document("syllabus.txt", TEXT, "sentence", 2, 1)
+
+
+def test_token_chunks_pack_whole_sentences_under_the_budget():
+    records = chunker.chunk_records("syllabus.txt", TEXT, chunk_by="token", chunk_size=20, chunk_overlap=8)
+    sentences = re.split(r"(?<=[!?.])\s+", TEXT)
+    for text in records.texts():
+        assert sum(estimate_tokens(sentence) for sentence in re.split(r"(?<=[!?.])\s+", text)) <= 20
+        assert all(sentence in sentences for sentence in re.split(r"(?<=[!?.])\s+", text))
+    # Neighbouring chunks share their boundary sentence, and together they cover the text
+    texts = list(records.texts())
+    assert texts[1].startswith(re.split(r"(?<=[!?.])\s+", texts[0])[-1])
+    assert TEXT.startswith(texts[0]) and TEXT.endswith(texts[-1])
+    assert records.total_tokens() == sum(estimate_tokens(text) for text in texts)
+
+
+def test_token_chunks_split_sentences_longer_than_the_budget():
+    text = "word " * 100
+    chunks = chunker.chunk_document("long.txt", text, chunk_by="token", chunk_size=10, chunk_overlap=2)
+    assert all(estimate_tokens(chunk["chunk_content"]) <= 10 for chunk in chunks)
+    assert "".join(chunk["chunk_content"] for chunk in chunks) == text
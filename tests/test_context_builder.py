@@ -0,0 +1,91 @@
+# Unit tests for packing retrieved chunks into the prompt context
+from src.chunker import TextChunker
+from src.context_builder import ContextBuilder, overlap_length
+from utils.text_processing import estimate_tokens
+
+TEXT = ("The committee met on Monday. It reviewed the budget for the new library. "
+        "Members disagreed about the opening hours. A vote was postponed to next week. "
+        "The chair thanked everyone for attending.")
+
+
+def chunks_of(text, chunk_size=60, chunk_overlap=15):
+    return TextChunker().chunk_document("notes.txt", text, "character", chunk_size, chunk_overlap)
+
+
+def test_overlap_length():
+    assert overlap_length("the cat sat on the mat", "on the mat and slept") == len("on the mat")
+    assert overlap_length("abc", "xyz") == 0
+    assert overlap_length("", "abc") == overlap_length("abc", "") == 0
+
+
+def test_adjacent_chunks_are_stitched_back_into_the_original_text():
+    chunks = chunks_of(TEXT)
+    # Ranked out of order: the passage grows in both directions
+    ranked = [chunks[2], chunks[1], chunks[3], chunks[0]] + chunks[4:]
+    builder = ContextBuilder(token_budget=10_000, redundancy_threshold=None)
+    passages = builder.pack(ranked)
+    assert len(passages) == 1
+    assert passages[0]["text"] == TEXT
+    assert (passages[0]["first_chunk_id"], passages[0]["last_chunk_id"]) == (0, len(chunks) - 1)
+    assert builder.build(ranked).startswith(f'<source file="notes.txt" chunks="0-{len(chunks) - 1}">')
+
+
+def test_redundant_chunks_are_dropped_and_the_budget_is_respected():
+    chunks = [{"file_name": "a.txt", "chunk_id": 0, "chunk_content": "The library opens at nine every day."},
+              {"file_name": "b.txt", "chunk_id": 5, "chunk_content": "The library opens at nine, every day!"},
+              {"file_name": "c.txt", "chunk_id": 2, "chunk_content": "x" * 400},
+              {"file_name": "d.txt", "chunk_id": 9, "chunk_content": "Parking is free after six."}]
+    builder = ContextBuilder(token_budget=40)
+    passages = builder.pack(chunks)
+    assert [passage["file_name"] for passage in passages] == ["a.txt", "d.txt"]
+    assert builder.last_stats["redundant"] == 1 and builder.last_stats["over_budget"] == 1
+    assert builder.last_stats["tokens"] <= 40
+
+
+def test_neighbours_and_document_head_are_added_with_overlap_stitched_by_offsets():
+    from src.context_builder import ChunkPositionIndex
+    chunks = chunks_of(TEXT)
+    other = {"file_name": "other.txt", "chunk_id": 0, "chunk_content": "Unrelated minutes about parking."}
+    positions = ChunkPositionIndex(chunks + [other])
+    assert positions.get("notes.txt", 2) is chunks[2] and positions.get("notes.txt", 99) is None
+    assert positions.neighbours(chunks[2], 2, 1) == [chunks[1], chunks[0], chunks[3]]
+    assert positions.document_head("notes.txt", 2) == chunks[:2]
+
+    builder = ContextBuilder(token_budget=10_000, num_head_chunks=1, num_previous_chunks=1, num_next_chunks=0)
+    expanded = builder.expand([chunks[3]], positions)
+    assert expanded == [chunks[3], chunks[2], chunks[0]]
+    passages = builder.pack(expanded)
+    # Chunks 2-3 are one passage (stitched exactly), the document head is another
+    assert [passage["text"] for passage in passages] == [TEXT[chunks[2]["start_char"]:chunks[3]["end_char"]],
+                                                        chunks[0]["chunk_content"]]
+
+
+def test_expansion_stays_within_the_budget():
+    from src.context_builder import ChunkPositionIndex
+    chunks = chunks_of(TEXT)
+    builder = ContextBuilder(token_budget=30, num_head_chunks=0, num_previous_chunks=3, num_next_chunks=3)
+    context = builder.build([chunks[2]], ChunkPositionIndex(chunks))
+    assert chunks[2]["chunk_content"] in context
+    assert builder.last_stats["tokens"] <= 30 and builder.last_stats["over_budget"] > 0
+
+
+def test_a_chunk_between_two_passages_joins_them():
+    chunks = chunks_of(TEXT)
+    other = {"file_name": "other.txt", "chunk_id": 1, "chunk_content": "Unrelated minutes about parking."}
+    builder = ContextBuilder(token_budget=10_000, redundancy_threshold=None)
+    passages = builder.pack([other, chunks[3], chunks[1], chunks[0], chunks[2]])
+    # Chunk 2 bridges passages 0-1 and 3, which become one passage in the place of the better ranked one
+    assert [passage["file_name"] for passage in passages] == ["other.txt", "notes.txt"]
+    assert (passages[1]["first_chunk_id"], passages[1]["last_chunk_id"]) == (0, 3)
+    assert passages[1]["text"] == TEXT[:chunks[3]["end_char"]]
+
+
+def test_the_source_wrappers_count_against_the_budget():
+    chunks = [{"file_name": f"file_{i}.txt", "chunk_id": i, "chunk_content": f"Fact number {i} is short."}
+              for i in range(20)]
+    for budget in (10, 25, 60, 120):
+        builder = ContextBuilder(token_budget=budget)
+        context = builder.build(chunks)
+        assert estimate_tokens(context) <= builder.last_stats["tokens"] <= budget
+    # Wrappers are most of a short passage, so fewer passages fit than the bare text would allow
+    assert builder.last_stats["passages"] < 120 // estimate_tokens(chunks[0]["chunk_content"])
@@ -0,0 +1,36 @@
+# Unit tests for near-duplicate chunk detection
+from src.dedup import ChunkDeduplicator
+
+FOOTER = ("This document is confidential and intended only for the named recipient. If you received it "
+          "in error please notify the sender and delete every copy. Unauthorized use is prohibited.")
+
+
+def make_chunk(file_name, chunk_id, text):
+    return {"file_name": file_name, "chunk_id": chunk_id, "chunk_content": text}
+
+
+def test_near_duplicates_collapse_onto_the_first_chunk():
+    chunks = [make_chunk("a.txt", 0, "Grades are posted on the course site every Friday afternoon."),
+              make_chunk("a.txt", 1, FOOTER),
+              make_chunk("b.txt", 0, "The lab uses Python 3 and the numpy library for every assignment."),
+              make_chunk("b.txt", 1, FOOTER.replace("prohibited.", "prohibited by law.")),
+              make_chunk("c.txt", 0, FOOTER)]
+    deduplicator = ChunkDeduplicator(threshold=0.8)
+    kept = deduplicator.deduplicate(chunks)
+
+    assert [(chunk["file_name"], chunk["chunk_id"]) for chunk in kept] == [("a.txt", 0), ("a.txt", 1), ("b.txt", 0)]
+    assert kept[1]["duplicate_sources"] == [{"file_name": "b.txt", "chunk_id": 1},
+                                            {"file_name": "c.txt", "chunk_id": 0}]
+    assert "duplicate_sources" not in kept[0]
+    assert deduplicator.last_stats["duplicates"] == 2
+    assert deduplicator.last_stats["tokens_saved"] > 0
+
+
+def test_signature_similarity_tracks_jaccard():
+    deduplicator = ChunkDeduplicator()
+    words = [f"w{i}" for i in range(200)]
+    a = deduplicator.signature(" ".join(words))
+    b = deduplicator.signature(" ".join(words[:100] + [f"x{i}" for i in range(100)]))
+    assert (a == deduplicator.signature(" ".join(words))).all()
+    # Shingle Jaccard of the two texts is 96 / 296
+    assert abs(float((a == b).mean()) - 96 / 296) < 0.15
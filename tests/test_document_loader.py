@@ -0,0 +1,40 @@
+# Unit tests for parallel, cached document extraction
+import os
+import pytest
+from src.document_loader import DocumentLoader
+
+
+@pytest.fixture(autouse=True)
+def documents_dir(tmp_path, monkeypatch):
+    # DOCUMENTS_DIR and EXTRACTED_TEXT_DIR are relative paths
+    monkeypatch.chdir(tmp_path)
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    (documents / "a.txt").write_text("first document\r\nwith two lines", encoding="utf-8")
+    (documents / "b.txt").write_text("second document", encoding="utf-8")
+    return documents
+
+
+def test_extracts_in_parallel_and_keeps_order():
+    loader = DocumentLoader(workers=2)
+    documents = loader.load_all_documents(["b.txt", "a.txt"])
+    assert list(documents) == ["b.txt", "a.txt"]
+    assert documents["b.txt"] == "second document"
+    assert not any(loader.extraction_times[name] == 0.0 for name in documents)
+
+
+def test_unchanged_documents_come_from_the_cache(documents_dir):
+    first = DocumentLoader(workers=1).load_all_documents(["a.txt", "b.txt"])
+
+    loader = DocumentLoader(workers=1)
+    assert loader.load_all_documents(["a.txt", "b.txt"]) == first
+    assert loader.extraction_times == {"a.txt": 0.0, "b.txt": 0.0}
+
+    # A modified file is extracted again
+    (documents_dir / "b.txt").write_text("second document, edited", encoding="utf-8")
+    stat = os.stat(documents_dir / "b.txt")
+    os.utime(documents_dir / "b.txt", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    documents = loader.load_all_documents(["a.txt", "b.txt"])
+    assert documents["b.txt"] == "second document, edited"
+    assert loader.extraction_times["a.txt"] == 0.0
+    assert loader.extraction_times["b.txt"] > 0.0
@@ -0,0 +1,52 @@
+# Unit tests for the batch embedding scheduler
+import pytest
+import voyageai.error
+from src.embedding_scheduler import EmbeddingScheduler
+from tests.fakes import RateLimitedFakeVoyageClient
+
+TEXTS = [f"chunk number {i} " * 10 for i in range(50)]  # ~45 tokens each
+
+
+def make_scheduler(client, **kwargs):
+    settings = {"max_batch_items": 8, "max_batch_tokens": 100_000, "tokens_per_minute": 100_000,
+                "requests_per_minute": 100, "window_seconds": 0.2, "initial_backoff": 0.01,
+                "progress": lambda progress: None}
+    settings.update(kwargs)
+    return EmbeddingScheduler(client, **settings)
+
+
+def test_pack_batches_respects_item_and_token_limits():
+    scheduler = make_scheduler(None, max_batch_items=4, max_batch_tokens=100)
+    batches = scheduler.pack_batches(TEXTS[:10])
+    assert [i for batch in batches for i in batch] == list(range(10))
+    assert all(len(batch) <= 2 for batch in batches)  # two ~45 token texts fit in 100 tokens
+
+
+def test_embed_preserves_order_under_rate_limits():
+    client = RateLimitedFakeVoyageClient(tokens_per_window=1000, requests_per_window=4, window_seconds=0.2)
+    scheduler = make_scheduler(client, tokens_per_minute=1000, requests_per_minute=4)
+    embeddings = scheduler.embed(TEXTS)
+
+    assert embeddings == [client.embed_text(text) for text in TEXTS]
+    assert client.throttled == 0
+    assert scheduler.last_run_stats["chunks_done"] == len(TEXTS)
+    assert scheduler.last_run_stats["batches"] == len(scheduler.pack_batches(TEXTS))
+
+
+def test_retries_only_when_throttled():
+    # The scheduler thinks it has a bigger budget than the API gives it, so it gets throttled
+    client = RateLimitedFakeVoyageClient(tokens_per_window=1000, requests_per_window=2, window_seconds=0.2)
+    scheduler = make_scheduler(client, max_retries=20)
+    embeddings = scheduler.embed(TEXTS)
+
+    assert embeddings == [client.embed_text(text) for text in TEXTS]
+    assert client.throttled > 0
+    assert scheduler.last_run_stats["retries"] == client.throttled
+
+
+def test_other_api_errors_are_not_retried():
+    client = RateLimitedFakeVoyageClient(max_batch_items=2)
+    scheduler = make_scheduler(client, max_batch_items=8)
+    with pytest.raises(voyageai.error.InvalidRequestError):
+        scheduler.embed(TEXTS)
+    assert scheduler.last_run_stats["retries"] == 0
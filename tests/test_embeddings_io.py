@@ -0,0 +1,121 @@
+# Unit tests for the memory-mapped embedding store
+import json
+import numpy as np
+import pytest
+from src import embeddings_io
+from src.embeddings_io import EmbeddingsIO
+
+
+@pytest.fixture(autouse=True)
+def embeddings_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings_io, "EMBEDDINGS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def make_chunks(file_name, num_chunks, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{"chunk_id": i,
+             "chunk_content": f"{file_name} chunk {i}",
+             "file_name": file_name,
+             "chunk_by": "character",
+             "chunk_size": None,
+             "chunk_overlap": None,
+             "chunk_embeddings": rng.standard_normal(dim).tolist()}
+            for i in range(num_chunks)]
+
+
+def test_save_and_load_round_trip():
+    chunks = make_chunks("a.txt", 3)
+    EmbeddingsIO.save_embeddings(chunks)
+
+    loaded = EmbeddingsIO.load_embeddings("a.txt")
+    assert [chunk["chunk_id"] for chunk in loaded] == [0, 1, 2]
+    assert isinstance(loaded[0]["chunk_embeddings"], np.memmap)
+    np.testing.assert_allclose(loaded[2]["chunk_embeddings"], chunks[2]["chunk_embeddings"], rtol=1e-6)
+    assert EmbeddingsIO.stored_files() == {"a.txt"}
+
+
+def test_saving_a_file_again_replaces_only_that_file():
+    EmbeddingsIO.save_embeddings(make_chunks("a.txt", 3) + make_chunks("b.txt", 2, seed=1))
+    new_a = make_chunks("a.txt", 1, seed=2)
+    EmbeddingsIO.save_embeddings(new_a)
+
+    matrix, records = EmbeddingsIO.load_store()
+    assert matrix.shape == (3, 8)
+    assert len(EmbeddingsIO.load_embeddings("a.txt")) == 1
+    b_chunks = EmbeddingsIO.load_embeddings("b.txt")
+    np.testing.assert_allclose(b_chunks[1]["chunk_embeddings"],
+                               make_chunks("b.txt", 2, seed=1)[1]["chunk_embeddings"], rtol=1e-6)
+
+
+def test_migrates_legacy_json_files(embeddings_dir):
+    legacy = make_chunks("old.pdf", 2)
+    with open(embeddings_dir / "old.pdf.json", "w") as f:
+        json.dump(legacy, f)
+
+    assert EmbeddingsIO.stored_files() == {"old.pdf"}
+    assert not (embeddings_dir / "old.pdf.json").exists()
+    assert (embeddings_dir / embeddings_io.LEGACY_DIR / "old.pdf.json").exists()
+    loaded = EmbeddingsIO.load_embeddings("old.pdf")
+    np.testing.assert_allclose(loaded[0]["chunk_embeddings"], legacy[0]["chunk_embeddings"], rtol=1e-6)
+
+
+def test_chunks_with_the_same_hash_share_a_row_and_unused_rows_are_dropped():
+    chunks = make_chunks("a.txt", 3) + make_chunks("b.txt", 1, seed=5)
+    for chunk in chunks:
+        chunk["content_hash"] = EmbeddingsIO.content_hash(chunk["chunk_content"], "model", "query")
+    chunks[1]["content_hash"] = chunks[0]["content_hash"]
+    EmbeddingsIO.save_embeddings(chunks)
+    matrix, records = EmbeddingsIO.load_store()
+    assert matrix.shape[0] == 3
+
+    EmbeddingsIO.remove_embeddings(["a.txt"])
+    matrix, records = EmbeddingsIO.load_store()
+    assert matrix.shape[0] == 1
+    assert [record["file_name"] for record in records] == ["b.txt"]
+
+
+def test_writer_appends_batches_in_place_and_compacts_on_close(embeddings_dir):
+    EmbeddingsIO.save_embeddings(make_chunks("a.txt", 3))
+    inode = (embeddings_dir / embeddings_io.MATRIX_FILE).stat().st_ino
+
+    # New files only append rows, the matrix file is never rewritten
+    writer = embeddings_io.StoreWriter()
+    writer.add(make_chunks("b.txt", 2, seed=1))
+    writer.add(make_chunks("c.txt", 1, seed=2))
+    assert writer.close()
+    matrix, records = EmbeddingsIO.load_store()
+    assert matrix.shape == (6, 8)
+    assert (embeddings_dir / embeddings_io.MATRIX_FILE).stat().st_ino == inode
+    np.testing.assert_allclose(EmbeddingsIO.load_embeddings("c.txt")[0]["chunk_embeddings"],
+                               make_chunks("c.txt", 1, seed=2)[0]["chunk_embeddings"], rtol=1e-6)
+
+    # Replacing a file leaves rows unused, which are dropped
+    writer = embeddings_io.StoreWriter(replaced_files=["b.txt"])
+    writer.add(make_chunks("a.txt", 1, seed=3))
+    assert writer.close()
+    matrix, records = EmbeddingsIO.load_store()
+    assert matrix.shape == (2, 8)
+    assert EmbeddingsIO.stored_files() == {"a.txt", "c.txt"}
+    np.testing.assert_allclose(EmbeddingsIO.load_embeddings("c.txt")[0]["chunk_embeddings"],
+                               make_chunks("c.txt", 1, seed=2)[0]["chunk_embeddings"], rtol=1e-6)
+
+
+def test_a_crash_while_recording_the_coarse_matrix_keeps_the_sidecar(embeddings_dir, monkeypatch):
+    EmbeddingsIO.save_embeddings(make_chunks("a.txt", 4))
+    metadata_path = embeddings_dir / embeddings_io.METADATA_FILE
+    before = metadata_path.read_text()
+
+    def crash_midway(data, file_path, indent=4):
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data)[:20])
+        raise OSError("disk full")
+
+    monkeypatch.setattr(embeddings_io.file_utils, "save_json", crash_midway)
+    with pytest.raises(OSError):
+        EmbeddingsIO.load_coarse_matrix(4)
+    assert metadata_path.read_text() == before
+    monkeypatch.undo()
+    monkeypatch.setattr(embeddings_io, "EMBEDDINGS_DIR", str(embeddings_dir))
+    assert EmbeddingsIO.load_coarse_matrix(4).shape == (4, 4)
+    assert json.loads(metadata_path.read_text())["coarse_dim"] == 4
@@ -0,0 +1,69 @@
+# Unit tests for the retrieval metrics and the evaluation sweep
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from utils.evaluation_metrics import evaluate_rankings, ndcg_at_k, passage_gains
+from tests.fakes import FakeVoyageClient
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def test_metrics_match_hand_computed_values():
+    # One labelled passage per relevant item
+    retrieved = [["a", "b", "c"], ["x", "y", "z"], ["p", "q"]]
+    passages = [[{"a"}, {"c"}], [{"z"}], []]
+    metrics = evaluate_rankings(retrieved, passages, cutoffs=(1, 3))
+    assert metrics["recall@1"] == pytest.approx((1 / 2 + 0 + 0) / 3)
+    assert metrics["recall@3"] == pytest.approx((1 + 1 + 0) / 3)
+    assert metrics["precision@3"] == pytest.approx((2 / 3 + 1 / 3 + 0) / 3)
+    assert metrics["mrr"] == pytest.approx((1 + 1 / 3 + 0) / 3)
+    gains = passage_gains(retrieved[:1], passages[:1], 3)
+    assert ndcg_at_k(gains, np.array([2]), 3) == pytest.approx((1 + 1 / np.log2(4)) / (1 + 1 / np.log2(3)))
+
+
+def test_a_passage_split_across_chunks_counts_once():
+    # Passage P was split into chunks p1, p2 and p3, passage Q is chunk q
+    passages = [[{"p1", "p2", "p3"}, {"q"}]]
+    metrics = evaluate_rankings([["x", "p2", "q", "p1"]], passages, cutoffs=(1, 2, 3))
+    # Finding any piece of P finds P, the other pieces add nothing
+    assert metrics["recall@2"] == pytest.approx(1 / 2)
+    assert metrics["recall@3"] == pytest.approx(1.0)
+    assert metrics["mrr"] == pytest.approx(1 / 2)
+    assert metrics["ndcg@3"] == pytest.approx((1 / np.log2(3) + 1 / np.log2(4)) / (1 + 1 / np.log2(3)))
+    # The same ranking over one chunk per passage scores the same
+    assert evaluate_rankings([["x", "p", "q"]], [[{"p"}, {"q"}]], cutoffs=(1, 2, 3))["recall@3"] == 1.0
+
+
+def test_sweep_reuses_embeddings_and_picks_the_cheapest_configuration(tmp_path, monkeypatch):
+    from src.embeddings import EmbeddingSystem
+    from src.evaluation import RetrievalEvaluator, cheapest_configuration, load_labelled_queries
+    labelled_queries = load_labelled_queries(str(REPO_DIR / "tests" / "test_queries.json"))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "documents").mkdir()
+    shutil.copy(REPO_DIR / "documents" / "test.txt", tmp_path / "documents" / "test.txt")
+
+    client = FakeVoyageClient()
+    embedding_system = EmbeddingSystem(voyageai_client=client)
+    embedding_system.scheduler._progress = lambda progress: None
+    chunkings = [{"chunk_by": "sentence", "chunk_size": 2, "chunk_overlap": 1},
+                 {"chunk_by": "character", "chunk_size": 2000, "chunk_overlap": 200}]
+    evaluator = RetrievalEvaluator(embedding_system, labelled_queries, cutoffs=(1, 5),
+                                   cache_path=str(tmp_path / "evaluation.sqlite"))
+    results = evaluator.run(chunkings, ["dense", "hybrid"])
+    assert len(results) == 4
+    assert all(0 <= result["recall@5"] <= 1 and result["tokens_embedded"] > 0 for result in results[::2])
+    # Keyword search finds the labelled sentences that share words with the query
+    assert results[1]["recall@5"] >= 0.5
+
+    # A second run only embeds the queries (cached) and no chunks
+    num_calls = len(client.calls)
+    rerun = RetrievalEvaluator(embedding_system, labelled_queries, cutoffs=(1, 5),
+                               cache_path=str(tmp_path / "evaluation.sqlite")).run(chunkings, ["dense"])
+    assert len(client.calls) == num_calls and all(result["tokens_embedded"] == 0 for result in rerun)
+
+    best = cheapest_configuration(results, "recall@5", 0.0)
+    assert best["embedding_tokens"] == min(result["embedding_tokens"] for result in results)
+    assert cheapest_configuration(results, "recall@5", 1.01) is None
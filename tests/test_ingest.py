@@ -0,0 +1,105 @@
+# Unit tests for delta ingestion of the documents directory
+import logging
+import os
+import pytest
+from src.embeddings import EmbeddingSystem
+from src.embeddings_io import EmbeddingsIO
+from src.ingest import Ingestor
+from tests.fakes import FakeVoyageClient
+
+
+@pytest.fixture
+def documents_dir(tmp_path, monkeypatch):
+    # DOCUMENTS_DIR, EMBEDDINGS_DIR and INDEXES_DIR are relative paths
+    monkeypatch.chdir(tmp_path)
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    (documents / "a.txt").write_text("The cat sat on the mat. It was a sunny day.", encoding="utf-8")
+    (documents / "b.txt").write_text("Stock markets fell sharply today. Investors were worried.", encoding="utf-8")
+    (documents / "notes.md").write_text("not a supported document", encoding="utf-8")
+    return documents
+
+
+def make_ingestor(client):
+    return Ingestor(EmbeddingSystem(voyageai_client=client),
+                    policy={"*.txt": {"chunk_by": "sentence", "chunk_size": 1, "chunk_overlap": 0}})
+
+
+def test_ingest_applies_only_the_changes(documents_dir):
+    client = FakeVoyageClient()
+    changes = make_ingestor(client).ingest()
+    assert changes == {"added": ["a.txt", "b.txt"], "modified": [], "deleted": []}
+    assert EmbeddingsIO.stored_files() == {"a.txt", "b.txt"}
+
+    # A fresh process sees nothing to do
+    client.calls.clear()
+    ingestor = make_ingestor(client)
+    assert ingestor.ingest() == {"added": [], "modified": [], "deleted": []}
+    assert client.calls == []
+    assert len(ingestor.embedded_chunks) == 4
+
+    # Delete a, modify b and add c
+    os.remove(documents_dir / "a.txt")
+    (documents_dir / "b.txt").write_text("Stock markets fell sharply today. Bonds rallied.", encoding="utf-8")
+    stat = os.stat(documents_dir / "b.txt")
+    os.utime(documents_dir / "b.txt", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    (documents_dir / "c.txt").write_text("A recipe for banana bread.", encoding="utf-8")
+    changes = ingestor.ingest()
+    assert changes == {"added": ["c.txt"], "modified": ["b.txt"], "deleted": ["a.txt"]}
+
+    # Only the new sentences were embedded, and both indexes dropped a.txt
+    assert sorted(text for call in client.calls for text in call) == ["A recipe for banana bread.", "Bonds rallied."]
+    assert EmbeddingsIO.stored_files() == {"b.txt", "c.txt"}
+    assert ingestor.bm25.indexed_files() == {"b.txt", "c.txt"}
+    results = ingestor.embedding_system.similarity_search("banana bread", top_k=1)
+    assert results[0]["file_name"] == "c.txt"
+
+
+def test_ingest_reports_progress_through_the_rag_logger(documents_dir, caplog, capsys):
+    with caplog.at_level(logging.INFO, logger="rag"):
+        make_ingestor(FakeVoyageClient()).ingest()
+    messages = [record.getMessage() for record in caplog.records if record.name == "rag"]
+    assert "2 added, 0 modified, 0 deleted" in messages
+    assert any(message.startswith("Reused 0 cached embeddings") for message in messages)
+    assert any(message.startswith("Ingested 2 files") for message in messages)
+    # Nothing is printed, so a library caller can silence the pipeline through logging
+    assert capsys.readouterr().out == ""
+
+
+def test_changing_the_policy_re_ingests(documents_dir):
+    make_ingestor(FakeVoyageClient()).ingest()
+    ingestor = Ingestor(EmbeddingSystem(voyageai_client=FakeVoyageClient()),
+                        policy={"*.txt": {"chunk_by": "character", "chunk_size": 20, "chunk_overlap": 5}})
+    assert ingestor.ingest()["modified"] == ["a.txt", "b.txt"]
+    assert all(chunk["chunk_by"] == "character" for chunk in ingestor.embedded_chunks)
+
+
+def test_corrupt_files_are_skipped_and_retried(documents_dir):
+    (documents_dir / "REPORT.TXT").write_text("Quarterly revenue grew.", encoding="utf-8")
+    (documents_dir / "bad.pdf").write_bytes(b"%PDF-1.4\n1 0 obj << /Type /Catalog")
+    (documents_dir / "bad.docx").write_bytes(b"PK\x03\x04 truncated")
+    ingestor = make_ingestor(FakeVoyageClient())
+    ingestor.policy = {"*": {"chunk_by": "sentence", "chunk_size": 1, "chunk_overlap": 0}}
+    assert ingestor.ingest()["added"] == ["REPORT.TXT", "a.txt", "b.txt", "bad.docx", "bad.pdf"]
+    assert EmbeddingsIO.stored_files() == {"REPORT.TXT", "a.txt", "b.txt"}
+
+    # The corrupt files were not recorded, so every run tries them again until they can be read
+    import docx
+    document = docx.Document()
+    document.add_paragraph("The docx was repaired.")
+    document.save(str(documents_dir / "bad.docx"))
+    assert ingestor.ingest()["added"] == ["bad.docx", "bad.pdf"]
+    assert EmbeddingsIO.stored_files() == {"REPORT.TXT", "a.txt", "b.txt", "bad.docx"}
+    assert ingestor.ingest()["added"] == ["bad.pdf"]
+
+
+def test_dedup_related_files_follow_chains_of_shared_chunks(documents_dir):
+    # a.txt stands in for a chunk of b.txt, which stands in for a chunk of c.txt
+    def chunk(file_name, source_file):
+        return {"file_name": file_name, "chunk_id": 0, "chunk_content": file_name, "chunk_embeddings": [1.0, 0.0],
+                "duplicate_sources": [{"file_name": source_file, "chunk_id": 1}]}
+    EmbeddingsIO.save_embeddings([chunk("a.txt", "b.txt"), chunk("b.txt", "c.txt"),
+                                  {"file_name": "d.txt", "chunk_id": 0, "chunk_content": "d", "chunk_embeddings": [0.0, 1.0]}])
+    assert Ingestor._dedup_related_files({"a.txt"}) == {"b.txt", "c.txt"}
+    assert Ingestor._dedup_related_files({"c.txt"}) == {"a.txt", "b.txt"}
+    assert Ingestor._dedup_related_files({"d.txt"}) == set()
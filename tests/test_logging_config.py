@@ -0,0 +1,65 @@
+# Unit tests for the pipeline's tracing spans, counters and sampled profiling
+import json
+
+import pytest
+
+from config.logging_config import Telemetry
+
+
+def read_records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_nested_spans_share_a_trace_and_are_exported(tmp_path):
+    path = tmp_path / "telemetry.jsonl"
+    telemetry = Telemetry(export_path=str(path))
+    with telemetry.span("query", user="a") as query:
+        with telemetry.span("retrieve") as retrieve:
+            retrieve["chunks"] = 3
+        with pytest.raises(KeyError):
+            with telemetry.span("generate"):
+                raise KeyError("x")
+
+    retrieve, generate, query = read_records(path)
+    assert [retrieve["name"], generate["name"], query["name"]] == ["retrieve", "generate", "query"]
+    assert retrieve["parent_id"] == generate["parent_id"] == query["span_id"]
+    assert query["parent_id"] is None
+    assert retrieve["trace_id"] == generate["trace_id"] == query["trace_id"]
+    assert retrieve["chunks"] == 3 and query["user"] == "a"
+    assert generate["error"] == "KeyError"
+    assert query["duration_ms"] >= retrieve["duration_ms"] >= 0
+
+    # A new top-level span starts a new trace
+    with telemetry.span("query"):
+        pass
+    assert read_records(path)[-1]["trace_id"] != query["trace_id"]
+    assert telemetry.summary()["query"]["count"] == 2
+
+
+def test_counters_and_export(tmp_path):
+    path = tmp_path / "telemetry.jsonl"
+    telemetry = Telemetry(export_path=str(path))
+    telemetry.increment("embedding_api_calls")
+    telemetry.increment("embedding_tokens", 120)
+    telemetry.increment("embedding_tokens", 30)
+    assert telemetry.counters() == {"embedding_api_calls": 1, "embedding_tokens": 150}
+    telemetry.export_counters()
+    assert read_records(path)[-1]["counters"]["embedding_tokens"] == 150
+    telemetry.reset()
+    assert telemetry.counters() == {} and telemetry.summary() == {}
+
+
+def test_profile_is_sampled(tmp_path):
+    path = tmp_path / "telemetry.jsonl"
+    with Telemetry(export_path=str(path), profile_sample_rate=0).profile("query"):
+        sum(range(1000))
+    assert not path.exists()
+
+    telemetry = Telemetry(export_path=str(path), profile_sample_rate=1, profile_top_functions=5)
+    with telemetry.span("query"):
+        with telemetry.profile("query"):
+            sorted(range(1000), key=lambda i: -i)
+    profile, span = read_records(path)
+    assert profile["type"] == "profile" and profile["trace_id"] == span["trace_id"]
+    assert 0 < len(profile["top_functions"]) <= 5
+    assert any("<lambda>" in function["function"] for function in profile["top_functions"])
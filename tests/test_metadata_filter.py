@@ -0,0 +1,97 @@
+# Unit tests for query-time metadata filters
+import numpy as np
+import pytest
+
+from src.ann_index import IVFIndex
+from src.metadata_filter import MetadataIndex, document_tags
+from src.quantization import QuantizedIndex
+from src.rag_pipeline import RAGSystem
+from tests.fakes import FakeAnthropicClient, FakeAsyncAnthropicClient, FakeVoyageClient
+from utils.vector_utils import exact_search, normalize_rows
+
+CHUNKS = [{"file_name": "syllabus.pdf", "chunk_id": 0, "chunk_by": "token",
+           "chunk_content": "the final exam is on may 12"},
+          {"file_name": "syllabus.pdf", "chunk_id": 1, "chunk_by": "token",
+           "chunk_content": "late homework loses ten percent"},
+          {"file_name": "notes.txt", "chunk_id": 0, "chunk_by": "sentence",
+           "chunk_content": "the final exam covers chapters one to five",
+           "duplicate_sources": [{"file_name": "old_notes.txt", "chunk_id": 3}]},
+          {"file_name": "recipes.docx", "chunk_id": 0, "chunk_by": "character",
+           "chunk_content": "a recipe for banana bread"}]
+TAGS = {"syllabus*": ["course"], "*notes*": ["course", "notes"]}
+
+
+def test_masks_combine_fields_values_and_exclusions():
+    index = MetadataIndex(CHUNKS, TAGS)
+    assert index.mask(None) is None and index.mask({}) is None
+    assert index.mask({"file_name": "notes.txt"}).tolist() == [False, False, True, False]
+    # Values of one field are OR-ed, fields are AND-ed
+    assert index.mask({"extension": ["PDF", ".docx"]}).tolist() == [True, True, False, True]
+    assert index.mask({"tags": ["course"], "chunk_by": ["token"]}).tolist() == [True, True, False, False]
+    assert index.mask({"tags": "course", "exclude": {"extension": "pdf"}}).tolist() == [False, False, True, False]
+    # A deduplicated chunk also belongs to the documents it was collapsed from
+    assert index.mask({"file_name": "old_notes.txt"}).tolist() == [False, False, True, False]
+    assert not index.mask({"file_name": "missing.txt"}).any()
+    assert index.values("tags") == ["course", "notes"]
+    assert document_tags("old_notes.txt", TAGS) == ["course", "notes"]
+    with pytest.raises(ValueError):
+        index.mask({"author": "me"})
+
+
+@pytest.mark.parametrize("fraction_passing", [0.1, 0.6])
+def test_masked_search_matches_search_over_the_passing_rows(fraction_passing):
+    rng = np.random.default_rng(0)
+    matrix = normalize_rows(rng.standard_normal((400, 16)))
+    queries = normalize_rows(rng.standard_normal((3, 16)))
+    row_mask = rng.random(400) < fraction_passing
+    rows = np.flatnonzero(row_mask)
+    expected_idxs, _ = exact_search(matrix[rows], queries, 5)
+
+    idxs, _ = exact_search(matrix, queries, 5, row_mask)
+    np.testing.assert_array_equal(idxs, rows[expected_idxs])
+
+    # Approximate indexes only return rows that pass as well
+    ivf = IVFIndex(nlist=8, nprobe=8, exact_threshold=10)
+    ivf.build(matrix)
+    ivf_idxs, _ = ivf.search(matrix, queries, 5, row_mask=row_mask)
+    np.testing.assert_array_equal(ivf_idxs, rows[expected_idxs])
+    quantized = QuantizedIndex("int8", num_candidates=50)
+    quantized.build(matrix)
+    quantized_idxs, _ = quantized.search(lambda found: matrix[found], queries, 5, row_mask)
+    assert row_mask[quantized_idxs].all()
+
+
+def test_filtered_queries_reuse_the_loaded_indexes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    voyage = FakeVoyageClient()
+    rag_system = RAGSystem(anthropic_client=FakeAnthropicClient("May 12."),
+                           async_anthropic_client=FakeAsyncAnthropicClient("May 12."),
+                           voyageai_client=voyage)
+    rag_system.embedded_chunks = [{**chunk, "chunk_embeddings": voyage.embed_text(chunk["chunk_content"])}
+                                  for chunk in CHUNKS]
+    rag_system.multi_index.index_chunks(rag_system.embedded_chunks)
+
+    assert {chunk["file_name"] for chunk in rag_system.retrieve("final exam")} >= {"syllabus.pdf", "notes.txt"}
+    # Both retrievers skip the chunks that are filtered out
+    results = rag_system.retrieve("final exam", filters={"extension": [".txt"]})
+    assert [chunk["file_name"] for chunk in results] == ["notes.txt"]
+    results = rag_system.retrieve("final exam", filters={"exclude": {"file_name": ["notes.txt"]}})
+    assert "notes.txt" not in {chunk["file_name"] for chunk in results}
+    assert rag_system.query("when is the final exam", filters={"chunk_by": "token"}) == "May 12."
+    assert "late homework" in rag_system.client.requests[-1]["system"][-1]["text"]
+
+
+def test_bm25_mask_follows_the_dense_rows_of_duplicate_keys(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    voyage = FakeVoyageClient()
+    rag_system = RAGSystem(anthropic_client=FakeAnthropicClient(), async_anthropic_client=FakeAsyncAnthropicClient(),
+                           voyageai_client=voyage)
+    # The first chunk's key appears twice, every later row must still map to its own position
+    chunks = [CHUNKS[0], CHUNKS[0], *CHUNKS[1:]]
+    rag_system.embedded_chunks = [{**chunk, "chunk_embeddings": voyage.embed_text(chunk["chunk_content"])}
+                                  for chunk in chunks]
+    rag_system.multi_index.index_chunks(rag_system.embedded_chunks)
+    row_mask = np.array([chunk["file_name"] == "recipes.docx" for chunk in chunks])
+    doc_mask = rag_system.multi_index._bm25_doc_mask(row_mask)
+    assert [key for key, passes in zip(rag_system.multi_index.bm25.doc_keys(), doc_mask) if passes] \
+        == [("recipes.docx", 0)]
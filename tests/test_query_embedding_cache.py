@@ -0,0 +1,43 @@
+# Unit tests for the query embedding cache
+from src.embeddings import EmbeddingSystem
+from src.query_embedding_cache import QueryEmbeddingCache
+from tests.fakes import FakeVoyageClient
+
+
+def test_known_queries_skip_the_embed_call(tmp_path):
+    client = FakeVoyageClient()
+    system = EmbeddingSystem(voyageai_client=client,
+                             query_cache=QueryEmbeddingCache(path=str(tmp_path / "queries.sqlite")))
+    first = system.get_embeddings(["banana bread", "markets fell", "banana bread"])
+    assert client.calls == [["banana bread", "markets fell"]]
+
+    # Only the new query is embedded, and cached embeddings come back unchanged
+    second = system.get_embeddings(["markets fell", "world cup"])
+    assert client.calls[-1] == ["world cup"]
+    assert second[0] == first[1]
+    assert system.get_embedding("banana bread") == first[0]
+    assert len(client.calls) == 2
+    assert system.query_cache.metrics()["hits"] == 2
+
+
+def test_lru_eviction_and_disk_persistence(tmp_path):
+    path = str(tmp_path / "queries.sqlite")
+    cache = QueryEmbeddingCache(max_entries=2, path=path)
+    cache.put_many({"a": [1.0, 0.0], "b": [0.0, 1.0]}, "model", "query")
+    cache.get_many(["a"], "model", "query")
+    cache.put_many({"c": [0.5, 0.5]}, "model", "query")
+    assert len(cache) == 2 and cache.key("b", "model", "query") not in cache._memory
+
+    # A new process finds every embedding on disk, but only for the same model and input type
+    reopened = QueryEmbeddingCache(max_entries=2, path=path)
+    assert reopened.get_many(["a", "b", "c"], "model", "query") == {"a": [1.0, 0.0], "b": [0.0, 1.0], "c": [0.5, 0.5]}
+    assert reopened.get_many(["a"], "other-model", "query") == {}
+    assert reopened.metrics()["disk_hits"] == 3 and reopened.metrics()["misses"] == 1
+
+
+def test_memory_only_cache_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = QueryEmbeddingCache(path=None)
+    cache.put_many({"a": [1.0]}, "model", "query")
+    assert cache.get_many(["a"], "model", "query") == {"a": [1.0]}
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,121 @@
+# Unit tests for streaming and async queries through RAGSystem
+import asyncio
+import pytest
+from config.config import PROMPT_CACHE_MIN_TOKENS
+from config.logging_config import telemetry
+from src.rag_pipeline import RAGSystem
+from tests.fakes import FakeAnthropicClient, FakeAsyncAnthropicClient, FakeVoyageClient
+
+TEXTS = ["the cat sat on the mat",
+         "stock markets fell sharply today",
+         "the world cup final was in uruguay"]
+
+
+@pytest.fixture
+def rag_system(tmp_path, monkeypatch):
+    # The BM25 index and the other indexes are loaded from relative paths
+    monkeypatch.chdir(tmp_path)
+    voyage = FakeVoyageClient()
+    system = RAGSystem(anthropic_client=FakeAnthropicClient("The final was in Uruguay.", token_latency=0.01),
+                       async_anthropic_client=FakeAsyncAnthropicClient("Cats sit on mats.", token_latency=0.01),
+                       voyageai_client=voyage)
+    system.embedded_chunks = [{"file_name": "f.txt", "chunk_id": i, "chunk_content": text,
+                               "chunk_embeddings": voyage.embed_text(text)}
+                              for i, text in enumerate(TEXTS)]
+    system.multi_index.index_chunks(system.embedded_chunks)
+    return system
+
+
+def test_query_stream_yields_tokens_and_records_timings(rag_system):
+    tokens = list(rag_system.query_stream("where was the world cup final"))
+    assert tokens == ["The ", "final ", "was ", "in ", "Uruguay."]
+    timings = rag_system.query_timings[-1]
+    assert timings["query"] == "where was the world cup final"
+    assert 0 <= timings["retrieval_seconds"] <= timings["time_to_first_token"] < timings["total_seconds"]
+    assert timings["num_chunks_streamed"] == 5
+    # The retrieved chunk went into the context, which follows the instructions in the system prompt
+    instructions, context = rag_system.client.requests[-1]["system"]
+    assert TEXTS[2] in context["text"]
+    assert "where was the world cup final" in rag_system.client.prompts[-1][0]["content"]
+    # A prefix this short is never cached by the API, so it is not marked
+    assert "cache_control" not in instructions and "cache_control" not in context
+    assert rag_system.query("world cup") == "The final was in Uruguay."
+
+
+def test_async_queries_run_concurrently(rag_system):
+    async def ask_all():
+        return await asyncio.gather(*(rag_system.aquery("cat on a mat") for _ in range(5)))
+
+    answers = asyncio.run(ask_all())
+    assert answers == ["Cats sit on mats."] * 5
+    timings = list(rag_system.query_timings)[-5:]
+    assert all(timing["time_to_first_token"] is not None for timing in timings)
+    # Five answers of 4 tokens streamed concurrently take about as long as one
+    assert max(timing["total_seconds"] for timing in timings) < 5 * 0.03
+
+
+def test_repeated_query_is_answered_from_the_cache(rag_system):
+    assert rag_system.query("where was the world cup final") == "The final was in Uruguay."
+    num_prompts = len(rag_system.client.prompts)
+    assert rag_system.query("Where was the World Cup final?") == "The final was in Uruguay."
+    assert len(rag_system.client.prompts) == num_prompts
+    assert rag_system.query_timings[-1]["cached"]
+    assert rag_system.answer_cache.metrics()["hits"] == 1
+
+
+def test_query_records_spans_and_counters(rag_system):
+    telemetry.reset()
+    rag_system.query("where was the world cup final")
+    summary = telemetry.summary()
+    assert {"query", "embed_query", "retrieve", "generate"} <= set(summary)
+    counters = telemetry.counters()
+    assert counters["llm_calls"] == 1 and counters["input_tokens"] > 0 and counters["output_tokens"] > 0
+    assert counters["query_embedding_cache_misses"] == 1
+
+
+
+def test_specified_files_can_exclude_neighbouring_documents(rag_system, tmp_path):
+    # The fixture runs in tmp_path, where the relative DOCUMENTS_DIR is created
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    for name in ["a.txt", "b.txt", "c.txt", "d.txt"]:
+        (documents / name).write_text(name)
+    assert sorted(rag_system._get_specified_files(exclude_documents=["a.txt", "b.txt"])) == ["c.txt", "d.txt"]
+    assert rag_system._get_specified_files(["b.txt", "c.txt"], ["c.txt"]) == ["b.txt"]
+
+
+def test_embed_documents_passes_an_explicit_zero_overlap(rag_system, tmp_path, monkeypatch):
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    (documents / "a.txt").write_text("abcdefghijklmnopqrstuvwxyz")
+    monkeypatch.setattr("builtins.input", lambda prompt: "c")
+    rag_system.embed_documents(chunk_size=10, chunk_overlap=0)
+    assert [chunk["chunk_content"] for chunk in rag_system.embedded_chunks] == ["abcdefghij", "klmnopqrst", "uvwxyz"]
+
+
+def test_long_contexts_are_marked_for_prompt_caching(rag_system):
+    long_text = " ".join(f"word{i}" for i in range(1000))
+    params = rag_system._message_params("what is word7", [{"file_name": "g.txt", "chunk_id": 0,
+                                                           "chunk_content": long_text}])
+    # The breakpoint closes the instructions and the context, the query comes after it
+    assert params["system"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert "word999" in params["system"][-1]["text"]
+    assert "what is word7" in params["messages"][0]["content"]
+
+
+def test_prompt_cache_usage_is_counted(rag_system):
+    long_text = " ".join(f"word{i}" for i in range(1000))
+    rag_system.answer_cache = None
+    rag_system.embed_and_retrieve_many = lambda queries, filters=None: [
+        (None, [{"file_name": "g.txt", "chunk_id": 0, "chunk_content": long_text}]) for _ in queries]
+    telemetry.reset()
+    rag_system.query("what is word7")
+    counters = telemetry.counters()
+    # The first query writes the instructions and the context to the cache
+    assert counters["cache_creation_input_tokens"] >= PROMPT_CACHE_MIN_TOKENS
+    assert counters["cache_read_input_tokens"] == 0
+    # A second query over the same chunks reads them back, only the query is billed as input
+    rag_system.query("which word comes after word7")
+    counters = telemetry.counters()
+    assert counters["cache_read_input_tokens"] == counters["cache_creation_input_tokens"]
+    assert counters["input_tokens"] < 50
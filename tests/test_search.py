@@ -1 +1,250 @@
-# Unit tests for search functionality
\ No newline at end of file
+# Unit tests for search functionality
+import numpy as np
+import pytest
+from src.bm25 import BM25Search
+from src.embeddings import EmbeddingSystem
+from utils.vector_utils import top_k_indices
+from tests.fakes import FakeVoyageClient
+
+
+TEXTS = ["the cat sat on the mat",
+         "dogs chase cats in the park",
+         "stock markets fell sharply today",
+         "the world cup final was in uruguay",
+         "a recipe for banana bread"]
+
+
+@pytest.fixture
+def embedded(tmp_path, monkeypatch):
+    # Query embeddings are cached under the relative EMBEDDINGS_DIR
+    monkeypatch.chdir(tmp_path)
+    client = FakeVoyageClient()
+    system = EmbeddingSystem(voyageai_client=client)
+    chunks = [{"file_name": "f.txt", "chunk_id": i, "chunk_content": text,
+               "chunk_embeddings": client.embed_text(text)}
+              for i, text in enumerate(TEXTS)]
+    system.index_chunks(chunks)
+    return system, chunks
+
+
+def test_top_k_indices_matches_full_sort():
+    scores = np.random.default_rng(0).standard_normal((3, 100))
+    expected = np.argsort(-scores, axis=1)[:, :7]
+    np.testing.assert_array_equal(top_k_indices(scores, 7), expected)
+    assert top_k_indices(scores[0], 500).shape == (100,)
+
+
+def test_similarity_search_returns_best_match_first(embedded):
+    system, chunks = embedded
+    results = system.similarity_search("world cup in uruguay", chunks, top_k=2)
+    assert results[0]["chunk_content"] == TEXTS[3]
+    assert len(results) == 2
+
+
+def test_similarity_search_many_uses_one_embed_call(embedded):
+    system, _ = embedded
+    client = system._voyageai_client
+    client.calls.clear()
+    results = system.similarity_search_many(["banana bread", "markets fell"], top_k=1)
+    assert [r[0]["chunk_id"] for r in results] == [4, 2]
+    assert len(client.calls) == 1
+
+
+def test_index_is_rebuilt_when_chunks_change(embedded):
+    system, chunks = embedded
+    more_chunks = chunks + [{"file_name": "g.txt", "chunk_id": 0, "chunk_content": "quantum physics",
+                             "chunk_embeddings": system._voyageai_client.embed_text("quantum physics")}]
+    assert system.similarity_search("quantum physics", more_chunks)[0]["file_name"] == "g.txt"
+
+
+def test_embed_chunks_only_embeds_new_or_changed_chunks(tmp_path, monkeypatch):
+    from src import embeddings_io
+    monkeypatch.setattr(embeddings_io, "EMBEDDINGS_DIR", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    client = FakeVoyageClient()
+    system = EmbeddingSystem(voyageai_client=client)
+    system.scheduler._progress = lambda progress: None
+
+    def chunk(i, text):
+        return {"file_name": "f.txt", "chunk_id": i, "chunk_content": text}
+
+    system.embed_chunks([chunk(i, text) for i, text in enumerate(TEXTS)])
+    assert sum(len(call) for call in client.calls) == len(TEXTS)
+
+    client.calls.clear()
+    system.embed_chunks([chunk(i, text) for i, text in enumerate(TEXTS)])
+    assert client.calls == []
+
+    edited = [chunk(i, text) for i, text in enumerate(TEXTS[:3] + ["a brand new paragraph"])]
+    embedded = system.embed_chunks(edited)
+    assert client.calls == [["a brand new paragraph"]]
+    assert embeddings_io.EmbeddingsIO.load_store()[0].shape[0] == 4
+    assert system.similarity_search("brand new paragraph", embedded)[0]["chunk_id"] == 3
+
+
+def test_embed_chunks_streams_batches_into_the_store(tmp_path, monkeypatch):
+    from src import embeddings_io
+    from src.dedup import iter_unique_chunks
+    monkeypatch.setattr(embeddings_io, "EMBEDDINGS_DIR", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    client = FakeVoyageClient()
+    system = EmbeddingSystem(voyageai_client=client)
+    system.scheduler._progress = lambda progress: None
+
+    # Record how many rows were stored when each chunk was read from the stream
+    stored_rows = []
+    def chunks():
+        for i, text in enumerate(TEXTS + [TEXTS[0]]):
+            matrix = embeddings_io.EmbeddingsIO.open_matrix()
+            stored_rows.append(0 if matrix is None else matrix.shape[0])
+            yield {"file_name": "f.txt", "chunk_id": i, "chunk_content": text}
+
+    duplicate_sources = {}
+    embedded = system.embed_chunks(iter_unique_chunks(chunks(), duplicate_sources), batch_size=2,
+                                   duplicate_sources=duplicate_sources)
+    assert [len(call) for call in client.calls] == [2, 2, 1]
+    assert stored_rows == [0, 0, 2, 2, 4, 4]
+    # The repeated chunk arrived after its first copy was stored, and is still recorded on it
+    assert embedded[0]["duplicate_sources"] == [{"file_name": "f.txt", "chunk_id": len(TEXTS)}]
+    assert [chunk["row"] for chunk in embedded] == list(range(len(TEXTS)))
+
+
+def bm25_chunks(file_name, texts):
+    return [{"file_name": file_name, "chunk_id": i, "chunk_content": text} for i, text in enumerate(texts)]
+
+
+def test_bm25_scores_match_reference_formula():
+    from utils.text_processing import tokenize
+    index = BM25Search()
+    chunks = bm25_chunks("f.txt", TEXTS) + bm25_chunks("g.txt", ["the cat and the dog", "cats cats cats"])
+    index.build_index(chunks)
+
+    results = index.search("the cat", top_k=10)
+    assert results[0]["file_name"] == "g.txt" and results[0]["chunk_id"] == 0
+    by_key = {(chunk["file_name"], chunk["chunk_id"]): chunk for chunk in chunks}
+    for result in results:
+        doc_terms = tokenize(by_key[(result["file_name"], result["chunk_id"])]["chunk_content"])
+        assert result["score"] == pytest.approx(index._calculate_bm25_score(["the", "cat"], doc_terms))
+    # Only chunks containing a query term are scored
+    assert len(results) == 4
+
+
+def test_bm25_incremental_updates_match_a_full_rebuild(tmp_path):
+    incremental = BM25Search()
+    incremental.add_chunks(bm25_chunks("f.txt", TEXTS))
+    incremental.add_chunks(bm25_chunks("g.txt", ["the world cup", "banana splits"]))
+    incremental.add_chunks(bm25_chunks("f.txt", TEXTS[:2]))
+    incremental.remove_files(["g.txt"])
+    incremental.add_chunks(bm25_chunks("h.txt", ["uruguay won the world cup"]))
+
+    rebuilt = BM25Search()
+    rebuilt.build_index(bm25_chunks("f.txt", TEXTS[:2]) + bm25_chunks("h.txt", ["uruguay won the world cup"]))
+
+    assert incremental.indexed_files() == {"f.txt", "h.txt"}
+    for query in ["the cat", "world cup", "banana", "park dogs"]:
+        assert incremental.search(query, top_k=5) == pytest.approx(rebuilt.search(query, top_k=5))
+
+    incremental.save(str(tmp_path))
+    loaded = BM25Search.load(str(tmp_path))
+    assert len(loaded) == 3
+    assert loaded.search("world cup") == incremental.search("world cup")
+    assert BM25Search.load(str(tmp_path / "missing")) is None
+
+
+@pytest.mark.parametrize("fusion", ["rrf", "weighted"])
+def test_multi_index_fuses_dense_and_bm25_results(embedded, fusion):
+    from src.multi_index import MultiIndex
+    system, chunks = embedded
+    multi_index = MultiIndex(system, BM25Search(), fusion=fusion)
+    multi_index.index_chunks(chunks)
+
+    results = multi_index.search("cat on the mat", top_k=2)
+    assert results[0]["chunk_content"] == TEXTS[0]
+    assert set(results[0]["retriever_scores"]) == {"dense", "bm25"}
+    assert results[0]["fused_score"] >= results[1]["fused_score"]
+    # Results are copies, the indexed chunks are not modified
+    assert "fused_score" not in chunks[0]
+
+
+def clustered_vectors(num_rows, dim=32, num_clusters=20, seed=0):
+    from utils.vector_utils import normalize_rows
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim))
+    return normalize_rows(centers[rng.integers(num_clusters, size=num_rows)]
+                          + 0.3 * rng.standard_normal((num_rows, dim)))
+
+
+def test_ivf_index_recall_and_exact_fallback(tmp_path):
+    from src.ann_index import IVFIndex, recall_report
+    matrix = clustered_vectors(3000)
+    queries = clustered_vectors(50, seed=1)
+
+    small_index = IVFIndex(exact_threshold=10_000)
+    small_index.build(matrix)
+    assert not small_index.is_trained
+
+    index = IVFIndex(nlist=40, nprobe=40, exact_threshold=1000)
+    index.build(matrix)
+    report = recall_report(matrix, queries, index, top_k=10, nprobes=[1, 8, 40])
+    assert [row["nprobe"] for row in report] == [1, 8, 40]
+    assert report[0]["recall"] <= report[1]["recall"] <= report[2]["recall"] == 1.0
+    assert report[1]["recall"] > 0.8
+
+    index.save(str(tmp_path))
+    loaded = IVFIndex.load(str(tmp_path))
+    np.testing.assert_array_equal(loaded.search(matrix, queries, 5)[0], index.search(matrix, queries, 5)[0])
+
+
+def test_ivf_index_incremental_insert():
+    from src.ann_index import IVFIndex
+    matrix = clustered_vectors(2000)
+    index = IVFIndex(nlist=20, nprobe=20, exact_threshold=1000)
+    index.build(matrix[:1500])
+    index.add(matrix)
+    assert index.num_rows == 2000
+    idxs, scores = index.search(matrix, matrix[1990:], top_k=1)
+    np.testing.assert_array_equal(idxs[:, 0], np.arange(1990, 2000))
+
+
+def test_quantized_search_recall_after_rescoring():
+    from src.quantization import quantization_report
+    matrix = clustered_vectors(2000, dim=32)
+    queries = clustered_vectors(30, dim=32, seed=1)
+    report = {row["kind"]: row for row in quantization_report(matrix, queries, top_k=10, num_candidates=100)}
+
+    assert report["int8"]["compression"] == 4
+    assert report["pq"]["bytes_per_vector"] == 32
+    assert report["int8"]["recall_rescored"] >= 0.95
+    assert report["pq"]["recall_rescored"] >= report["pq"]["recall_codes_only"]
+    assert report["pq"]["recall_rescored"] >= 0.8
+
+
+def test_embedding_system_searches_quantized_codes(embedded, tmp_path, monkeypatch):
+    from src.quantization import QuantizedIndex
+    system, chunks = embedded
+    system.quantized_index = QuantizedIndex("int8", num_candidates=3)
+    system.index_chunks(chunks)
+    assert system._normalized_matrix is None
+    assert system.similarity_search("world cup in uruguay", chunks)[0]["chunk_content"] == TEXTS[3]
+
+
+def test_two_stage_search_matches_full_dimension_ranking(embedded, tmp_path, monkeypatch):
+    from src import embeddings_io
+    monkeypatch.setattr(embeddings_io, "EMBEDDINGS_DIR", str(tmp_path))
+    system, chunks = embedded
+    full_results = system.similarity_search_many_with_scores(TEXTS, chunks, top_k=3)
+
+    # Stored chunks gather the coarse matrix saved alongside the full one
+    embeddings_io.EmbeddingsIO.save_embeddings(chunks)
+    stored_chunks = embeddings_io.EmbeddingsIO.load_embeddings("f.txt")
+    system.coarse_dimensions = 16
+    system.coarse_candidates = 5
+    system.index_chunks(stored_chunks)
+    assert system._normalized_matrix.shape == (len(TEXTS), 16)
+    assert (tmp_path / embeddings_io.COARSE_MATRIX_FILE).exists()
+
+    # Same scores (ties may come back in either order)
+    two_stage_results = system.similarity_search_many_with_scores(TEXTS, stored_chunks, top_k=3)
+    np.testing.assert_allclose([[score for _, score in results] for results in two_stage_results],
+                               [[score for _, score in results] for results in full_results], atol=1e-6)
+    assert [results[0][0]["chunk_id"] for results in two_stage_results] == list(range(len(TEXTS)))
@@ -0,0 +1,95 @@
+# End-to-end tests for the HTTP query server with fake Voyage and Anthropic clients
+import asyncio
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from src.rag_pipeline import RAGSystem
+from src.server import QueryServer
+from tests.fakes import FakeAnthropicClient, FakeAsyncAnthropicClient, FakeVoyageClient
+
+TEXTS = ["the cat sat on the mat",
+         "stock markets fell sharply today",
+         "the world cup final was in uruguay"]
+
+
+@pytest.fixture
+def rag_system(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    voyage = FakeVoyageClient()
+    system = RAGSystem(anthropic_client=FakeAnthropicClient(),
+                       async_anthropic_client=FakeAsyncAnthropicClient("It was in Uruguay.", token_latency=0.02),
+                       voyageai_client=voyage)
+    system.embedded_chunks = [{"file_name": "f.txt", "chunk_id": i, "chunk_content": text,
+                               "chunk_embeddings": voyage.embed_text(text)}
+                              for i, text in enumerate(TEXTS)]
+    system.multi_index.index_chunks(system.embedded_chunks)
+    voyage.calls.clear()
+    return system
+
+
+async def run_with_client(server, requests):
+    client = TestClient(TestServer(server.create_app()))
+    await client.start_server()
+    try:
+        return await requests(client)
+    finally:
+        await client.close()
+
+
+def test_concurrent_queries_share_one_embed_call(rag_system):
+    server = QueryServer(rag_system, batch_wait_ms=20)
+
+    async def requests(client):
+        async def ask(query):
+            response = await client.post("/query", json={"query": query})
+            return response.status, await response.json()
+        return await asyncio.gather(*(ask(f"where was the world cup final {i}") for i in range(8)))
+
+    results = asyncio.run(run_with_client(server, requests))
+    assert all(status == 200 for status, _ in results)
+    assert all(body["answer"] == "It was in Uruguay." for _, body in results)
+    assert all(body["sources"][0] == {"file_name": "f.txt", "chunk_id": 2} for _, body in results)
+    assert len(rag_system.embedding_system._voyageai_client.calls) == 1
+    assert server.batcher.num_batches == 1 and server.batcher.num_queries == 8
+
+
+def test_streaming_response_and_bad_requests(rag_system):
+    async def requests(client):
+        streamed = await client.post("/query", json={"query": "world cup", "stream": True})
+        text = await streamed.text()
+        bad = await client.post("/query", json={"question": "world cup"})
+        health = await client.get("/health")
+        return text, bad.status, await health.json()
+
+    text, bad_status, health = asyncio.run(run_with_client(QueryServer(rag_system), requests))
+    assert text == "It was in Uruguay."
+    assert bad_status == 400
+    assert health["chunks"] == 3 and health["pending_requests"] == 0
+    assert health["query_embedding_cache"]["misses"] == 1
+
+
+def test_requests_over_the_pending_limit_are_rejected(rag_system):
+    server = QueryServer(rag_system, max_llm_concurrency=1, max_pending_requests=2)
+
+    async def requests(client):
+        responses = await asyncio.gather(*(client.post("/query", json={"query": "cat"}) for _ in range(5)))
+        return [(response.status, response.headers.get("Retry-After")) for response in responses]
+
+    statuses = asyncio.run(run_with_client(server, requests))
+    assert sorted(status for status, _ in statuses) == [200, 200, 503, 503, 503]
+    assert all(retry_after == "1" for status, retry_after in statuses if status == 503)
+    assert server.num_rejected == 3
+
+
+def test_filtered_queries_and_metrics(rag_system):
+    async def requests(client):
+        filtered = await client.post("/query", json={"query": "world cup", "filters": {"file_name": ["g.txt"]}})
+        unknown_field = await client.post("/query", json={"query": "world cup", "filters": {"author": "me"}})
+        not_an_object = await client.post("/query", json={"query": "world cup", "filters": ["f.txt"]})
+        metrics = await client.get("/metrics")
+        return await filtered.json(), unknown_field.status, not_an_object.status, await metrics.json()
+
+    filtered, unknown_status, not_an_object_status, metrics = asyncio.run(
+        run_with_client(QueryServer(rag_system), requests))
+    assert filtered["sources"] == []
+    assert unknown_status == 400 and not_an_object_status == 400
+    assert "retrieve" in metrics["spans"] and metrics["counters"]["chunks_scanned"] > 0
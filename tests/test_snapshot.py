@@ -0,0 +1,90 @@
+# Unit tests for lazy imports and the warm-start snapshot
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from src.embeddings import EmbeddingSystem
+from src.embeddings_io import EmbeddingsIO
+from src.query_embedding_cache import QueryEmbeddingCache
+from src.rag_pipeline import RAGSystem
+from src.snapshot import SNAPSHOT_FILE, load_snapshot
+from tests.fakes import FakeAnthropicClient, FakeAsyncAnthropicClient, FakeVoyageClient
+
+TEXTS = ["the cat sat on the mat",
+         "stock markets fell sharply today",
+         "the world cup final was in uruguay",
+         "a recipe for banana bread"]
+
+
+def embed(file_name, texts):
+    client = FakeVoyageClient()
+    system = EmbeddingSystem(voyageai_client=client, query_cache=QueryEmbeddingCache(path=None))
+    system.embed_chunks([{"file_name": file_name, "chunk_id": i, "chunk_content": text}
+                         for i, text in enumerate(texts)], index=False)
+
+
+def new_rag_system():
+    return RAGSystem(anthropic_client=FakeAnthropicClient("An answer."),
+                     async_anthropic_client=FakeAsyncAnthropicClient("An answer."),
+                     voyageai_client=FakeVoyageClient())
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # The store, indexes and snapshot live under relative paths
+    monkeypatch.chdir(tmp_path)
+    embed("f.txt", TEXTS)
+    return tmp_path
+
+
+def test_restart_restores_the_snapshot(store, monkeypatch):
+    first = new_rag_system()
+    assert first.load_index() == len(TEXTS)
+    assert (store / "data" / "snapshot" / SNAPSHOT_FILE).exists()
+
+    # The next start neither reads the store's metadata nor rebuilds any index
+    def fail(*args, **kwargs):
+        raise AssertionError("the snapshot should have been restored")
+    monkeypatch.setattr(EmbeddingsIO, "load_files_embeddings", fail)
+    monkeypatch.setattr(EmbeddingSystem, "index_chunks", fail)
+    second = new_rag_system()
+    assert second.load_index() == len(TEXTS)
+    for query in ["world cup in uruguay", "banana bread", "markets"]:
+        assert ([chunk["chunk_id"] for chunk in second.retrieve(query)]
+                == [chunk["chunk_id"] for chunk in first.retrieve(query)])
+    assert second.chunk_positions.get("f.txt", 1)["chunk_content"] == TEXTS[1]
+
+
+def test_snapshot_is_rebuilt_when_the_store_changes(store):
+    new_rag_system().load_index()
+    assert load_snapshot() is not None
+    embed("g.txt", ["quantum physics"])
+    assert load_snapshot() is None
+
+    rag_system = new_rag_system()
+    assert rag_system.load_index() == len(TEXTS) + 1
+    assert rag_system.retrieve("quantum physics")[0]["file_name"] == "g.txt"
+    assert len(load_snapshot()["chunks"]) == len(TEXTS) + 1
+
+
+def test_snapshot_is_rebuilt_when_index_settings_change(store, monkeypatch):
+    new_rag_system().load_index()
+    assert load_snapshot() is not None
+    monkeypatch.setattr("src.snapshot.PQ_SUBVECTORS", 32)
+    assert load_snapshot() is None
+    monkeypatch.setattr("src.snapshot.PQ_SUBVECTORS", 64)
+    monkeypatch.setattr("src.snapshot.ANN_EXACT_THRESHOLD", 5)
+    assert load_snapshot() is None
+
+
+def test_importing_the_pipeline_defers_heavy_packages():
+    # Embedding with an injected client never needs voyageai either
+    code = ("import sys, src.rag_pipeline; from tests.fakes import FakeVoyageClient; "
+            "from src.embeddings import EmbeddingSystem; from src.query_embedding_cache import QueryEmbeddingCache; "
+            "EmbeddingSystem(FakeVoyageClient(), QueryEmbeddingCache(path=None)).scheduler.embed(['a', 'b']); "
+            "print(sorted(m for m in ('anthropic', 'voyageai', 'pypdf', 'docx') if m in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent.parent,
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == "[]"
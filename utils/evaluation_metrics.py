@@ -1 +1,101 @@
-# Calculate precision, recall, etc.
\ No newline at end of file
+# Retrieval quality metrics (recall@k, precision@k, MRR, nDCG@k) over a labelled query set
+from typing import Dict, Iterable, Sequence, Set
+
+import numpy as np
+
+
+def relevance_matrix(retrieved: Sequence[Sequence], relevant: Sequence[Set], k: int) -> np.ndarray:
+    """Mark which of the first k retrieved items of every query are relevant
+
+    Args:
+        retrieved (Sequence[Sequence]): the ranked item keys retrieved for each query
+        relevant (Sequence[Set]): the relevant item keys of each query
+        k (int): how many ranks to keep (shorter rankings are padded with misses)
+
+    Returns:
+        np.ndarray: (num_queries, k) bool matrix, True where the item at that rank is relevant
+    """
+    hits = np.zeros((len(retrieved), k), dtype=bool)
+    for i, (ranking, relevant_keys) in enumerate(zip(retrieved, relevant)):
+        hits[i, :min(len(ranking), k)] = [key in relevant_keys for key in ranking[:k]]
+    return hits
+
+
+def passage_gains(retrieved: Sequence[Sequence], passages: Sequence[Sequence[Set]], k: int) -> np.ndarray:
+    """Count the labelled passages first found at every rank
+
+    A passage is found by the first retrieved item that covers it, later items covering it add
+    nothing, so a passage split across several items counts once however it was chunked
+
+    Args:
+        retrieved (Sequence[Sequence]): the ranked item keys retrieved for each query
+        passages (Sequence[Sequence[Set]]): for each query, the item keys covering each of its passages
+        k (int): how many ranks to keep
+
+    Returns:
+        np.ndarray: (num_queries, k) matrix, the number of passages whose first hit is at that rank
+    """
+    gains = np.zeros((len(retrieved), k))
+    for i, (ranking, query_passages) in enumerate(zip(retrieved, passages)):
+        for passage_keys in query_passages:
+            for rank, key in enumerate(ranking[:k]):
+                if key in passage_keys:
+                    gains[i, rank] += 1
+                    break
+    return gains
+
+
+def recall_at_k(gains: np.ndarray, num_passages: np.ndarray, k: int) -> float:
+    """Mean fraction of each query's labelled passages found in its first k results"""
+    return float(np.mean(gains[:, :k].sum(axis=1) / np.maximum(num_passages, 1)))
+
+
+def precision_at_k(hits: np.ndarray, k: int) -> float:
+    """Mean fraction of each query's first k results that are relevant"""
+    return float(np.mean(hits[:, :k].sum(axis=1) / k))
+
+
+def mean_reciprocal_rank(gains: np.ndarray) -> float:
+    """Mean of 1 / (rank of the first hit of any passage), 0 for queries with none"""
+    found = gains.any(axis=1)
+    first_rank = (gains > 0).argmax(axis=1) + 1
+    return float(np.mean(np.where(found, 1.0 / first_rank, 0.0)))
+
+
+def ndcg_at_k(gains: np.ndarray, num_passages: np.ndarray, k: int) -> float:
+    """Mean normalized discounted cumulative gain of the first k results, one gain per passage at its first hit"""
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    dcg = (gains[:, :k] * discounts).sum(axis=1)
+    # The ideal ranking finds one passage at each of the first ranks (a result covering several
+    # passages at once can beat it, so the ratio is capped at 1)
+    ideal_discounts = np.concatenate([[0.0], np.cumsum(discounts)])
+    idcg = ideal_discounts[np.minimum(num_passages, k)]
+    return float(np.mean(np.minimum(np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0), 1.0)))
+
+
+def evaluate_rankings(retrieved: Sequence[Sequence],
+                      passages: Sequence[Sequence[Set]],
+                      cutoffs: Iterable[int] = (1, 3, 5, 10)) -> Dict[str, float]:
+    """Compute every metric at every cutoff
+
+    Recall, MRR and nDCG count labelled passages (found by their first covering result),
+    precision counts the results that cover any passage
+
+    Args:
+        retrieved (Sequence[Sequence]): the ranked item keys retrieved for each query
+        passages (Sequence[Sequence[Set]]): for each query, the item keys covering each of its passages
+        cutoffs (Iterable[int], optional): the values of k. Defaults to (1, 3, 5, 10).
+
+    Returns:
+        Dict[str, float]: "mrr", and "recall@k", "precision@k" and "ndcg@k" for every cutoff
+    """
+    cutoffs = sorted(cutoffs)
+    gains = passage_gains(retrieved, passages, cutoffs[-1])
+    hits = relevance_matrix(retrieved, [set().union(*query_passages) for query_passages in passages], cutoffs[-1])
+    num_passages = np.array([len(query_passages) for query_passages in passages])
+    metrics = {"mrr": mean_reciprocal_rank(gains)}
+    for k in cutoffs:
+        metrics[f"recall@{k}"] = recall_at_k(gains, num_passages, k)
+        metrics[f"precision@{k}"] = precision_at_k(hits, k)
+        metrics[f"ndcg@{k}"] = ndcg_at_k(gains, num_passages, k)
+    return metrics
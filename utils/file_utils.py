@@ -1,11 +1,10 @@
 # File handling helper methods
 import os
 import json
+import hashlib
 from pathlib import Path
-from pypdf import PdfReader
-from docx import Document
-from typing import Dict
-from config.config import DOCUMENTS_DIR
+from typing import Dict, Optional
+from config.config import DOCUMENTS_DIR, EXTRACTED_TEXT_DIR
 
 def ensure_directory_exists(directory_path):
     """Create directory if it doesn't exist"""
@@ -14,6 +13,7 @@ def ensure_directory_exists(directory_path):
 def load_pdf(file_path: str) -> str:
     """Extract the text from a PDF file"""
     # Use PdfReader to get the text
+    from pypdf import PdfReader
     reader = PdfReader(file_path)
     text = []
     for page in reader.pages:
@@ -22,6 +22,20 @@ def load_pdf(file_path: str) -> str:
     # Return all the text from the pdf
     return text
 
+def count_pdf_pages(file_path: str) -> int:
+    """Get the number of pages in a PDF file"""
+    from pypdf import PdfReader
+    return len(PdfReader(file_path).pages)
+
+def load_pdf_pages(file_path: str, start: int, end: int) -> str:
+    """Extract the text of pages start to end (exclusive) from a PDF file"""
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    text = []
+    for page in reader.pages[start:end]:
+        text.append(page.extract_text() or "")
+    return "\n".join(text)
+
 def load_txt(file_path: str) -> str:
     """Load text from .txt file"""
     # Use basic file IO to get text from the .txt file
@@ -32,14 +46,16 @@ def load_txt(file_path: str) -> str:
 
 def load_docx(file_path: str) -> str:
     """Extract text from Word document"""
-    # Using python-docx library get all the text
+    # Using python-docx library get all the text (imported here, pypdf and docx are only
+    # needed when a document has to be extracted)
+    from docx import Document
     doc = Document(file_path)
     text = "\n".join([para.text for para in doc.paragraphs])
     # Return the text
     return text
 
-def save_json(data, file_path: str) -> None:
-    """Save data to JSON file"""
+def save_json(data, file_path: str, indent: Optional[int] = 4) -> None:
+    """Save data to JSON file (pass indent=None for a compact file)"""
     # Turn all text to a dict
     if isinstance(data, str):
         text_data = {
@@ -47,7 +63,7 @@ def save_json(data, file_path: str) -> None:
         }
     # Use json library to write text to a .json file
     with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4)
+        json.dump(data, f, indent=indent)
 
 def load_json(file_path: str) -> Dict:
     """Load data from JSON file"""
@@ -58,6 +74,38 @@ def load_json(file_path: str) -> Dict:
     return data
 
 
+def _extraction_cache_path(file_path: str) -> Path:
+    # One cache file per document, named after its absolute path
+    path_hash = hashlib.sha1(str(Path(file_path).resolve()).encode("utf-8")).hexdigest()
+    return Path(EXTRACTED_TEXT_DIR) / (path_hash + ".txt")
+
+def _file_signature(file_path: str) -> Dict:
+    stat = os.stat(file_path)
+    return {"path": str(Path(file_path).resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def load_cached_text(file_path: str) -> Optional[str]:
+    """Get the extracted text of a document if it was cached and the file has not changed since"""
+    cache_path = _extraction_cache_path(file_path)
+    if not cache_path.exists():
+        return None
+    # The first line is the signature (path, size, mtime) of the file the text came from
+    with open(cache_path, "r", encoding="utf-8", newline="") as f:
+        signature = json.loads(f.readline())
+        if signature != _file_signature(file_path):
+            return None
+        return f.read()
+
+def save_cached_text(file_path: str, text: str) -> None:
+    """Cache the extracted text of a document, keyed by its path, size and modification time"""
+    ensure_directory_exists(EXTRACTED_TEXT_DIR)
+    cache_path = _extraction_cache_path(file_path)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        f.write(json.dumps(_file_signature(file_path)) + "\n")
+        f.write(text)
+    os.replace(tmp_path, cache_path)
+
+
 def main():
     pdf_text = load_pdf("Manish_Chepuri_Resume.pdf")
     save_json(pdf_text, "data/data.json")
@@ -1 +1,21 @@
-# Text cleaning and preprocessing
\ No newline at end of file
+# Text cleaning and preprocessing
+import math
+import re
+from typing import List
+
+# Voyage / Claude tokenizers average a little under 4 characters per token on English text
+CHARS_PER_TOKEN = 4
+# Runs of letters/digits, e.g. "CSC-226's" -> ["csc", "226", "s"]
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local estimate of how many tokens a piece of text is (no tokenizer download)"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens for keyword search"""
+    return TOKEN_PATTERN.findall(text.lower())
@@ -0,0 +1,97 @@
+# Vector math shared by the search indexes
+from typing import Optional
+
+import numpy as np
+
+from config.config import FILTER_GATHER_FRACTION
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize every row of a matrix as float32 (zero rows stay zero)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Get the indices of the top_k highest scores (per row for 2D scores), best first
+
+    Uses argpartition so only the top_k candidates are sorted, not every score
+    """
+    num_scores = scores.shape[-1]
+    top_k = min(top_k, num_scores)
+    if top_k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if top_k < num_scores:
+        candidates = np.argpartition(-scores, top_k - 1, axis=-1)[..., :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(num_scores), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=-1)
+    order = np.argsort(-candidate_scores, axis=-1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+def exact_search(normalized_matrix: np.ndarray,
+                 normalized_queries: np.ndarray,
+                 top_k: int,
+                 row_mask: Optional[np.ndarray] = None):
+    """Brute-force cosine search: one matrix product, then top_k per query
+
+    Args:
+        row_mask (np.ndarray, optional): bool per row, only the True rows can be returned
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (num_queries, top_k) row indices and their scores (fewer
+        than top_k columns when fewer rows pass row_mask)
+    """
+    queries = np.atleast_2d(normalized_queries)
+    if row_mask is not None:
+        rows = np.flatnonzero(row_mask)
+        if len(rows) < FILTER_GATHER_FRACTION * len(row_mask):
+            # Only a few rows pass, score just those
+            idxs, scores = exact_search(normalized_matrix[rows], queries, top_k)
+            return rows[idxs], scores
+        top_k = min(top_k, len(rows))
+    if normalized_matrix.shape[0] == 0:
+        empty = np.empty((queries.shape[0], 0))
+        return empty.astype(np.int64), empty
+    scores = queries @ normalized_matrix.T
+    if row_mask is not None:
+        # Filtered out rows can never make the top_k (which is at most the number of rows that pass)
+        scores[:, ~row_mask] = -np.inf
+    idxs = top_k_indices(scores, top_k)
+    return idxs, np.take_along_axis(scores, idxs, axis=-1)
+
+
+def recall_at_k(found_idxs: np.ndarray, exact_idxs: np.ndarray) -> float:
+    """Fraction of the exact top-k rows that an approximate search also found"""
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(found_idxs, exact_idxs))
+    return hits / exact_idxs.size if exact_idxs.size else 1.0
+
+
+def rerank(candidate_idxs: np.ndarray, normalized_queries: np.ndarray, get_full_vectors, top_k: int):
+    """Re-score each query's candidate rows with full precision vectors and keep the top_k
+
+    Args:
+        candidate_idxs (np.ndarray): (num_queries, num_candidates) rows, -1 marks a missing candidate
+        normalized_queries (np.ndarray): full precision normalized queries
+        get_full_vectors (Callable[[np.ndarray], np.ndarray]): normalized full vectors of some rows
+        top_k (int): number of rows to keep per query
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (num_queries, top_k) row indices (-1 if missing) and their scores
+    """
+    queries = np.atleast_2d(normalized_queries)
+    num_results = min(top_k, candidate_idxs.shape[1])
+    idxs = np.full((len(queries), num_results), -1, dtype=np.int64)
+    scores = np.full((len(queries), num_results), -np.inf, dtype=np.float32)
+    for i, (query, candidates) in enumerate(zip(queries, candidate_idxs)):
+        candidates = candidates[candidates >= 0]
+        if len(candidates) == 0:
+            continue
+        full_scores = get_full_vectors(candidates) @ query
+        best = top_k_indices(full_scores, num_results)
+        idxs[i, :len(best)] = candidates[best]
+        scores[i, :len(best)] = full_scores[best]
+    return idxs, scores